@@ -0,0 +1,145 @@
+"""Admission control for the message webhook.
+
+Every webhook request takes a slot before it touches the database, so a
+slow Postgres shows up as fast ``503`` answers with ``Retry-After`` instead
+of requests piling up on the connection pool. Slots are capped globally and
+per instance. Outgoing echoes (``fromMe``) may only use part of the global
+slots and wait behind incoming customer messages, so the messages that
+matter most still get in when the service is saturated.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from app.metrics import ADMISSION_WAIT, ADMISSIONS, REJECTIONS, WEBHOOK_IN_FLIGHT, WEBHOOK_WAITING
+
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", "12"))
+WEBHOOK_MAX_IN_FLIGHT_PER_INSTANCE = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT_PER_INSTANCE", "8"))
+# Share of the global slots outgoing echoes may hold; the rest is kept for incoming messages.
+WEBHOOK_OUTGOING_SHARE = float(os.getenv("WEBHOOK_OUTGOING_SHARE", "0.75"))
+WEBHOOK_ADMISSION_WAIT = float(os.getenv("WEBHOOK_ADMISSION_WAIT", "0.25"))
+WEBHOOK_MAX_WAITING = int(os.getenv("WEBHOOK_MAX_WAITING", "256"))
+WEBHOOK_RETRY_AFTER = int(os.getenv("WEBHOOK_RETRY_AFTER", "2"))
+
+INCOMING = "incoming"
+OUTGOING = "outgoing"
+
+
+class _waiter:
+    __slots__ = ("instance_id", "future")
+
+    def __init__(self, instance_id: str, future: asyncio.Future):
+        self.instance_id = instance_id
+        self.future = future
+
+
+class admission_controller:
+    """Counting slots with a global cap, a per-instance cap and two priorities.
+
+    A request that finds no free slot waits up to ``max_wait`` seconds.
+    Freed slots go to waiting incoming requests first, then to outgoing
+    ones, skipping waiters whose instance is still at its cap. Requests
+    still waiting at the deadline, or arriving when ``max_waiting`` are
+    already queued, are rejected.
+    """
+
+    def __init__(
+        self,
+        limit: int = WEBHOOK_MAX_IN_FLIGHT,
+        per_instance: int = WEBHOOK_MAX_IN_FLIGHT_PER_INSTANCE,
+        outgoing_share: float = WEBHOOK_OUTGOING_SHARE,
+        max_wait: float = WEBHOOK_ADMISSION_WAIT,
+        max_waiting: int = WEBHOOK_MAX_WAITING,
+    ):
+        self.limit = limit
+        self.per_instance = per_instance
+        self.outgoing_limit = max(1, int(limit * outgoing_share))
+        self.max_wait = max_wait
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        self._by_instance: Dict[str, int] = {}
+        self._waiting: Dict[str, Deque[_waiter]] = {INCOMING: deque(), OUTGOING: deque()}
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._waiting.values())
+
+    def _fits(self, instance_id: str, priority: str) -> bool:
+        limit = self.limit if priority == INCOMING else self.outgoing_limit
+        return self.in_flight < limit and self._by_instance.get(instance_id, 0) < self.per_instance
+
+    def _take(self, instance_id: str) -> None:
+        self.in_flight += 1
+        self._by_instance[instance_id] = self._by_instance.get(instance_id, 0) + 1
+
+    def _grant(self) -> None:
+        """Hand free slots to waiters, incoming first, in arrival order."""
+        for priority in (INCOMING, OUTGOING):
+            queue = self._waiting[priority]
+            for waiter in queue:
+                if not waiter.future.done() and self._fits(waiter.instance_id, priority):
+                    self._take(waiter.instance_id)
+                    waiter.future.set_result(True)
+            self._waiting[priority] = deque(waiter for waiter in queue if not waiter.future.done())
+
+    def _reason(self, instance_id: str) -> str:
+        return "instance" if self._by_instance.get(instance_id, 0) >= self.per_instance else "global"
+
+    def _reject(self, instance_id: str, priority: str, reason: Optional[str] = None) -> bool:
+        REJECTIONS.inc(priority=priority, reason=reason or self._reason(instance_id))
+        ADMISSIONS.inc(priority=priority, outcome="rejected")
+        return False
+
+    async def acquire(self, instance_id: str, from_me: bool) -> bool:
+        """Take a slot for ``instance_id``. Returns False when the request must be shed."""
+        priority = OUTGOING if from_me else INCOMING
+        ahead = self._waiting[INCOMING] or (priority == OUTGOING and self._waiting[OUTGOING])
+        if not ahead and self._fits(instance_id, priority):
+            self._take(instance_id)
+            ADMISSIONS.inc(priority=priority, outcome="admitted")
+            return True
+        if self.max_wait <= 0 or self.waiting >= self.max_waiting:
+            return self._reject(instance_id, priority, None if self.max_wait <= 0 else "waiting")
+
+        waiter = _waiter(instance_id, asyncio.get_running_loop().create_future())
+        self._waiting[priority].append(waiter)
+        # Waiters ahead may be stuck on their own instance cap; this one may fit now.
+        self._grant()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if waiter.future.done():
+                self.release(instance_id)
+            else:
+                waiter.future.cancel()
+            raise
+        finally:
+            ADMISSION_WAIT.observe(time.perf_counter() - started, priority=priority)
+        if waiter.future.done() and not waiter.future.cancelled():
+            ADMISSIONS.inc(priority=priority, outcome="waited")
+            return True
+        waiter.future.cancel()
+        try:
+            self._waiting[priority].remove(waiter)
+        except ValueError:
+            pass
+        return self._reject(instance_id, priority)
+
+    def release(self, instance_id: str) -> None:
+        self.in_flight -= 1
+        remaining = self._by_instance[instance_id] - 1
+        if remaining:
+            self._by_instance[instance_id] = remaining
+        else:
+            del self._by_instance[instance_id]
+        self._grant()
+
+
+webhook_admission = admission_controller()
+WEBHOOK_IN_FLIGHT.set_function(lambda: webhook_admission.in_flight)
+WEBHOOK_WAITING.set_function(lambda: webhook_admission.waiting)
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Optional
+
+import asyncpg
+
+from app.database import DATABASE_URL
+from app.websocket_manager import connection_manager
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_BACKEND = os.getenv("BROADCAST_BACKEND", "memory")
+BROADCAST_CHANNEL = os.getenv("BROADCAST_CHANNEL", "nestor_messages")
+# Last sequence number handed out per instance.
+BROADCAST_SEQ_TABLE = "nestor_broadcast_instance_seq"
+
+CREATE_SEQ_TABLE_SQL = f"""
+CREATE TABLE IF NOT EXISTS {BROADCAST_SEQ_TABLE} (instance_id text PRIMARY KEY, seq bigint NOT NULL)
+"""
+
+# Incrementing the instance's row locks it until the implicit transaction
+# commits the NOTIFY, so the events of one instance are delivered in
+# sequence order while other instances publish in parallel.
+PUBLISH_SQL = f"""
+WITH next AS (
+    INSERT INTO {BROADCAST_SEQ_TABLE} AS s (instance_id, seq) VALUES ($1, 1)
+    ON CONFLICT (instance_id) DO UPDATE SET seq = s.seq + 1
+    RETURNING seq
+)
+SELECT pg_notify($2, jsonb_set($3::jsonb, '{{seq}}', to_jsonb(next.seq))::text) FROM next
+"""
+
+# NOTIFY payloads must stay below 8000 bytes; keep headroom for the seq
+# field and the jsonb re-serialization done by PUBLISH_SQL.
+NOTIFY_MAX_BYTES = 7600
+
+
+class memory_backend:
+    """Deliver events to the websockets connected to this process only."""
+
+    def __init__(self, manager: connection_manager):
+        self.manager = manager
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def publish(self, payload: dict, instance_id: str, whatsapp_id: str) -> None:
+        self.manager.publish(payload, instance_id, whatsapp_id)
+
+
+class postgres_backend:
+    """Fan events out to every worker through Postgres LISTEN/NOTIFY.
+
+    Publishing only sends the NOTIFY; each worker, including the publisher,
+    delivers the event to its own websockets when the notification comes
+    back on its listener connection, so all workers see the same order.
+    Sequence numbers come from a per-instance counter in Postgres, so a
+    client can resume on any worker.
+    """
+
+    def __init__(self, manager: connection_manager, dsn: str = DATABASE_URL, channel: str = BROADCAST_CHANNEL):
+        self.manager = manager
+        # Events are numbered by BROADCAST_SEQ_TABLE from 1; the listener
+        # raises each instance's floor to its current value on (re)connect.
+        manager.start_sequence(0)
+        self.dsn = dsn
+        self.channel = channel
+        self._pool = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        # Connecting happens in the listener task, so the app boots (with
+        # websockets but no live feed) while Postgres is unreachable.
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def publish(self, payload: dict, instance_id: str, whatsapp_id: str) -> None:
+        envelope = {"instanceId": instance_id, "WhatsappjId": whatsapp_id, "payload": payload}
+        data = json.dumps(envelope)
+        if len(data.encode()) > NOTIFY_MAX_BYTES:
+            data = json.dumps(self._shrink(envelope))
+        if self._pool is None:
+            raise RuntimeError("Broadcast backend is not connected to Postgres yet")
+        await self._pool.execute(PUBLISH_SQL, instance_id, self.channel, data)
+
+    @staticmethod
+    def _shrink(envelope: dict) -> dict:
+        """Truncate the message text so the envelope fits in a NOTIFY payload."""
+        content = envelope["payload"].get("Message_Content") or ""
+        payload = dict(envelope["payload"], Message_Content="", truncated=True)
+        budget = NOTIFY_MAX_BYTES - len(json.dumps(dict(envelope, payload=payload)).encode())
+        encoded = len(json.dumps(content).encode()) - 2
+        while content and encoded > budget:
+            content = content[: min(len(content) - 1, len(content) * budget // encoded)]
+            encoded = len(json.dumps(content).encode()) - 2
+        payload["Message_Content"] = content
+        return dict(envelope, payload=payload)
+
+    def _on_notify(self, connection, pid, channel, data) -> None:
+        try:
+            envelope = json.loads(data)
+            self.manager.publish(
+                envelope["payload"], envelope["instanceId"], envelope["WhatsappjId"], envelope["seq"]
+            )
+        except Exception:
+            logger.exception("Ignoring malformed broadcast notification")
+
+    async def _connect_pool(self) -> None:
+        pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=4)
+        try:
+            await pool.execute(CREATE_SEQ_TABLE_SQL)
+        except BaseException:
+            await pool.close()
+            raise
+        self._pool = pool
+
+    async def _listen(self) -> None:
+        """Open the publish pool, then keep a LISTEN connection open, retrying both with backoff."""
+        delay = 1
+        while True:
+            connection = None
+            try:
+                if self._pool is None:
+                    await self._connect_pool()
+                connection = await asyncpg.connect(self.dsn)
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda _: closed.set())
+                await connection.add_listener(self.channel, self._on_notify)
+                # Anything published before this listener existed was missed.
+                self.manager.reset_floors(dict(
+                    await connection.fetch(f"SELECT instance_id, seq FROM {BROADCAST_SEQ_TABLE}")
+                ))
+                delay = 1
+                await closed.wait()
+                logger.warning("Broadcast listener connection lost, reconnecting")
+            except asyncio.CancelledError:
+                if connection is not None:
+                    await connection.close()
+                raise
+            except Exception:
+                logger.exception("Broadcast listener failed, retrying in %ss", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+def create_broadcast_backend(manager: connection_manager):
+    """Build the backend selected by BROADCAST_BACKEND."""
+    if BROADCAST_BACKEND == "postgres":
+        return postgres_backend(manager)
+    return memory_backend(manager)
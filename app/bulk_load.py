@@ -0,0 +1,430 @@
+"""Bulk loading of Evolution history (messages.set / history sync) through COPY.
+
+Payloads are parsed incrementally from the request stream, loaded chunk by
+chunk into temporary staging tables with COPY and merged into the real tables
+with one set-based statement per table.
+"""
+import codecs
+import io
+import json
+import logging
+import os
+import re
+from datetime import datetime
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+from app.change_versions import bump_committed, message_scopes
+from app.contact_cache import known_contacts
+from app.database import open_session, threadpool_session
+from app.ingestion import _contact_rows, _image_row, _text_row, parse_webhook_payload
+from app.models import timeline
+from app.partitions import ensure_partitions_for
+from app.rollup import record_rollup
+from app.timeline import CONVERSATION_COLUMNS, refresh_conversations
+
+logger = logging.getLogger(__name__)
+
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "5000"))
+# Largest single JSON document accepted while waiting for it to complete.
+BULK_MAX_DOCUMENT_BYTES = int(os.getenv("BULK_MAX_DOCUMENT_BYTES", str(16 * 1024 * 1024)))
+
+TEXT_COLUMNS = ["messageId", "datetime", "WhatsappjId", "Message_Type", "Message_Content", "instanceId"]
+IMAGE_COLUMNS = [
+    "id", "messageId", "WhatsappjId", "instanceId", "datetime", "url", "mimetype", "caption",
+    "fileSha256", "fileLength", "height", "width", "mediaKey", "fileEncSha256", "Message_Type",
+]
+CONTACT_COLUMNS = ["contactId", "WhatsappjId", "pushname", "instanceId"]
+
+
+class json_stream_error(ValueError):
+    """The request body is not a JSON array or sequence of JSON values."""
+
+
+# Characters that matter while scanning a value: inside a string only the
+# quote and escapes, outside it only quotes and brackets.
+_STRING_SPECIAL = re.compile(r'["\\]')
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_VALUE_START = re.compile(r"[^\s,]")
+_SCALAR_END = re.compile(r"[\s,\]]")
+
+
+class json_stream:
+    """Incremental parser for a JSON array or a sequence of JSON values (NDJSON).
+
+    Values are decoded straight from the chunk when they fit in it. A value
+    cut by the chunk boundary is scanned once, tracking nesting depth and
+    strings, to find where it ends, and decoded only then, so a document
+    spanning many chunks costs linear time.
+    """
+
+    def __init__(self, max_document_bytes: int = BULK_MAX_DOCUMENT_BYTES):
+        self.max_document_bytes = max_document_bytes
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._in_array: Optional[bool] = None
+        # Text of the value being scanned, from chunks already consumed.
+        self._pieces: Optional[List[str]] = None
+        self._pending = 0
+        self._depth = 0
+        self._in_string = False
+        self._scalar = False
+        self._escaped = False
+
+    def feed(self, chunk: bytes) -> List[Any]:
+        return self._drain(self._text.decode(chunk))
+
+    def close(self) -> List[Any]:
+        values = self._drain(self._text.decode(b"", final=True))
+        if self._pieces is not None:
+            if not self._scalar:
+                raise json_stream_error("Malformed or truncated JSON in request body")
+            values.append(self._decode(""))
+        return values
+
+    def _decode(self, tail: str) -> Any:
+        document = "".join(self._pieces) + tail
+        self._pieces = None
+        try:
+            return self._decoder.decode(document)
+        except json.JSONDecodeError:
+            raise json_stream_error("Malformed or truncated JSON in request body")
+
+    def _drain(self, text: str) -> List[Any]:
+        values = []
+        pos = 0
+        start = 0
+        while True:
+            if self._pieces is None:
+                match = _VALUE_START.search(text, pos)
+                if match is None:
+                    break
+                pos = match.start()
+                if self._in_array is None:
+                    self._in_array = text[pos] == "["
+                    if self._in_array:
+                        pos += 1
+                        continue
+                if self._in_array and text[pos] == "]":
+                    pos += 1
+                    continue
+                try:
+                    value, end = self._decoder.raw_decode(text, pos)
+                except json.JSONDecodeError:
+                    pass
+                else:
+                    # A scalar ends only at a delimiter: "3." may be "3.5" cut by the chunk.
+                    if text[pos] in '{["' or _SCALAR_END.match(text, end):
+                        values.append(value)
+                        pos = end
+                        continue
+                start = pos
+                self._pieces, self._pending = [], 0
+                self._scalar = text[pos] not in '{["'
+                self._in_string = text[pos] == '"'
+                self._depth = 1 if text[pos] in "{[" else 0
+                if not self._scalar:
+                    pos += 1
+
+            if self._escaped:
+                pos += 1
+                self._escaped = False
+            if self._scalar:
+                match = _SCALAR_END.search(text, pos)
+                if match is None:
+                    pos = len(text)
+                    break
+                pos = match.start()
+            elif self._in_string:
+                match = _STRING_SPECIAL.search(text, pos)
+                if match is None:
+                    pos = len(text)
+                    break
+                if match.group() == "\\":
+                    pos = match.end() + 1
+                    if pos > len(text):
+                        self._escaped = True
+                        pos = len(text)
+                        break
+                    continue
+                pos = match.end()
+                self._in_string = False
+                if self._depth:
+                    continue
+            else:
+                match = _STRUCTURE.search(text, pos)
+                if match is None:
+                    pos = len(text)
+                    break
+                pos = match.end()
+                char = match.group()
+                if char == '"':
+                    self._in_string = True
+                    continue
+                self._depth += 1 if char in "{[" else -1
+                if self._depth:
+                    continue
+            values.append(self._decode(text[start:pos]))
+
+        if self._pieces is not None:
+            self._pieces.append(text[start:pos])
+            self._pending += pos - start
+            if self._pending > self.max_document_bytes:
+                raise json_stream_error("JSON document exceeds BULK_MAX_DOCUMENT_BYTES")
+        return values
+
+
+def expand_history_item(item: Any, instance_id: Optional[str] = None) -> Iterator[dict]:
+    """Yield webhook-shaped payloads from one element of a history upload.
+
+    Accepts full webhook envelopes, messages.set envelopes whose ``data``
+    holds a ``messages`` list, and bare message objects. ``instance_id``
+    fills in messages that do not carry their own instanceId.
+    """
+    if isinstance(item, list):
+        for sub in item:
+            yield from expand_history_item(sub, instance_id)
+        return
+    if not isinstance(item, dict):
+        return
+    data = item.get("data", item)
+    if isinstance(data, list):
+        messages = data
+    elif isinstance(data, dict) and isinstance(data.get("messages"), list):
+        messages = data["messages"]
+    else:
+        messages = [data]
+    for msg in messages:
+        if not isinstance(msg, dict):
+            continue
+        if instance_id and not msg.get("instanceId"):
+            msg = dict(msg, instanceId=instance_id)
+        yield {"data": msg}
+
+
+async def iter_events(
+    chunks: AsyncIterator[bytes], instance_id: Optional[str] = None
+) -> AsyncIterator[Tuple[Optional[dict], Any]]:
+    """Parse a request body into (event, None) or (None, error) pairs."""
+    stream = json_stream()
+
+    def parse(values):
+        for value in values:
+            for payload in expand_history_item(value, instance_id):
+                try:
+                    yield parse_webhook_payload(payload), None
+                except (ValueError, TypeError) as e:
+                    yield None, str(e)
+
+    async for chunk in chunks:
+        for item in parse(stream.feed(chunk)):
+            yield item
+    for item in parse(stream.close()):
+        yield item
+
+
+def _copy_value(value: Any) -> str:
+    """Render a value in COPY text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _psycopg2_copy(session, table: str, columns: List[str], records: List[tuple]) -> None:
+    body = io.StringIO()
+    for record in records:
+        body.write("\t".join(_copy_value(v) for v in record))
+        body.write("\n")
+    body.seek(0)
+    column_list = ", ".join(f'"{c}"' for c in columns)
+    cursor = session.connection().connection.dbapi_connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table} ({column_list}) FROM STDIN", body)
+    finally:
+        cursor.close()
+
+
+async def _execute_raw(db, sql: str) -> None:
+    if isinstance(db, threadpool_session):
+        await run_in_threadpool(lambda: db.sync_session.connection().exec_driver_sql(sql))
+    else:
+        connection = await db.connection()
+        await connection.exec_driver_sql(sql)
+
+
+async def _copy_records(db, table: str, columns: List[str], records: List[tuple]) -> None:
+    """COPY records into a table on the session's own connection and transaction."""
+    if not records:
+        return
+    if isinstance(db, threadpool_session):
+        await run_in_threadpool(_psycopg2_copy, db.sync_session, table, columns, records)
+        return
+    connection = await db.connection()
+    raw = await connection.get_raw_connection()
+    await raw.driver_connection.copy_records_to_table(table, records=records, columns=columns)
+
+
+def _records(rows: List[dict], columns: List[str]) -> List[tuple]:
+    return [tuple(row[c] for c in columns) for row in rows]
+
+
+def _image_record(event: dict) -> dict:
+    row = _image_row(event)
+    # COPY does not coerce: keep the types of the image_message columns.
+    row["fileLength"] = str(row["fileLength"]) if row["fileLength"] is not None else None
+    for key in ("height", "width"):
+        row[key] = int(row[key]) if row[key] is not None else None
+    return row
+
+
+async def load_chunk(db, events: List[dict]) -> Tuple[List[dict], List[tuple]]:
+    """Stage one chunk with COPY and merge it; the caller commits.
+
+    Timeline and conversation rows are written for every staged message, so
+    a sync also fills in messages stored before the timeline existed.
+
+    Returns the events whose message was inserted and the resulting contact
+    rows, like ingestion.write_batch.
+    """
+    unique = {}
+    for event in events:
+        unique.setdefault(event["message_id"], event)
+    events = list(unique.values())
+
+    await ensure_partitions_for(e["datetime_obj"] for e in events)
+    for table in ("message", "image_message", "contact"):
+        await _execute_raw(
+            db,
+            f"CREATE TEMP TABLE IF NOT EXISTS stage_{table} "
+            f"(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS",
+        )
+
+    await _copy_records(
+        db, "stage_message", TEXT_COLUMNS,
+        _records([_text_row(e) for e in events if e["kind"] == "text"], TEXT_COLUMNS),
+    )
+    await _copy_records(
+        db, "stage_image_message", IMAGE_COLUMNS,
+        _records([_image_record(e) for e in events if e["kind"] == "image"], IMAGE_COLUMNS),
+    )
+    await _copy_records(db, "stage_contact", CONTACT_COLUMNS, _records(_contact_rows(events), CONTACT_COLUMNS))
+
+    text_columns = ", ".join(f'"{c}"' for c in TEXT_COLUMNS)
+    image_columns = ", ".join(f'"{c}"' for c in IMAGE_COLUMNS)
+    inserted = set()
+    result = await db.execute(text(
+        f'INSERT INTO message ({text_columns}) SELECT {text_columns} FROM stage_message '
+        f'ON CONFLICT DO NOTHING RETURNING "messageId"'
+    ))
+    inserted.update(result.scalars().all())
+    result = await db.execute(text(
+        f'INSERT INTO image_message ({image_columns}) SELECT {image_columns} FROM stage_image_message '
+        f'ON CONFLICT DO NOTHING RETURNING "messageId"'
+    ))
+    inserted.update(result.scalars().all())
+    # Same lock order as ingestion.write_batch: contacts, then timeline and
+    # conversations, then rollups, so a sync cannot deadlock live webhooks.
+    result = await db.execute(text(
+        'INSERT INTO contact ("contactId", "WhatsappjId", pushname, "instanceId") '
+        'SELECT "contactId", "WhatsappjId", pushname, "instanceId" FROM stage_contact '
+        'ORDER BY "WhatsappjId" '
+        'ON CONFLICT ("WhatsappjId") DO UPDATE SET '
+        'pushname = COALESCE(excluded.pushname, contact.pushname), '
+        '"updatedAt" = CASE WHEN excluded.pushname IS NULL THEN contact."updatedAt" ELSE now() END '
+        'RETURNING "WhatsappjId", "contactId", pushname'
+    ))
+    contacts = [tuple(row) for row in result.all()]
+    await db.execute(text(
+        'INSERT INTO timeline ("instanceId", "WhatsappjId", datetime, "messageId", kind, "Message_Type") '
+        'SELECT "instanceId", "WhatsappjId", datetime, "messageId", \'text\', "Message_Type" FROM stage_message '
+        'UNION ALL '
+        'SELECT "instanceId", "WhatsappjId", datetime, id, \'image\', "Message_Type" FROM stage_image_message '
+        'ON CONFLICT DO NOTHING'
+    ))
+    staged = text(
+        'SELECT "instanceId", "WhatsappjId", datetime, "messageId", \'text\' AS kind FROM stage_message '
+        'UNION ALL '
+        'SELECT "instanceId", "WhatsappjId", datetime, id, \'image\' FROM stage_image_message'
+    ).columns(*(timeline.__table__.c[column] for column in CONVERSATION_COLUMNS)).subquery("staged")
+    await db.execute(refresh_conversations(staged))
+
+    stored = [e for e in events if e["message_id"] in inserted]
+    await record_rollup(db, stored)
+    return stored, contacts
+
+
+async def _commit_chunk(events: List[dict]) -> List[dict]:
+    db = open_session()
+    try:
+        stored, contacts = await load_chunk(db, events)
+        await db.commit()
+        known_contacts.put_many(contacts)
+        await bump_committed(db, message_scopes(events, stored, contacts))
+        return stored
+    except Exception:
+        await db.rollback()
+        raise
+    finally:
+        await db.close()
+
+
+async def load_stream(
+    chunks: AsyncIterator[bytes],
+    instance_id: Optional[str] = None,
+    chunk_size: int = BULK_CHUNK_SIZE,
+    on_commit: Optional[Callable[[List[dict]], Any]] = None,
+) -> Dict[str, Any]:
+    """Load a history upload chunk by chunk, one transaction per chunk.
+
+    Chunks committed before a failure stay committed; the summary tells the
+    caller how far the load got, and re-sending the whole upload is safe
+    because already stored messages are skipped.
+    """
+    summary = {"received": 0, "inserted": 0, "duplicates": 0, "ignored": 0, "invalid": 0, "errors": []}
+    pending: List[dict] = []
+
+    async def flush():
+        stored = await _commit_chunk(pending)
+        summary["inserted"] += len(stored)
+        summary["duplicates"] += len(pending) - len(stored)
+        pending.clear()
+        if stored and on_commit is not None:
+            await on_commit(stored)
+
+    try:
+        async for event, error in iter_events(chunks, instance_id):
+            summary["received"] += 1
+            if event is None:
+                summary["invalid"] += 1
+                if len(summary["errors"]) < 10:
+                    summary["errors"].append(error)
+                continue
+            if event["kind"] is None:
+                summary["ignored"] += 1
+                continue
+            if event["kind"] == "image" and not event["img_data"].get("url"):
+                summary["invalid"] += 1
+                if len(summary["errors"]) < 10:
+                    summary["errors"].append(f"Image message {event['message_id']} has no url")
+                continue
+            pending.append(event)
+            if len(pending) >= chunk_size:
+                await flush()
+        if pending:
+            await flush()
+    except json_stream_error as e:
+        summary["malformed"] = str(e)
+    except Exception as e:
+        logger.exception("Bulk load aborted after %d inserted messages", summary["inserted"])
+        summary["failed"] = str(e)
+    return summary
@@ -0,0 +1,102 @@
+"""Per-scope change versions backing ETags of the polled list endpoints.
+
+Writers bump the versions of the scopes they touch in their own transaction,
+or, on the hot ingest paths, in a short one right after it (see
+``bump_committed``); readers fetch the version first and answer
+``If-None-Match`` with a 304 without querying the listed tables.
+"""
+import hashlib
+import logging
+import time
+from typing import Iterable, Optional, Tuple
+
+from fastapi import Request, Response, status
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.models import change_version
+
+logger = logging.getLogger(__name__)
+
+INBOXES = "inboxes"
+
+
+def contacts_scope(instance_id: str) -> str:
+    return f"contacts:{instance_id}"
+
+
+def conversations_scope(instance_id: str) -> str:
+    return f"conversations:{instance_id}"
+
+
+def instance_scopes(instance_id: str) -> Tuple[str, str]:
+    """Scopes changed by a contact change: the list itself and the conversation names."""
+    return contacts_scope(instance_id), conversations_scope(instance_id)
+
+
+def message_scopes(events: Iterable[dict], stored: Iterable[dict], contacts: Iterable[tuple]) -> set:
+    """Scopes touched by an ingested batch: new messages and upserted contacts."""
+    scopes = {conversations_scope(event["instance_id"]) for event in stored}
+    upserted = {row[0] for row in contacts}
+    for event in events:
+        if event["whatsapp_id"] in upserted:
+            scopes.update(instance_scopes(event["instance_id"]))
+    return scopes
+
+
+async def bump(db, scopes: Iterable[str]) -> None:
+    """Advance the versions of ``scopes``; the caller commits.
+
+    Versions are microsecond timestamps (never going backwards), so an ETag
+    stays unique even if the table is recreated. The version rows stay
+    locked, in sorted order, until the commit.
+    """
+    scopes = sorted(set(scopes))
+    if not scopes:
+        return
+    now = time.time_ns() // 1000
+    stmt = pg_insert(change_version).values([{"scope": scope, "version": now} for scope in scopes])
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[change_version.scope],
+        set_={"version": func.greatest(change_version.version + 1, stmt.excluded.version)},
+    ))
+
+
+async def bump_committed(db, scopes: Iterable[str]) -> None:
+    """Bump ``scopes`` in a transaction of its own, after the writes they cover committed.
+
+    Every writer of an instance shares its version rows; bumping outside the
+    write transaction holds their locks for one statement instead of a whole
+    batch. Readers can see the new data under the old version for a moment,
+    never the reverse. Failures are logged: the data is already committed.
+    """
+    if not scopes:
+        return
+    try:
+        await bump(db, scopes)
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        logger.exception("Could not bump change versions %s", sorted(scopes))
+
+
+async def current(db, scope: str) -> int:
+    return await db.scalar(select(change_version.version).where(change_version.scope == scope)) or 0
+
+
+def etag_for(request: Request, scope: str, version: int) -> str:
+    """Strong ETag of a response: the scope version plus the query parameters."""
+    digest = hashlib.sha1(f"{scope}|{version}|{request.url.query}".encode()).hexdigest()[:20]
+    return f'"{digest}"'
+
+
+async def check_not_modified(request: Request, db, scope: str) -> Tuple[str, Optional[Response]]:
+    """Return the ETag for the current version and, if the client has it, a 304 response."""
+    etag = etag_for(request, scope, await current(db, scope))
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (
+        if_none_match.strip() == "*"
+        or etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+    ):
+        return etag, Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return etag, None
@@ -0,0 +1,50 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+CONTACT_CACHE_SIZE = int(os.getenv("CONTACT_CACHE_SIZE", "50000"))
+CONTACT_CACHE_TTL = float(os.getenv("CONTACT_CACHE_TTL", "600"))
+
+
+class contact_cache:
+    """Bounded LRU of WhatsappjId -> (contactId, pushname) with a TTL.
+
+    Entries only reflect committed rows: callers add them after their
+    transaction commits. The TTL bounds how long a change made by another
+    worker can go unnoticed.
+    """
+
+    def __init__(self, max_size: int = CONTACT_CACHE_SIZE, ttl: float = CONTACT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[str, Optional[str], float]]" = OrderedDict()
+
+    def get(self, whatsapp_id: str) -> Optional[Tuple[str, Optional[str]]]:
+        entry = self._entries.get(whatsapp_id)
+        if entry is None:
+            return None
+        if entry[2] < time.monotonic():
+            del self._entries[whatsapp_id]
+            return None
+        self._entries.move_to_end(whatsapp_id)
+        return entry[0], entry[1]
+
+    def put(self, whatsapp_id: str, contact_id: str, pushname: Optional[str]) -> None:
+        self._entries[whatsapp_id] = (contact_id, pushname, time.monotonic() + self.ttl)
+        self._entries.move_to_end(whatsapp_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def put_many(self, rows: Iterable[Tuple[str, str, Optional[str]]]) -> None:
+        for whatsapp_id, contact_id, pushname in rows:
+            self.put(whatsapp_id, contact_id, pushname)
+
+    def invalidate(self, whatsapp_id: str) -> None:
+        self._entries.pop(whatsapp_id, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+known_contacts = contact_cache()
@@ -1,7 +1,25 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
 from dotenv import load_dotenv
+import asyncio
+import itertools
+import logging
 import os
+from typing import List, Optional
+
+from app.metrics import (
+    READ_SESSIONS,
+    REPLICA_HEALTHY,
+    REPLICA_LAG,
+    instrument_engine,
+    timed_async_pool,
+    timed_pool_class,
+    timed_queue_pool,
+)
 
 #load_dotenv()
 from pathlib import Path
@@ -14,16 +32,313 @@ POSTGRES_USER = os.getenv("POSTGRES_USER")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
 POSTGRES_DB = os.getenv("POSTGRES_DB")
 
+# "async" serves requests through asyncpg; "sync" keeps the blocking driver and
+# runs every session call in the threadpool. Both expose the same awaitable API.
+DB_MODE = os.getenv("DB_MODE", "async")
+
 DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+
+# Optional streaming replicas for read-only GET routes: comma-separated
+# postgresql:// URLs, or host[:port] entries reusing the primary's credentials.
+READ_REPLICA_URLS = [url.strip() for url in os.getenv("READ_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "2"))
+REPLICA_CHECK_TIMEOUT = float(os.getenv("REPLICA_CHECK_TIMEOUT", "1"))
+
+logger = logging.getLogger(__name__)
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Engines are created by init_engines() (the app lifespan, or the first
+# session a CLI opens), so importing the app never touches the database.
+engine = None
+async_engine = None
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
+
+# A replica that has replayed everything it received has no lag, even when
+# its last replayed transaction is old because the primary is idle. That only
+# holds while its WAL receiver streams: a disconnected replica has replayed
+# everything it received, forever. Without pg_read_all_stats the receiver row
+# shows no status, but it only exists while the receiver process runs.
+REPLICA_LAG_SQL = """
+SELECT pg_is_in_recovery(),
+       EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE coalesce(status, 'streaming') = 'streaming'),
+       CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+       END
+"""
+
+
+def _replica_url(entry: str) -> str:
+    if "://" in entry:
+        return entry
+    host, _, port = entry.partition(":")
+    return f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{host}:{port or POSTGRES_PORT}/{POSTGRES_DB}"
+
+
+class _replica:
+    """One read replica with the health and lag seen by its last check."""
+
+    def __init__(self, index: int, url: str):
+        self.name = f"replica{index}"
+        self.url = make_url(_replica_url(url))
+        self.engine = None
+        self.sessions = None
+        self.healthy = False
+        self.lag: Optional[float] = None
+
+    def init(self) -> None:
+        if self.engine is not None:
+            return
+        if DB_MODE == "sync":
+            self.engine = create_engine(
+                self.url, poolclass=timed_pool_class(self.name), connect_args={"connect_timeout": 2}
+            )
+            self.sessions = sessionmaker(bind=self.engine, autoflush=False)
+        else:
+            self.engine = create_async_engine(
+                self.url.set(drivername="postgresql+asyncpg"),
+                poolclass=timed_pool_class(self.name, asynchronous=True),
+                connect_args={"timeout": 2},
+            )
+            self.sessions = async_sessionmaker(bind=self.engine, autoflush=False, expire_on_commit=False)
+        instrument_engine(self.engine, self.name)
+
+    async def dispose(self) -> None:
+        if self.engine is None:
+            return
+        if DB_MODE == "sync":
+            await run_in_threadpool(self.engine.dispose)
+        else:
+            await self.engine.dispose()
+        self.engine = self.sessions = None
+        self.healthy = False
+
+    def _probe_sync(self):
+        with self.engine.connect() as conn:
+            return conn.execute(text(REPLICA_LAG_SQL)).one()
+
+    async def _probe(self):
+        if DB_MODE == "sync":
+            return await run_in_threadpool(self._probe_sync)
+        async with self.engine.connect() as conn:
+            return (await conn.execute(text(REPLICA_LAG_SQL))).one()
+
+    async def check(self) -> None:
+        """Refresh ``healthy`` and ``lag``.
+
+        A replica that is not in recovery, or whose WAL receiver is not
+        streaming from the primary, is not used.
+        """
+        try:
+            in_recovery, streaming, lag = await asyncio.wait_for(self._probe(), REPLICA_CHECK_TIMEOUT)
+            healthy = bool(in_recovery and streaming)
+            if not in_recovery:
+                logger.warning("Read replica %s is not in recovery; not using it", self.name)
+            elif not streaming and self.healthy:
+                logger.warning("Read replica %s is not streaming from the primary; not using it", self.name)
+        except Exception as e:
+            healthy, lag = False, None
+            if self.healthy:
+                logger.warning("Read replica %s failed its health check: %s", self.name, e)
+        if healthy and not self.healthy:
+            logger.info("Read replica %s is available", self.name)
+        self.healthy = healthy
+        self.lag = None if lag is None else float(lag)
+        REPLICA_HEALTHY.set(int(healthy), replica=self.name)
+        REPLICA_LAG.set(-1 if self.lag is None else self.lag, replica=self.name)
+
+    @property
+    def usable(self) -> bool:
+        # Unknown lag (nothing replayed yet) counts as too much.
+        return self.healthy and self.lag is not None and self.lag <= REPLICA_MAX_LAG_SECONDS
+
+
+class replica_set:
+    """Round-robin over the replicas that are healthy and within the lag budget.
+
+    Replicas start out unused and join once a health check passes, so with
+    no monitor running (command line tools) every read goes to the primary.
+    """
+
+    def __init__(self, urls: List[str]):
+        self.replicas = [_replica(index, url) for index, url in enumerate(urls)]
+        self._turn = itertools.count()
+
+    def init(self) -> None:
+        for replica in self.replicas:
+            replica.init()
+
+    async def dispose(self) -> None:
+        for replica in self.replicas:
+            await replica.dispose()
+
+    def choose(self) -> Optional[_replica]:
+        usable = [replica for replica in self.replicas if replica.usable]
+        if not usable:
+            return None
+        return usable[next(self._turn) % len(usable)]
+
+    async def monitor(self, interval: float = REPLICA_CHECK_INTERVAL) -> None:
+        """Check every replica every ``interval`` seconds."""
+        if not self.replicas:
+            return
+        while True:
+            await asyncio.gather(*(replica.check() for replica in self.replicas if replica.engine is not None))
+            await asyncio.sleep(interval)
+
+
+read_replicas = replica_set(READ_REPLICA_URLS)
+
+
+def init_engines() -> None:
+    """Create the engines and bind the session factories; no connection is opened."""
+    global engine, async_engine
+    if engine is None:
+        engine = create_engine(DATABASE_URL, poolclass=timed_queue_pool)
+        instrument_engine(engine, "sync")
+        SessionLocal.configure(bind=engine)
+    if async_engine is None:
+        async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=timed_async_pool)
+        instrument_engine(async_engine, "async")
+        AsyncSessionLocal.configure(bind=async_engine)
+    read_replicas.init()
+
+
+async def dispose_engines() -> None:
+    """Close every pooled connection and forget the engines."""
+    global engine, async_engine
+    await read_replicas.dispose()
+    if async_engine is not None:
+        await async_engine.dispose()
+        async_engine = None
+    if engine is not None:
+        await run_in_threadpool(engine.dispose)
+        engine = None
+
+
+def get_engine():
+    """The sync engine, for background jobs and command line tools."""
+    init_engines()
+    return engine
+
+
+class threadpool_session:
+    """Awaitable facade over a sync Session, mirroring the AsyncSession API."""
+
+    def __init__(self, session):
+        self.sync_session = session
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def add_all(self, instances):
+        self.sync_session.add_all(instances)
+
+    async def execute(self, statement, params=None, **kwargs):
+        return await run_in_threadpool(self.sync_session.execute, statement, params, **kwargs)
+
+    async def scalar(self, statement, params=None, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalar, statement, params, **kwargs)
+
+    async def scalars(self, statement, params=None, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalars, statement, params, **kwargs)
+
+    async def get(self, entity, ident, **kwargs):
+        return await run_in_threadpool(self.sync_session.get, entity, ident, **kwargs)
+
+    async def delete(self, instance):
+        await run_in_threadpool(self.sync_session.delete, instance)
+
+    async def refresh(self, instance, attribute_names=None):
+        await run_in_threadpool(self.sync_session.refresh, instance, attribute_names)
+
+    async def flush(self):
+        await run_in_threadpool(self.sync_session.flush)
+
+    async def commit(self):
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def close(self):
+        await run_in_threadpool(self.sync_session.close)
+
+
+def open_session():
+    """Return a session for the configured DB_MODE."""
+    init_engines()
+    if DB_MODE == "sync":
+        return threadpool_session(SessionLocal())
+    return AsyncSessionLocal()
+
+
+async def get_db():
+    db = open_session()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        await db.close()
+
+
+def open_read_session():
+    """Return a session on a usable read replica, or on the primary if there is none."""
+    init_engines()
+    replica = read_replicas.choose()
+    if replica is None:
+        READ_SESSIONS.inc(target="primary")
+        return open_session()
+    READ_SESSIONS.inc(target=replica.name)
+    if DB_MODE == "sync":
+        return threadpool_session(replica.sessions())
+    return replica.sessions()
+
+
+async def get_read_db(request: Request):
+    """Session for read-only routes, which may lag the primary by up to REPLICA_MAX_LAG_SECONDS.
+
+    Clients that must see their own writes send ``X-Consistency: primary``.
+    """
+    if request.headers.get("x-consistency") == "primary":
+        db = open_session()
+    else:
+        db = open_read_session()
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+async def stream_rows(statement, batch_size: int, read_only: bool = False):
+    """Yield the rows of a query in lists of ``batch_size`` from a server-side cursor.
+
+    The session lives as long as the iteration, so this is safe to drive from
+    a streaming response after the request dependencies are gone. With
+    ``read_only`` the rows may come from a read replica.
+    """
+    statement = statement.execution_options(yield_per=batch_size)
+    init_engines()
+    replica = None
+    if read_only:
+        replica = read_replicas.choose()
+        READ_SESSIONS.inc(target=replica.name if replica else "primary")
+    if DB_MODE == "sync":
+        session = (replica.sessions if replica else SessionLocal)()
+        try:
+            result = await run_in_threadpool(session.execute, statement)
+            while True:
+                rows = await run_in_threadpool(result.fetchmany, batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            await run_in_threadpool(session.close)
+        return
+    async with (replica.sessions if replica else AsyncSessionLocal)() as session:
+        result = await session.stream(statement)
+        async for rows in result.partitions(batch_size):
+            yield rows
@@ -0,0 +1,37 @@
+import os
+from collections import OrderedDict
+
+DEDUPE_CACHE_SIZE = int(os.getenv("DEDUPE_CACHE_SIZE", "100000"))
+
+
+class recent_ids:
+    """Bounded set of recently accepted messageIds, oldest forgotten first.
+
+    It only short-circuits webhook retries reaching the same worker; the
+    ``ON CONFLICT DO NOTHING`` inserts remain the source of truth.
+    """
+
+    def __init__(self, max_size: int = DEDUPE_CACHE_SIZE):
+        self.max_size = max_size
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self._ids
+
+    def add(self, message_id: str) -> bool:
+        """Remember an id. Returns False if it was already known."""
+        if message_id in self._ids:
+            return False
+        self._ids[message_id] = None
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+        return True
+
+    def discard(self, message_id: str) -> None:
+        self._ids.pop(message_id, None)
+
+    def clear(self) -> None:
+        self._ids.clear()
+
+
+recent_messages = recent_ids()
@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from sqlalchemy import case, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.change_versions import bump_committed, message_scopes
+from app.contact_cache import known_contacts
+from app.database import open_session
+from app.dedupe import recent_messages
+from app.models import message, image_message, contact
+from app.partitions import ensure_partitions_for
+from app.rollup import record_rollup
+from app.timeline import record_timeline
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "sync")
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", "0.2"))
+
+
+def parse_webhook_payload(data: dict) -> dict:
+    """Validate an Evolution webhook body and normalize it into an event dict."""
+    if not isinstance(data, dict):
+        raise ValueError("Payload must be a JSON object")
+    data_block = data.get("data") or {}
+    key = data_block.get("key") or {}
+    instance_id = data_block.get("instanceId")
+    message_id = key.get("id")
+    whatsapp_id = key.get("remoteJid")
+    if not instance_id or not message_id or not whatsapp_id:
+        raise ValueError("Missing instanceId, key.id or key.remoteJid")
+    # The timestamp is part of the message key: a retry stamped with the
+    # arrival time would be stored again instead of hitting ON CONFLICT.
+    timestamp_unix = data_block.get("messageTimestamp")
+    if not timestamp_unix:
+        raise ValueError("Missing messageTimestamp")
+
+    from_me = bool(key.get("fromMe", False))
+    message_data = data_block.get("message") or {}
+    datetime_obj = datetime.fromtimestamp(int(timestamp_unix))
+
+    event = {
+        "kind": None,
+        "instance_id": instance_id,
+        "message_id": message_id,
+        "whatsapp_id": whatsapp_id,
+        "from_me": from_me,
+        "message_type": "Outgoing" if from_me else "Incoming",
+        "pushname": data_block.get("pushName"),
+        "datetime_obj": datetime_obj,
+    }
+    if "conversation" in message_data:
+        event["kind"] = "text"
+        event["content"] = message_data.get("conversation", "")
+    elif "imageMessage" in message_data:
+        event["kind"] = "image"
+        event["img_data"] = message_data.get("imageMessage") or {}
+    return event
+
+
+def message_payload(event: dict) -> dict:
+    """Build the websocket payload for a stored event."""
+    payload = {
+        "instanceId": event["instance_id"],
+        "messageId": event["message_id"],
+        "WhatsappjId": event["whatsapp_id"],
+        "Message_Type": event["message_type"],
+        "contact": event["pushname"],
+        "datetime": event["datetime_obj"].isoformat(),
+    }
+    if event["kind"] == "text":
+        payload["Message_Content"] = event["content"]
+    else:
+        payload["Image_URL"] = event["img_data"].get("url")
+    return payload
+
+
+def _text_row(event: dict) -> dict:
+    return {
+        "messageId": event["message_id"],
+        "datetime": event["datetime_obj"],
+        "WhatsappjId": event["whatsapp_id"],
+        "Message_Type": event["message_type"],
+        "Message_Content": event["content"],
+        "instanceId": event["instance_id"],
+    }
+
+
+def _image_row(event: dict) -> dict:
+    img_data = event["img_data"]
+    return {
+        "id": event["message_id"],
+        "messageId": event["message_id"],
+        "WhatsappjId": event["whatsapp_id"],
+        "instanceId": event["instance_id"],
+        "datetime": event["datetime_obj"],
+        "url": img_data.get("url"),
+        "mimetype": img_data.get("mimetype"),
+        "caption": img_data.get("caption"),
+        "fileSha256": img_data.get("fileSha256"),
+        "fileLength": img_data.get("fileLength"),
+        "height": img_data.get("height"),
+        "width": img_data.get("width"),
+        "mediaKey": img_data.get("mediaKey"),
+        "fileEncSha256": img_data.get("fileEncSha256"),
+        "Message_Type": event["message_type"],
+    }
+
+
+def _contact_rows(events: List[dict]) -> List[dict]:
+    """Collapse the batch to one contact row per WhatsappjId.
+
+    The first event supplies the contactId, the latest pushname sent by the
+    contact (never by us) wins.
+    """
+    rows = {}
+    for event in events:
+        pushname = event["pushname"] if not event["from_me"] else None
+        row = rows.get(event["whatsapp_id"])
+        if row is None:
+            rows[event["whatsapp_id"]] = {
+                "contactId": event["message_id"],
+                "WhatsappjId": event["whatsapp_id"],
+                "pushname": pushname,
+                "instanceId": event["instance_id"],
+            }
+        elif pushname is not None:
+            row["pushname"] = pushname
+    return list(rows.values())
+
+
+async def upsert_contacts(db, events: List[dict]) -> List[Tuple[str, str, Optional[str]]]:
+    """Create or update the contacts of a batch with at most one statement.
+
+    Contacts already cached whose pushname did not change (or that only
+    appear in messages sent by us) are skipped entirely. The rest go through
+    a single INSERT ... ON CONFLICT DO UPDATE; a message sent by us never
+    overwrites the pushname of an existing contact. Returns the resulting
+    (WhatsappjId, contactId, pushname) rows, to be cached once committed.
+    """
+    rows = []
+    for row in _contact_rows(events):
+        cached = known_contacts.get(row["WhatsappjId"])
+        if cached is None or (row["pushname"] is not None and row["pushname"] != cached[1]):
+            rows.append(row)
+    if not rows:
+        return []
+
+    # Sorted so concurrent batches lock contact rows in the same order.
+    rows.sort(key=lambda row: row["WhatsappjId"])
+    stmt = pg_insert(contact).values(rows)
+    pushname_changed = stmt.excluded.pushname.isnot(None)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[contact.WhatsappjId],
+        set_={
+            "pushname": func.coalesce(stmt.excluded.pushname, contact.pushname),
+            "updatedAt": case((pushname_changed, func.now()), else_=contact.updatedAt),
+        },
+    ).returning(contact.WhatsappjId, contact.contactId, contact.pushname)
+    return [tuple(row) for row in (await db.execute(stmt)).all()]
+
+
+async def write_batch(db, events: List[dict]) -> Tuple[List[dict], List[tuple]]:
+    """Insert a batch of events with one statement per table.
+
+    Messages already stored (webhook retries) are skipped instead of failing
+    the whole batch. Returns the events whose message was actually inserted
+    and the contact rows to cache after commit. The caller bumps the change
+    versions once committed (``bump_committed``).
+    """
+    unique = {}
+    for event in events:
+        unique.setdefault(event["message_id"], event)
+    events = list(unique.values())
+
+    await ensure_partitions_for(e["datetime_obj"] for e in events if e["kind"] is not None)
+    text_rows = [_text_row(e) for e in events if e["kind"] == "text"]
+    image_rows = [_image_row(e) for e in events if e["kind"] == "image"]
+
+    inserted = set()
+    if text_rows:
+        result = await db.execute(
+            pg_insert(message)
+            .values(text_rows)
+            .on_conflict_do_nothing(index_elements=[message.messageId, message.datetime])
+            .returning(message.messageId)
+        )
+        inserted.update(result.scalars().all())
+    if image_rows:
+        result = await db.execute(
+            pg_insert(image_message)
+            .values(image_rows)
+            .on_conflict_do_nothing(index_elements=[image_message.id, image_message.datetime])
+            .returning(image_message.id)
+        )
+        inserted.update(result.scalars().all())
+    contacts = await upsert_contacts(db, events)
+
+    stored = [e for e in events if e["message_id"] in inserted]
+    await record_timeline(db, stored)
+    await record_rollup(db, stored)
+    return stored, contacts
+
+
+class batch_writer:
+    """Bounded in-process queue drained by a background task in micro-batches."""
+
+    def __init__(
+        self,
+        on_commit: Optional[Callable[[List[dict]], Awaitable[None]]] = None,
+        max_size: int = INGEST_QUEUE_SIZE,
+        batch_size: int = INGEST_BATCH_SIZE,
+        flush_interval: float = INGEST_FLUSH_INTERVAL,
+    ):
+        self.on_commit = on_commit
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Flush whatever is still queued and stop the writer task."""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    def submit(self, event: dict) -> bool:
+        """Queue an event without waiting. Returns False when the queue is full."""
+        if self._queue is None:
+            raise RuntimeError("batch_writer is not running")
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            event = await self._queue.get()
+            if event is None:
+                break
+            batch = [event]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                batch.append(event)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[dict]) -> None:
+        try:
+            committed = await self._write(batch)
+        except Exception:
+            logger.exception("Batch of %d events failed, retrying one by one", len(batch))
+            committed = []
+            for event in batch:
+                try:
+                    committed.extend(await self._write([event]))
+                except Exception:
+                    logger.exception("Dropping webhook event %s", event["message_id"])
+                    # Let a retry of the dropped event through again.
+                    recent_messages.discard(event["message_id"])
+        if committed and self.on_commit is not None:
+            try:
+                await self.on_commit(committed)
+            except Exception:
+                logger.exception("on_commit callback failed")
+
+    @staticmethod
+    async def _write(events: List[dict]) -> List[dict]:
+        db = open_session()
+        try:
+            stored, contacts = await write_batch(db, events)
+            await db.commit()
+            known_contacts.put_many(contacts)
+            await bump_committed(db, message_scopes(events, stored, contacts))
+            return stored
+        except Exception:
+            await db.rollback()
+            raise
+        finally:
+            await db.close()
@@ -1,16 +1,35 @@
+import time
+
+_import_started = time.perf_counter()
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.database import Base, engine
+from app.database import dispose_engines, init_engines, read_replicas
+from app.ingestion import WEBHOOK_MODE
+from app.media import media_cache
+from app.metrics import metrics_middleware
+from app.partitions import maintain_partitions
 from app.routes import (
     inbox_route,
     conversation_route,
     message_route,
     contact_route,
     dashboard_route,
+    export_route,
+    media_route,
+    metrics_route,
 )
+from app.routes.message_router import broadcaster, ingestion_queue
 
-Base.metadata.create_all(bind=engine)
+# uvicorn configures this logger, so the timing shows up next to its own startup lines.
+logger = logging.getLogger("uvicorn.error")
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
 
 tags_metadata = [
     {
@@ -33,9 +52,60 @@ tags_metadata = [
         "name": "Dashboard",
         "description": "Endpoints de dashboard.",
     },
+    {
+        "name": "Export",
+        "description": "Exportação em NDJSON de contatos e mensagens.",
+    },
+    {
+        "name": "Media",
+        "description": "Imagens baixadas e armazenadas localmente.",
+    },
+    {
+        "name": "Metrics",
+        "description": "Métricas no formato Prometheus.",
+    },
 ]
 
-app = FastAPI(openapi_tags=tags_metadata)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start and stop the background services, logging how long each step takes.
+
+    Nothing here waits on the database: engines connect lazily and the schema
+    is managed by ``python -m app.migrate``.
+    """
+    timings = {"imports": IMPORT_SECONDS}
+    started = time.perf_counter()
+
+    def step(name: str, since: float) -> float:
+        now = time.perf_counter()
+        timings[name] = now - since
+        return now
+
+    mark = started
+    init_engines()
+    mark = step("engines", mark)
+    partition_task = asyncio.create_task(maintain_partitions())
+    replica_task = asyncio.create_task(read_replicas.monitor())
+    await broadcaster.start()
+    mark = step("broadcaster", mark)
+    media_cache.start()
+    if WEBHOOK_MODE == "queue":
+        ingestion_queue.start()
+    mark = step("workers", mark)
+    timings["total"] = IMPORT_SECONDS + (mark - started)
+    logger.info("Startup timing: %s", ", ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in timings.items()))
+
+    yield
+
+    await ingestion_queue.stop()
+    await broadcaster.stop()
+    await media_cache.stop()
+    partition_task.cancel()
+    replica_task.cancel()
+    await dispose_engines()
+
+
+app = FastAPI(openapi_tags=tags_metadata, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -44,12 +114,18 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Added last so it wraps everything, CORS included.
+app.add_middleware(metrics_middleware)
 
 app.include_router(inbox_route)
 app.include_router(conversation_route)
 app.include_router(message_route)
 app.include_router(contact_route)
 app.include_router(dashboard_route)
+app.include_router(export_route)
+app.include_router(media_route)
+app.include_router(metrics_route)
+
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,278 @@
+"""Local, content-addressed cache of WhatsApp image media.
+
+Committed image messages are queued to a small pool of background workers
+that download the encrypted file once, verify and decrypt it with the
+message's ``mediaKey``, and store it under its ``fileSha256``: the same
+image forwarded to many chats is stored once, and a JPEG thumbnail is made
+with Pillow. Only https URLs on WhatsApp media hosts are fetched.
+"""
+import asyncio
+import base64
+import binascii
+import hashlib
+import hmac
+import importlib.util
+import io
+import ipaddress
+import logging
+import os
+import socket
+import tempfile
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from typing import Optional, Set
+
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+MEDIA_ROOT = Path(os.getenv("MEDIA_ROOT", "media"))
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "2"))
+MEDIA_QUEUE_SIZE = int(os.getenv("MEDIA_QUEUE_SIZE", "1000"))
+# History images only fill this much of the queue, leaving the rest to live messages.
+MEDIA_HISTORY_QUEUE_SIZE = int(os.getenv("MEDIA_HISTORY_QUEUE_SIZE", "500"))
+MEDIA_DOWNLOAD_TIMEOUT = float(os.getenv("MEDIA_DOWNLOAD_TIMEOUT", "30"))
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(32 * 1024 * 1024)))
+MEDIA_THUMBNAIL_SIZE = int(os.getenv("MEDIA_THUMBNAIL_SIZE", "320"))
+# Media is only fetched over https from these domains and their subdomains.
+MEDIA_ALLOWED_HOSTS = tuple(
+    host.strip().lower() for host in os.getenv("MEDIA_ALLOWED_HOSTS", "whatsapp.net").split(",") if host.strip()
+)
+
+# HKDF "info" for image media; other media kinds use their own label.
+IMAGE_KEY_INFO = b"WhatsApp Image Keys"
+MAC_LENGTH = 10
+
+
+class media_error(Exception):
+    """The media could not be fetched, verified or decrypted."""
+
+
+def sha_key(file_sha256: Optional[str]) -> Optional[str]:
+    """Hex cache key of a base64 ``fileSha256``, or None if it is not valid."""
+    if not file_sha256:
+        return None
+    try:
+        digest = base64.b64decode(file_sha256, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return digest.hex() if len(digest) == 32 else None
+
+
+def media_path(key: str) -> Path:
+    return MEDIA_ROOT / key[:2] / key
+
+
+def thumbnail_path(key: str) -> Path:
+    return MEDIA_ROOT / "thumbnails" / key[:2] / f"{key}.jpg"
+
+
+def sniff_mimetype(head: bytes) -> str:
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "application/octet-stream"
+
+
+def _hkdf(key: bytes, length: int, info: bytes) -> bytes:
+    """HKDF-SHA256 with an all-zero salt, as used by WhatsApp media keys."""
+    prk = hmac.new(b"\0" * 32, key, hashlib.sha256).digest()
+    output, block = b"", b""
+    counter = 1
+    while len(output) < length:
+        block = hmac.new(prk, block + info + bytes([counter]), hashlib.sha256).digest()
+        output += block
+        counter += 1
+    return output[:length]
+
+
+def decrypt_media(encrypted: bytes, media_key: str, file_enc_sha256: Optional[str] = None,
+                  file_sha256: Optional[str] = None, info: bytes = IMAGE_KEY_INFO) -> bytes:
+    """Verify and decrypt a downloaded WhatsApp media file."""
+    if file_enc_sha256 and hashlib.sha256(encrypted).digest() != base64.b64decode(file_enc_sha256):
+        raise media_error("fileEncSha256 mismatch")
+    expanded = _hkdf(base64.b64decode(media_key), 112, info)
+    iv, cipher_key, mac_key = expanded[:16], expanded[16:48], expanded[48:80]
+    ciphertext, mac = encrypted[:-MAC_LENGTH], encrypted[-MAC_LENGTH:]
+    expected = hmac.new(mac_key, iv + ciphertext, hashlib.sha256).digest()[:MAC_LENGTH]
+    if not hmac.compare_digest(mac, expected):
+        raise media_error("Media MAC mismatch")
+    decryptor = Cipher(algorithms.AES(cipher_key), modes.CBC(iv)).decryptor()
+    padded = decryptor.update(ciphertext) + decryptor.finalize()
+    unpadder = padding.PKCS7(128).unpadder()
+    try:
+        plaintext = unpadder.update(padded) + unpadder.finalize()
+    except ValueError:
+        raise media_error("Invalid media padding")
+    if file_sha256 and hashlib.sha256(plaintext).digest() != base64.b64decode(file_sha256):
+        raise media_error("fileSha256 mismatch")
+    return plaintext
+
+
+def _check_url(url: str) -> None:
+    """Refuse anything but https to an allowed host that resolves to public addresses."""
+    parts = urllib.parse.urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if parts.scheme != "https":
+        raise media_error("Media URL must use https")
+    if not any(host == allowed or host.endswith("." + allowed) for allowed in MEDIA_ALLOWED_HOSTS):
+        raise media_error(f"Media host {host!r} is not allowed")
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parts.port or 443, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError) as e:
+        raise media_error(f"Cannot resolve media host {host!r}") from e
+    for address in addresses:
+        if not ipaddress.ip_address(address.split("%", 1)[0]).is_global:
+            raise media_error(f"Media host {host!r} resolves to a private address")
+
+
+class _checked_redirects(urllib.request.HTTPRedirectHandler):
+    """Apply the media URL rules to every redirect too."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        _check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+_opener = urllib.request.build_opener(_checked_redirects)
+
+
+def _download(url: str) -> bytes:
+    _check_url(url)
+    request = urllib.request.Request(url, headers={"User-Agent": "nestor-media"})
+    with _opener.open(request, timeout=MEDIA_DOWNLOAD_TIMEOUT) as response:
+        body = response.read(MEDIA_MAX_BYTES + 1)
+    if len(body) > MEDIA_MAX_BYTES:
+        raise media_error("Media exceeds MEDIA_MAX_BYTES")
+    return body
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def thumbnails_enabled() -> bool:
+    return importlib.util.find_spec("PIL") is not None
+
+
+def _make_thumbnail(key: str, data: bytes) -> None:
+    # Imported here: Pillow is slow to import at worker boot.
+    try:
+        from PIL import Image
+    except ImportError:
+        return
+    with Image.open(io.BytesIO(data)) as image:
+        image.thumbnail((MEDIA_THUMBNAIL_SIZE, MEDIA_THUMBNAIL_SIZE))
+        out = io.BytesIO()
+        image.convert("RGB").save(out, "JPEG", quality=80)
+    _write_atomic(thumbnail_path(key), out.getvalue())
+
+
+def fetch_and_store(img_data: dict) -> str:
+    """Download, decrypt and store one image (blocking). Returns its key."""
+    key = sha_key(img_data.get("fileSha256"))
+    if key is None:
+        raise media_error("Missing or invalid fileSha256")
+    path = media_path(key)
+    if path.exists():
+        return key
+    encrypted = _download(img_data["url"])
+    data = decrypt_media(
+        encrypted,
+        img_data["mediaKey"],
+        img_data.get("fileEncSha256"),
+        img_data.get("fileSha256"),
+    )
+    _write_atomic(path, data)
+    try:
+        _make_thumbnail(key, data)
+    except Exception:
+        logger.warning("Could not make a thumbnail for %s", key, exc_info=True)
+    return key
+
+
+class media_pipeline:
+    """Bounded queue of images to cache, drained by background workers."""
+
+    def __init__(
+        self,
+        workers: int = MEDIA_WORKERS,
+        max_size: int = MEDIA_QUEUE_SIZE,
+        history_size: int = MEDIA_HISTORY_QUEUE_SIZE,
+    ):
+        self.workers = workers
+        self.max_size = max_size
+        self.history_size = min(history_size, max_size)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+        self._pending: Set[str] = set()
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if not thumbnails_enabled():
+            logger.warning("Pillow is not installed: media thumbnails are disabled")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def submit(self, img_data: dict, history: bool = False) -> bool:
+        """Queue an image unless it is cached, already queued or cannot be fetched.
+
+        ``history`` images are skipped without a warning once ``history_size``
+        downloads are pending, so a large history sync cannot crowd out live media.
+        """
+        key = sha_key(img_data.get("fileSha256"))
+        if (
+            self._queue is None
+            or key is None
+            or not img_data.get("url")
+            or not img_data.get("mediaKey")
+            or key in self._pending
+            or media_path(key).exists()
+        ):
+            return False
+        if history and self._queue.qsize() >= self.history_size:
+            return False
+        try:
+            self._queue.put_nowait((key, img_data))
+        except asyncio.QueueFull:
+            logger.warning("Media queue full, not caching %s", key)
+            return False
+        self._pending.add(key)
+        return True
+
+    async def _worker(self) -> None:
+        while True:
+            key, img_data = await self._queue.get()
+            try:
+                await run_in_threadpool(fetch_and_store, img_data)
+            except Exception as e:
+                logger.warning("Could not cache media %s: %s", key, e)
+            finally:
+                self._pending.discard(key)
+
+
+media_cache = media_pipeline()
@@ -0,0 +1,372 @@
+"""Prometheus metrics for requests, SQL statements, connection pools and websockets.
+
+Metrics live in process memory and are rendered in the Prometheus text
+format by ``GET /metrics``; with several workers each one reports its own
+numbers. Statements are counted through SQLAlchemy engine events and tied
+to the HTTP request that issued them with a context variable set by
+``metrics_middleware``, which also logs requests slower than
+``SLOW_REQUEST_SECONDS`` with their SQL breakdown.
+"""
+import bisect
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+logger = logging.getLogger(__name__)
+
+# Requests taking at least this long are logged with their SQL; 0 disables.
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "1"))
+SLOW_REQUEST_STATEMENTS = int(os.getenv("SLOW_REQUEST_STATEMENTS", "5"))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 1000)
+WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+FANOUT_BUCKETS = (0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+
+# Distinct statements remembered per request for the slow-request breakdown.
+MAX_TRACKED_STATEMENTS = 50
+
+_registry: List["_metric"] = []
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in tuple(zip(names, values)) + extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labels, key)} {_number(value)}" for key, value in items]
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ] + self._samples()
+
+
+class counter(_metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class gauge(_metric):
+    """A value that goes up and down, optionally read from a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def _samples(self) -> List[str]:
+        if self._function is not None:
+            return [f"{self.name} {_number(self._function())}"]
+        return super()._samples()
+
+
+class histogram(_metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # One slot per bucket, one for +Inf, then the sum.
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, (('le', _number(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_number(state[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+REQUESTS = counter("nestor_http_requests_total", "HTTP requests by route and status.", ("method", "route", "status"))
+REQUEST_SECONDS = histogram(
+    "nestor_http_request_duration_seconds", "HTTP request latency.", ("method", "route")
+)
+REQUEST_STATEMENTS = histogram(
+    "nestor_http_request_statements", "SQL statements issued per HTTP request.", ("method", "route"), COUNT_BUCKETS
+)
+REQUEST_DB_SECONDS = histogram(
+    "nestor_http_request_db_seconds", "Time spent executing SQL per HTTP request.", ("method", "route")
+)
+REQUEST_POOL_WAIT = histogram(
+    "nestor_http_request_pool_wait_seconds",
+    "Time spent waiting for pooled connections per HTTP request.",
+    ("method", "route"),
+    WAIT_BUCKETS,
+)
+STATEMENT_SECONDS = histogram(
+    "nestor_db_statement_duration_seconds", "SQL statement execution time, requests and background work.", ("engine",)
+)
+POOL_WAIT = histogram(
+    "nestor_db_pool_checkout_seconds", "Time to check a connection out of the pool.", ("engine",), WAIT_BUCKETS
+)
+POOL_TIMEOUTS = counter("nestor_db_pool_timeouts_total", "Pool checkouts that gave up waiting.", ("engine",))
+POOL_CONNECTIONS = gauge(
+    "nestor_db_pool_connections", "Pooled connections by state (checked_out, idle, overflow).", ("engine", "state")
+)
+WEBSOCKET_CONNECTIONS = gauge("nestor_websocket_connections", "Open websocket connections.")
+BROADCAST_FANOUT_SECONDS = histogram(
+    "nestor_broadcast_fanout_seconds", "Time to queue one event for every interested websocket.", (), FANOUT_BUCKETS
+)
+BROADCAST_DELIVERIES = counter("nestor_broadcast_deliveries_total", "Events queued to websocket clients.")
+READ_SESSIONS = counter(
+    "nestor_db_read_sessions_total", "Read-only sessions opened, by target (primary or replica name).", ("target",)
+)
+REPLICA_HEALTHY = gauge("nestor_db_replica_healthy", "1 when the replica answered its last health check.", ("replica",))
+REPLICA_LAG = gauge("nestor_db_replica_lag_seconds", "Replication lag seen by the last health check.", ("replica",))
+WEBHOOK_IN_FLIGHT = gauge("nestor_webhook_in_flight", "Webhook requests holding an admission slot.")
+WEBHOOK_WAITING = gauge("nestor_webhook_waiting", "Webhook requests waiting for an admission slot.")
+ADMISSIONS = counter(
+    "nestor_webhook_admissions_total",
+    "Webhook admission decisions (admitted, waited, rejected) by priority.",
+    ("priority", "outcome"),
+)
+REJECTIONS = counter(
+    "nestor_webhook_rejections_total",
+    "Webhook requests shed with 503, by priority and the limit that was hit.",
+    ("priority", "reason"),
+)
+ADMISSION_WAIT = histogram(
+    "nestor_webhook_admission_wait_seconds", "Time webhook requests waited for a slot.", ("priority",), WAIT_BUCKETS
+)
+
+
+class request_stats:
+    """SQL work done on behalf of one HTTP request."""
+
+    __slots__ = ("statements", "db_seconds", "pool_wait", "by_statement")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.pool_wait = 0.0
+        self.by_statement: Dict[str, List] = {}
+
+    def record(self, statement: str, seconds: float) -> None:
+        self.statements += 1
+        self.db_seconds += seconds
+        entry = self.by_statement.get(statement)
+        if entry is None:
+            if len(self.by_statement) >= MAX_TRACKED_STATEMENTS:
+                return
+            entry = self.by_statement[statement] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+
+    def breakdown(self, top: int) -> List[str]:
+        """The statements that took the most time, with how often each ran."""
+        heaviest = sorted(self.by_statement.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        return [
+            f"{count}x {seconds * 1000:.1f}ms {_WHITESPACE.sub(' ', statement)[:300]}"
+            for statement, (count, seconds) in heaviest
+        ]
+
+
+# Holds the stats of the HTTP request being served, if any. The object is
+# mutated in place so work done in threadpool copies of the context counts.
+_current: contextvars.ContextVar[Optional[request_stats]] = contextvars.ContextVar("request_stats", default=None)
+
+_engines: Dict[str, object] = {}
+
+
+def instrument_engine(engine, name: str) -> None:
+    """Time every statement of ``engine`` and report its pool on /metrics."""
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["statement_started"].pop()
+        STATEMENT_SECONDS.observe(seconds, engine=name)
+        stats = _current.get()
+        if stats is not None:
+            stats.record(statement, seconds)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _failed(context):
+        started = context.connection.info.get("statement_started") if context.connection is not None else None
+        if started:
+            started.pop()
+
+    _engines[name] = sync_engine
+
+
+class _timed_pool:
+    """Records how long each checkout waited, including opening new connections."""
+
+    engine_name = ""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            POOL_TIMEOUTS.inc(engine=self.engine_name)
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            POOL_WAIT.observe(waited, engine=self.engine_name)
+            stats = _current.get()
+            if stats is not None:
+                stats.pool_wait += waited
+
+
+class timed_queue_pool(_timed_pool, QueuePool):
+    engine_name = "sync"
+
+
+class timed_async_pool(_timed_pool, AsyncAdaptedQueuePool):
+    engine_name = "async"
+
+
+def timed_pool_class(name: str, asynchronous: bool = False):
+    """A timed pool class reporting its checkouts under ``engine=name``."""
+    base = timed_async_pool if asynchronous else timed_queue_pool
+    return type(base.__name__, (base,), {"engine_name": name})
+
+
+def _update_pool_gauges() -> None:
+    for name, engine in _engines.items():
+        pool = engine.pool
+        if not isinstance(pool, QueuePool):
+            continue
+        POOL_CONNECTIONS.set(pool.checkedout(), engine=name, state="checked_out")
+        POOL_CONNECTIONS.set(pool.checkedin(), engine=name, state="idle")
+        POOL_CONNECTIONS.set(max(pool.overflow(), 0), engine=name, state="overflow")
+
+
+def render_metrics() -> str:
+    _update_pool_gauges()
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _observe_request(scope, status_code: int, seconds: float, stats: request_stats) -> None:
+    # The route template, not the raw path, keeps the label set bounded.
+    route = getattr(scope.get("route"), "path", None) or "unmatched"
+    method = scope["method"]
+    REQUESTS.inc(method=method, route=route, status=status_code)
+    REQUEST_SECONDS.observe(seconds, method=method, route=route)
+    REQUEST_STATEMENTS.observe(stats.statements, method=method, route=route)
+    REQUEST_DB_SECONDS.observe(stats.db_seconds, method=method, route=route)
+    REQUEST_POOL_WAIT.observe(stats.pool_wait, method=method, route=route)
+    if SLOW_REQUEST_SECONDS and seconds >= SLOW_REQUEST_SECONDS:
+        logger.warning(
+            "Slow request %s %s %s %.1fms: %d statements, db %.1fms, pool wait %.1fms%s",
+            method,
+            scope["path"],
+            status_code,
+            seconds * 1000,
+            stats.statements,
+            stats.db_seconds * 1000,
+            stats.pool_wait * 1000,
+            "".join("\n  " + line for line in stats.breakdown(SLOW_REQUEST_STATEMENTS)),
+        )
+
+
+class metrics_middleware:
+    """ASGI middleware timing each HTTP request and collecting the SQL it ran.
+
+    Websocket connections pass through untouched; they are counted by the
+    connection manager instead.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = request_stats()
+        token = _current.set(stats)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - started
+            _current.reset(token)
+            _observe_request(scope, status_code, seconds, stats)
@@ -0,0 +1,352 @@
+"""Versioned schema migrations.
+
+The app never creates or alters tables on startup; deployments run::
+
+    python -m app.migrate                 # apply pending migrations
+    python -m app.migrate --check-schema  # exit 1 if the database is behind the models
+    python -m app.migrate --list          # show applied and pending migrations
+
+Applied versions are recorded in ``schema_migrations``. Every migration is
+written to be safe on both new databases and databases created by older
+versions of the app, which had their tables made by ``create_all``. Each
+step uses its own frozen table definitions; a model change ships as a new
+step, and ``--check-schema`` reports models that no step creates.
+"""
+import argparse
+import logging
+import os
+import sys
+from typing import Callable, List, Tuple
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    func,
+    inspect,
+    text,
+)
+
+from app import partitions, timeline
+from app.database import Base, get_engine
+
+logger = logging.getLogger(__name__)
+
+# Session-level advisory lock so two deploys never migrate at the same time.
+MIGRATION_LOCK_KEY = 0x6E6D6967
+
+# Opt-in for steps that copy a whole table under an exclusive lock (today only
+# partitioning message tables that already hold rows): plan downtime for it.
+MIGRATE_ALLOW_TABLE_REWRITE = os.getenv("MIGRATE_ALLOW_TABLE_REWRITE", "") == "1"
+
+
+# Frozen table definitions, as each migration first created them. Migrations
+# must not use the live models: a model change would silently change what an
+# old step does on a new database. Later changes are new steps.
+
+_v1 = MetaData()
+
+Table(
+    "inbox", _v1,
+    Column("inbox_id", String, primary_key=True, index=True),
+    Column("instance_id", String, index=True),
+    Column("url_evo", String, nullable=False),
+    Column("api_key", String, nullable=False),
+    Column("whatsappjID", String, nullable=False),
+    Column("inbox_name", String, nullable=False),
+)
+Table(
+    "message", _v1,
+    Column("messageId", String, primary_key=True, index=True),
+    Column("datetime", DateTime, nullable=False),
+    Column("WhatsappjId", String, index=True, nullable=False),
+    Column("Message_Type", String, nullable=False),
+    Column("Message_Content", String, nullable=True),
+    Column("instanceId", String, nullable=False),
+)
+Table(
+    "image_message", _v1,
+    Column("id", String, primary_key=True, index=True),
+    Column("messageId", String, index=True),
+    Column("WhatsappjId", String, index=True),
+    Column("instanceId", String, index=True),
+    Column("datetime", DateTime, nullable=False),
+    Column("url", String, nullable=False),
+    Column("mimetype", String),
+    Column("caption", String),
+    Column("fileSha256", String),
+    Column("fileLength", String),
+    Column("height", Integer),
+    Column("width", Integer),
+    Column("mediaKey", String),
+    Column("fileEncSha256", String),
+    Column("Message_Type", String, nullable=False),
+)
+Table(
+    "contact", _v1,
+    Column("contactId", String, primary_key=True, index=True),
+    Column("WhatsappjId", String, unique=True, index=True, nullable=False),
+    Column("pushname", String, nullable=True),
+    Column("instanceId", String, nullable=False),
+    Column("createdAt", DateTime(timezone=True), server_default=func.now()),
+    Column("updatedAt", DateTime(timezone=True)),
+)
+
+_v2 = MetaData()
+
+_message_v2 = Table(
+    "message", _v2,
+    Column("messageId", String, primary_key=True, index=True),
+    Column("datetime", DateTime, primary_key=True, nullable=False),
+    Column("WhatsappjId", String, index=True, nullable=False),
+    Column("Message_Type", String, nullable=False),
+    Column("Message_Content", String, nullable=True),
+    Column("instanceId", String, nullable=False),
+    Index("ix_message_instance_contact_datetime", "instanceId", "WhatsappjId", "datetime", "messageId"),
+    Index("ix_message_instance_datetime", "instanceId", "datetime", postgresql_include=["Message_Type", "WhatsappjId"]),
+    Index("ix_message_datetime", "datetime", postgresql_include=["Message_Type", "WhatsappjId"]),
+    postgresql_partition_by="RANGE (datetime)",
+)
+_image_message_v2 = Table(
+    "image_message", _v2,
+    Column("id", String, primary_key=True, index=True),
+    Column("messageId", String, index=True),
+    Column("WhatsappjId", String, index=True),
+    Column("instanceId", String, index=True),
+    Column("datetime", DateTime, primary_key=True, nullable=False),
+    Column("url", String, nullable=False),
+    Column("mimetype", String),
+    Column("caption", String),
+    Column("fileSha256", String),
+    Column("fileLength", String),
+    Column("height", Integer),
+    Column("width", Integer),
+    Column("mediaKey", String),
+    Column("fileEncSha256", String),
+    Column("Message_Type", String, nullable=False),
+    Index("ix_image_message_instance_contact_datetime", "instanceId", "WhatsappjId", "datetime", "messageId"),
+    postgresql_partition_by="RANGE (datetime)",
+)
+
+_SEARCH_INDEXES_V3 = [
+    f'CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} USING gin '
+    f'("instanceId", to_tsvector(\'simple\', coalesce("{column}", \'\')))'
+    for table, column in (("message", "Message_Content"), ("image_message", "caption"))
+] + [
+    f'CREATE INDEX IF NOT EXISTS ix_{table}_trgm ON {table} USING gin ("instanceId", "{column}" gin_trgm_ops)'
+    for table, column in (("message", "Message_Content"), ("image_message", "caption"))
+]
+
+_timeline_v4 = Table(
+    "timeline", MetaData(),
+    Column("instanceId", String, primary_key=True),
+    Column("WhatsappjId", String, primary_key=True),
+    Column("datetime", DateTime, primary_key=True),
+    Column("messageId", String, primary_key=True),
+    Column("kind", String, nullable=False),
+    Column("Message_Type", String, nullable=False),
+    Index("ix_timeline_instance_datetime", "instanceId", "datetime", postgresql_include=["Message_Type", "WhatsappjId"]),
+    Index("ix_timeline_datetime", "datetime", postgresql_include=["Message_Type", "WhatsappjId"]),
+    postgresql_partition_by="RANGE (datetime)",
+)
+
+_conversation_v5 = Table(
+    "conversation", MetaData(),
+    Column("instanceId", String, primary_key=True),
+    Column("WhatsappjId", String, primary_key=True),
+    Column("datetime", DateTime, nullable=False),
+    Column("messageId", String, nullable=False),
+    Column("kind", String, nullable=False),
+)
+Index(
+    "ix_conversation_instance_datetime",
+    _conversation_v5.c.instanceId,
+    _conversation_v5.c.datetime.desc(),
+    _conversation_v5.c.WhatsappjId.desc(),
+)
+
+_v6 = MetaData()
+
+Table(
+    "message_rollup", _v6,
+    Column("instanceId", String, primary_key=True),
+    Column("bucket", DateTime, primary_key=True),
+    Column("direction", String, primary_key=True),
+    Column("kind", String, primary_key=True),
+    Column("message_count", BigInteger, nullable=False),
+)
+Table(
+    "message_rollup_contact", _v6,
+    Column("instanceId", String, primary_key=True),
+    Column("bucket", DateTime, primary_key=True),
+    Column("direction", String, primary_key=True),
+    Column("kind", String, primary_key=True),
+    Column("WhatsappjId", String, primary_key=True),
+)
+
+_change_version_v7 = Table(
+    "change_version", MetaData(),
+    Column("scope", String, primary_key=True),
+    Column("version", BigInteger, nullable=False),
+)
+
+
+def _baseline() -> None:
+    _v1.create_all(bind=get_engine())
+
+
+def _partition_messages() -> None:
+    partitions.convert((_message_v2, _image_message_v2), allow_rewrite=MIGRATE_ALLOW_TABLE_REWRITE)
+
+
+def _search_indexes() -> None:
+    with get_engine().begin() as conn:
+        conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS btree_gin")
+        for statement in _SEARCH_INDEXES_V3:
+            conn.exec_driver_sql(statement)
+
+
+def _backfill_timeline() -> None:
+    _timeline_v4.create(get_engine(), checkfirst=True)
+    # The conversation list does not exist yet; migration 5 fills it.
+    timeline.backfill(conversations=False)
+
+
+def _conversation_list() -> None:
+    # Upserts only move rows forward, so ingest may run during the backfill.
+    _conversation_v5.create(get_engine(), checkfirst=True)
+    timeline.backfill_conversations()
+
+
+def _rollup_tables() -> None:
+    _v6.create_all(bind=get_engine())
+
+
+def _change_versions() -> None:
+    _change_version_v7.create(get_engine(), checkfirst=True)
+
+
+def _contact_instance_index() -> None:
+    with get_engine().begin() as conn:
+        conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS "ix_contact_instanceId" ON contact ("instanceId")')
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[], None]]] = [
+    (1, "create missing tables", _baseline),
+    (2, "partition message tables by month", _partition_messages),
+    (3, "full-text and trigram search indexes", _search_indexes),
+    (4, "backfill the conversation timeline", _backfill_timeline),
+    (5, "latest message per conversation", _conversation_list),
+    (6, "hourly message rollups", _rollup_tables),
+    (7, "change versions for ETags", _change_versions),
+    (8, "index contacts by instance", _contact_instance_index),
+]
+
+
+def _ensure_version_table(conn) -> None:
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version integer PRIMARY KEY, name text NOT NULL, "
+        "applied_at timestamptz NOT NULL DEFAULT now())"
+    ))
+
+
+def applied_versions() -> set:
+    engine = get_engine()
+    if not inspect(engine).has_table("schema_migrations"):
+        return set()
+    with engine.connect() as conn:
+        return set(conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+
+def upgrade() -> List[int]:
+    """Apply pending migrations in order. Returns the versions applied."""
+    engine = get_engine()
+    applied = []
+    with engine.connect() as lock_conn:
+        lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        lock_conn.commit()
+        try:
+            with engine.begin() as conn:
+                _ensure_version_table(conn)
+            done = applied_versions()
+            for version, name, migration in MIGRATIONS:
+                if version in done:
+                    continue
+                logger.info("Applying migration %d: %s", version, name)
+                migration()
+                with engine.begin() as conn:
+                    conn.execute(
+                        text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                        {"version": version, "name": name},
+                    )
+                applied.append(version)
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            lock_conn.commit()
+    partitions.ensure_ahead()
+    return applied
+
+
+def check_schema() -> List[str]:
+    """Differences between the database and the models, as readable lines."""
+    problems = []
+    done = applied_versions()
+    for version, name, _ in MIGRATIONS:
+        if version not in done:
+            problems.append(f"migration {version} ({name}) not applied")
+
+    engine = get_engine()
+    inspector = inspect(engine)
+    with engine.connect() as conn:
+        # Exact names from the catalog: to_regclass would fold unquoted mixed
+        # case. Partitioned tables list their parent indexes here too.
+        indexes = set(conn.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()"
+        )).scalars())
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                problems.append(f"table {table.name} is missing")
+                continue
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    problems.append(f"column {table.name}.{column.name} is missing")
+            for index in table.indexes:
+                if index.name not in indexes:
+                    problems.append(f"index {index.name} on {table.name} is missing")
+    return problems
+
+
+def main(argv=None) -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog="python -m app.migrate")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--check-schema", action="store_true", help="report drift and exit 1 if any")
+    mode.add_argument("--list", action="store_true", help="list migrations and whether they are applied")
+    args = parser.parse_args(argv)
+
+    if args.check_schema:
+        problems = check_schema()
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+        print("Schema is up to date")
+    elif args.list:
+        done = applied_versions()
+        for version, name, _ in MIGRATIONS:
+            print(f"{version:>4}  {'applied' if version in done else 'pending':<8} {name}")
+    else:
+        applied = upgrade()
+        print(f"Applied {len(applied)} migration(s)" if applied else "Nothing to apply")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,37 @@
-from sqlalchemy import Column, String, Integer, DateTime
+from sqlalchemy import DDL, Column, String, Integer, BigInteger, DateTime, Index, event, text
 from sqlalchemy.sql import func
 from .database import Base
 
+# Text search configuration baked into the search indexes. "simple" does no
+# stemming, so order numbers and codes are indexed verbatim.
+SEARCH_CONFIG = "simple"
+
+# pg_trgm backs substring search; btree_gin lets instanceId lead the GIN indexes.
+event.listen(
+    Base.metadata,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm; CREATE EXTENSION IF NOT EXISTS btree_gin"),
+)
+
+
+def _search_indexes(table: str, column: str):
+    """Full-text and trigram GIN indexes on a text column, scoped by instance."""
+    return (
+        Index(
+            f"ix_{table}_search",
+            "instanceId",
+            text(f"to_tsvector('{SEARCH_CONFIG}', coalesce(\"{column}\", ''))"),
+            postgresql_using="gin",
+        ),
+        Index(
+            f"ix_{table}_trgm",
+            "instanceId",
+            column,
+            postgresql_using="gin",
+            postgresql_ops={column: "gin_trgm_ops"},
+        ),
+    )
+
 class inbox(Base):
     __tablename__ = "inbox"
 
@@ -15,20 +45,34 @@ class inbox(Base):
 class message(Base):
     __tablename__ = "message"
 
+    # Partitioned by month on datetime, which therefore belongs to the key.
     messageId = Column(String, primary_key=True, index=True)
-    datetime = Column(DateTime, nullable=False)
+    datetime = Column(DateTime, primary_key=True, nullable=False)
     WhatsappjId = Column(String, index=True, nullable=False)
     Message_Type = Column(String, nullable=False)
     Message_Content = Column(String, nullable=True)
     instanceId = Column(String, nullable=False)
 
+    __table_args__ = (
+        Index("ix_message_instance_contact_datetime", "instanceId", "WhatsappjId", "datetime", "messageId"),
+        Index(
+            "ix_message_instance_datetime",
+            "instanceId",
+            "datetime",
+            postgresql_include=["Message_Type", "WhatsappjId"],
+        ),
+        Index("ix_message_datetime", "datetime", postgresql_include=["Message_Type", "WhatsappjId"]),
+        *_search_indexes("message", "Message_Content"),
+        {"postgresql_partition_by": "RANGE (datetime)"},
+    )
+
 class image_message(Base):
     __tablename__ = "image_message"
     id = Column(String, primary_key=True, index=True)
     messageId = Column(String, index=True)
     WhatsappjId = Column(String, index=True)
     instanceId = Column(String, index=True)
-    datetime = Column(DateTime, nullable=False)
+    datetime = Column(DateTime, primary_key=True, nullable=False)
     url = Column(String, nullable=False)
     mimetype = Column(String)
     caption = Column(String)
@@ -40,7 +84,58 @@ class image_message(Base):
     fileEncSha256 = Column(String)
     Message_Type = Column(String, nullable=False)
 
+    __table_args__ = (
+        Index("ix_image_message_instance_contact_datetime", "instanceId", "WhatsappjId", "datetime", "messageId"),
+        *_search_indexes("image_message", "caption"),
+        {"postgresql_partition_by": "RANGE (datetime)"},
+    )
+
+
+class timeline(Base):
+    """Every message of a conversation, whatever its kind, in one ordered index.
+
+    ``kind`` tells which detail table holds the rest of the message
+    ("text" -> message, "image" -> image_message), joined on
+    (messageId, datetime).
+    """
+    __tablename__ = "timeline"
+
+    instanceId = Column(String, primary_key=True)
+    WhatsappjId = Column(String, primary_key=True)
+    datetime = Column(DateTime, primary_key=True)
+    messageId = Column(String, primary_key=True)
+    kind = Column(String, nullable=False)
+    Message_Type = Column(String, nullable=False)
+
+    __table_args__ = (
+        Index(
+            "ix_timeline_instance_datetime",
+            "instanceId",
+            "datetime",
+            postgresql_include=["Message_Type", "WhatsappjId"],
+        ),
+        Index("ix_timeline_datetime", "datetime", postgresql_include=["Message_Type", "WhatsappjId"]),
+        {"postgresql_partition_by": "RANGE (datetime)"},
+    )
+
 
+class conversation(Base):
+    """Latest timeline row of each conversation, upserted with every timeline insert.
+
+    The conversation list pages through its index instead of looking for
+    every contact's latest message in the whole timeline.
+    """
+    __tablename__ = "conversation"
+
+    instanceId = Column(String, primary_key=True)
+    WhatsappjId = Column(String, primary_key=True)
+    datetime = Column(DateTime, nullable=False)
+    messageId = Column(String, nullable=False)
+    kind = Column(String, nullable=False)
+
+    __table_args__ = (
+        Index("ix_conversation_instance_datetime", instanceId, datetime.desc(), WhatsappjId.desc()),
+    )
 
 
 class contact(Base):
@@ -49,6 +144,35 @@ class contact(Base):
     contactId = Column(String, primary_key=True, index=True)
     WhatsappjId = Column(String, unique=True, index=True, nullable=False)
     pushname = Column(String, nullable=True)
-    instanceId = Column(String, nullable=False)
+    instanceId = Column(String, index=True, nullable=False)
     createdAt = Column(DateTime(timezone=True), server_default=func.now())
-    updatedAt = Column(DateTime(timezone=True), onupdate=func.now())
\ No newline at end of file
+    updatedAt = Column(DateTime(timezone=True), onupdate=func.now())
+
+class message_rollup(Base):
+    """Hourly message counts per instance, direction and message kind."""
+    __tablename__ = "message_rollup"
+
+    instanceId = Column(String, primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    direction = Column(String, primary_key=True)
+    kind = Column(String, primary_key=True)
+    message_count = Column(BigInteger, nullable=False, default=0)
+
+
+class message_rollup_contact(Base):
+    """Contacts seen in each hourly rollup bucket, used for distinct counts."""
+    __tablename__ = "message_rollup_contact"
+
+    instanceId = Column(String, primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    direction = Column(String, primary_key=True)
+    kind = Column(String, primary_key=True)
+    WhatsappjId = Column(String, primary_key=True)
+
+
+class change_version(Base):
+    """Version of a cached read scope (e.g. "contacts:<instanceId>"), bumped on every write to it."""
+    __tablename__ = "change_version"
+
+    scope = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False)
@@ -0,0 +1,20 @@
+import base64
+import json
+from datetime import datetime
+from typing import Tuple
+
+
+def encode_cursor(position: datetime, key: str) -> str:
+    """Encode a (datetime, tie-breaker) keyset position as an opaque token."""
+    raw = json.dumps([position.isoformat(), key], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> Tuple[datetime, str]:
+    """Decode a token produced by encode_cursor. Raises ValueError when malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        position, key = json.loads(raw)
+        return datetime.fromisoformat(position), str(key)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError("Invalid cursor") from e
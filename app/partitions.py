@@ -0,0 +1,188 @@
+"""Monthly range partitions of the message tables.
+
+``message``, ``image_message`` and ``timeline`` are partitioned by
+``datetime``, one partition per calendar month. The app creates partitions a
+few months ahead on startup and once a day, and on demand for any month a
+write touches (history syncs bring old months), so inserts never miss a
+partition.
+
+Usage::
+
+    python -m app.partitions ensure [--ahead N]
+    python -m app.partitions convert     # turn existing heap tables into partitioned ones (downtime)
+"""
+import argparse
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime
+from typing import Iterable, Set
+
+from sqlalchemy import Table, text
+from starlette.concurrency import run_in_threadpool
+
+from app.database import get_engine
+from app.models import image_message, message, timeline
+
+logger = logging.getLogger(__name__)
+
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+PARTITION_CHECK_INTERVAL = float(os.getenv("PARTITION_CHECK_INTERVAL", "86400"))
+# How long writes skip partition creation after finding a table that is not
+# partitioned (or missing, e.g. while migrations run) before checking again.
+PARTITION_RECHECK_INTERVAL = float(os.getenv("PARTITION_RECHECK_INTERVAL", "60"))
+
+PARTITIONED_TABLES = (message.__table__, image_message.__table__, timeline.__table__)
+
+# Months whose partitions are known to exist, so writes skip the DDL.
+_known_months: Set[date] = set()
+_lock = threading.Lock()
+_unpartitioned_until = 0.0
+
+
+def month_start(value: datetime) -> date:
+    return date(value.year, value.month, 1)
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month:%Y_%m}"
+
+
+def _is_partitioned(conn, table: str) -> bool:
+    return bool(conn.scalar(
+        text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)"),
+        {"table": table},
+    ))
+
+
+def _create_partition(conn, table: str, month: date) -> None:
+    conn.execute(text(
+        f'CREATE TABLE IF NOT EXISTS "{partition_name(table, month)}" PARTITION OF "{table}" '
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month(month).isoformat()}')"
+    ))
+
+
+def ensure_months(months: Iterable[date]) -> None:
+    """Create the partitions of the given months that do not exist yet."""
+    global _unpartitioned_until
+    with _lock:
+        missing = sorted(set(months) - _known_months)
+        if not missing or time.monotonic() < _unpartitioned_until:
+            return
+        # Each partition is created in its own short transaction: attaching
+        # one locks the parent table, so it must not wait on a write batch.
+        with get_engine().connect() as conn:
+            for table in PARTITIONED_TABLES:
+                if not _is_partitioned(conn, table.name):
+                    logger.warning(
+                        "Table %s is missing or not partitioned; run `python -m app.migrate`", table.name
+                    )
+                    _unpartitioned_until = time.monotonic() + PARTITION_RECHECK_INTERVAL
+                    conn.rollback()
+                    return
+            conn.rollback()
+            _unpartitioned_until = 0.0
+            for month in missing:
+                for table in PARTITIONED_TABLES:
+                    with conn.begin():
+                        _create_partition(conn, table.name, month)
+                _known_months.add(month)
+
+
+async def ensure_partitions_for(datetimes: Iterable[datetime]) -> None:
+    """Make sure every month in ``datetimes`` has a partition before inserting."""
+    months = {month_start(value) for value in datetimes}
+    if months - _known_months and time.monotonic() >= _unpartitioned_until:
+        await run_in_threadpool(ensure_months, months)
+
+
+def ensure_ahead(ahead: int = PARTITION_MONTHS_AHEAD) -> None:
+    """Create partitions for the current month and ``ahead`` months after it."""
+    month = month_start(datetime.now())
+    months = [month]
+    for _ in range(ahead):
+        month = next_month(month)
+        months.append(month)
+    ensure_months(months)
+
+
+async def maintain_partitions(interval: float = PARTITION_CHECK_INTERVAL) -> None:
+    """Background task keeping partitions created ahead of time."""
+    while True:
+        try:
+            await run_in_threadpool(ensure_ahead)
+        except Exception:
+            logger.exception("Failed to create message partitions")
+        await asyncio.sleep(interval)
+
+
+def convert(tables: Iterable[Table] = PARTITIONED_TABLES, allow_rewrite: bool = True) -> None:
+    """Rebuild existing heap tables as the partitioned ``tables``.
+
+    Each table is renamed to ``<table>_legacy`` (with its indexes), the
+    partitioned table is created from its definition (the models, unless a
+    migration passes its own), partitions are created for every month
+    present and the rows are copied over in one transaction. The legacy
+    tables are left in place to be dropped once verified.
+
+    The transaction holds exclusive locks while it copies, so writes stop
+    until it commits. Without ``allow_rewrite`` only empty tables are
+    converted and a table with rows raises RuntimeError.
+    """
+    with get_engine().begin() as conn:
+        for table in tables:
+            name = table.name
+            if _is_partitioned(conn, name) or conn.scalar(text("SELECT to_regclass(:t)"), {"t": name}) is None:
+                continue
+            if not allow_rewrite and conn.scalar(text(f'SELECT EXISTS (SELECT 1 FROM "{name}")')):
+                raise RuntimeError(
+                    f"Table {name} has rows; converting it to partitions blocks writes while they are "
+                    "copied. Stop the app and run with MIGRATE_ALLOW_TABLE_REWRITE=1"
+                )
+            legacy = f"{name}_legacy"
+            conn.execute(text(f'ALTER TABLE "{name}" RENAME TO "{legacy}"'))
+            for (index_name,) in conn.execute(
+                text("SELECT indexname FROM pg_indexes WHERE tablename = :t"), {"t": legacy}
+            ):
+                conn.execute(text(f'ALTER INDEX "{index_name}" RENAME TO "{index_name}_legacy"'))
+            table.create(conn)
+            months = conn.execute(text(
+                f'SELECT DISTINCT date_trunc(\'month\', datetime)::date FROM "{legacy}"'
+            )).scalars().all()
+            for month in months:
+                _create_partition(conn, name, month)
+            columns = ", ".join(f'"{c.name}"' for c in table.columns)
+            copied = conn.execute(text(
+                f'INSERT INTO "{name}" ({columns}) SELECT {columns} FROM "{legacy}"'
+            )).rowcount
+            logger.warning("Copied %d rows of %s into %d monthly partitions", copied, name, len(months))
+
+
+def main(argv=None) -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog="python -m app.partitions")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ensure_cmd = commands.add_parser("ensure", help="create upcoming monthly partitions")
+    ensure_cmd.add_argument("--ahead", type=int, default=PARTITION_MONTHS_AHEAD, help="months after the current one")
+    commands.add_parser(
+        "convert", help="convert heap message tables into partitioned tables (blocks writes while copying)"
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "ensure":
+        ensure_ahead(args.ahead)
+        print(f"Partitions exist up to {max(_known_months):%Y-%m}" if _known_months else "Nothing created")
+    elif args.command == "convert":
+        convert()
+        ensure_ahead()
+        print("Message tables are partitioned by month")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+DASHBOARD_CACHE_TTL = float(os.getenv("DASHBOARD_CACHE_TTL", "5"))
+DASHBOARD_CACHE_STALE_TTL = float(os.getenv("DASHBOARD_CACHE_STALE_TTL", "30"))
+DASHBOARD_CACHE_SIZE = int(os.getenv("DASHBOARD_CACHE_SIZE", "1024"))
+
+
+class _entry:
+    __slots__ = ("value", "computed_at", "stale")
+
+    def __init__(self, value: Any, computed_at: float, stale: bool = False):
+        self.value = value
+        self.computed_at = computed_at
+        self.stale = stale
+
+
+class response_cache:
+    """Per-instance response cache with single-flight recomputation.
+
+    Keys are tuples whose first element is the instanceId (or None for
+    unscoped responses). A fresh entry is served as is; an entry that is
+    expired or invalidated but still inside the stale window is served
+    while a single background task recomputes it. Concurrent misses on the
+    same key share one computation.
+    """
+
+    def __init__(
+        self,
+        ttl: float = DASHBOARD_CACHE_TTL,
+        stale_ttl: float = DASHBOARD_CACHE_STALE_TTL,
+        max_entries: int = DASHBOARD_CACHE_SIZE,
+    ):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, _entry]" = OrderedDict()
+        self._inflight: Dict[Tuple, asyncio.Task] = {}
+        self._versions: Dict[Optional[Hashable], int] = {}
+        self._global_version = 0
+
+    def _version(self, key: Tuple) -> int:
+        if key[0] is None:
+            return self._global_version
+        return self._versions.get(key[0], 0)
+
+    async def get_or_compute(self, key: Tuple, compute: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            age = time.monotonic() - entry.computed_at
+            if not entry.stale and age < self.ttl:
+                return entry.value
+            if age < self.ttl + self.stale_ttl:
+                self._refresh(key, compute)
+                return entry.value
+        # Shield the shared task so a disconnecting client does not cancel it
+        # for everyone else waiting on the same key.
+        return await asyncio.shield(self._refresh(key, compute))
+
+    def invalidate(self, instance_id: Optional[Hashable]) -> None:
+        """Mark the entries of an instance, and all unscoped entries, stale."""
+        self._global_version += 1
+        if instance_id is not None:
+            self._versions[instance_id] = self._versions.get(instance_id, 0) + 1
+        for key, entry in self._entries.items():
+            if key[0] is None or key[0] == instance_id:
+                entry.stale = True
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def _refresh(self, key: Tuple, compute: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._compute(key, compute))
+            # Background refreshes may have nobody awaiting them; consume the
+            # exception so a failure is not reported as never retrieved.
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[key] = task
+        return task
+
+    async def _compute(self, key: Tuple, compute: Callable[[], Awaitable[Any]]) -> Any:
+        version = self._version(key)
+        try:
+            value = await compute()
+            # Writes committed while computing make the result stale on arrival.
+            stale = version != self._version(key)
+            self._entries[key] = _entry(value, time.monotonic(), stale)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+
+dashboard_cache = response_cache()
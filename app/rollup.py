@@ -0,0 +1,158 @@
+"""Hourly message rollups for the dashboard time series.
+
+Rollups are updated in the same transaction that stores new messages. Rows
+that predate the rollup tables are loaded with::
+
+    python -m app.rollup backfill --since 2024-01-01
+"""
+import argparse
+from collections import Counter
+from datetime import date, datetime, time, timedelta
+from typing import List, Optional
+
+from sqlalchemy import func, literal, select, text, union_all
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.database import get_engine
+from app.models import message, image_message, message_rollup, message_rollup_contact
+
+ROLLUP_KEY = ("instanceId", "bucket", "direction", "kind")
+
+
+def hour_bucket(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+async def record_rollup(db, events: List[dict]) -> None:
+    """Add stored message events to the hourly rollup tables.
+
+    Callers must only pass events that were actually inserted, otherwise a
+    retried webhook would be counted twice. Rows are written in key order so
+    concurrent writers lock them in the same sequence.
+    """
+    counts = Counter()
+    contacts = set()
+    for event in events:
+        if event["kind"] is None:
+            continue
+        key = (
+            event["instance_id"],
+            hour_bucket(event["datetime_obj"]),
+            event["message_type"],
+            event["kind"],
+        )
+        counts[key] += 1
+        contacts.add(key + (event["whatsapp_id"],))
+    if not counts:
+        return
+
+    stmt = pg_insert(message_rollup).values(
+        [dict(zip(ROLLUP_KEY, key), message_count=n) for key, n in sorted(counts.items())]
+    )
+    await db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=list(ROLLUP_KEY),
+            set_={"message_count": message_rollup.message_count + stmt.excluded.message_count},
+        )
+    )
+    await db.execute(
+        pg_insert(message_rollup_contact)
+        .values([dict(zip(ROLLUP_KEY + ("WhatsappjId",), key)) for key in sorted(contacts)])
+        .on_conflict_do_nothing()
+    )
+
+
+def _raw_buckets(start: datetime, end: datetime):
+    """Message rows of both tables in [start, end) mapped to rollup keys."""
+    return union_all(
+        select(
+            message.instanceId,
+            func.date_trunc("hour", message.datetime).label("bucket"),
+            message.Message_Type.label("direction"),
+            literal("text").label("kind"),
+            message.WhatsappjId,
+        ).where(message.datetime >= start, message.datetime < end),
+        select(
+            image_message.instanceId,
+            func.date_trunc("hour", image_message.datetime).label("bucket"),
+            image_message.Message_Type.label("direction"),
+            literal("image").label("kind"),
+            image_message.WhatsappjId,
+        ).where(image_message.datetime >= start, image_message.datetime < end),
+    ).subquery()
+
+
+def backfill_day(conn, day: date) -> None:
+    """Recompute the rollup rows of one day from the raw message tables.
+
+    The counts are overwritten, so live increments must not interleave: the
+    table lock waits for ingest transactions in flight and holds new ones
+    until this day's transaction commits.
+    """
+    start = datetime.combine(day, time.min)
+    end = start + timedelta(days=1)
+
+    conn.execute(text(f"LOCK TABLE {message_rollup.__tablename__} IN SHARE ROW EXCLUSIVE MODE"))
+    raw = _raw_buckets(start, end)
+    key_columns = [raw.c.instanceId, raw.c.bucket, raw.c.direction, raw.c.kind]
+    counts = pg_insert(message_rollup).from_select(
+        list(ROLLUP_KEY) + ["message_count"],
+        select(*key_columns, func.count()).group_by(*key_columns),
+    )
+    conn.execute(
+        counts.on_conflict_do_update(
+            index_elements=list(ROLLUP_KEY),
+            set_={"message_count": counts.excluded.message_count},
+        )
+    )
+
+    raw = _raw_buckets(start, end)
+    conn.execute(
+        pg_insert(message_rollup_contact)
+        .from_select(
+            list(ROLLUP_KEY) + ["WhatsappjId"],
+            select(raw.c.instanceId, raw.c.bucket, raw.c.direction, raw.c.kind, raw.c.WhatsappjId).distinct(),
+        )
+        .on_conflict_do_nothing()
+    )
+
+
+def backfill(since: Optional[date] = None, until: Optional[date] = None) -> int:
+    """Backfill the rollups day by day, one transaction per day."""
+    if since is None:
+        with get_engine().connect() as conn:
+            firsts = [
+                conn.scalar(select(func.min(message.datetime))),
+                conn.scalar(select(func.min(image_message.datetime))),
+            ]
+        firsts = [first for first in firsts if first is not None]
+        if not firsts:
+            return 0
+        since = min(firsts).date()
+    until = until or date.today()
+
+    days = 0
+    day = since
+    while day <= until:
+        with get_engine().begin() as conn:
+            backfill_day(conn, day)
+        days += 1
+        day += timedelta(days=1)
+    return days
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.rollup")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill_cmd = commands.add_parser("backfill", help="rebuild hourly rollups from raw messages")
+    backfill_cmd.add_argument("--since", type=date.fromisoformat, help="first day (default: oldest message)")
+    backfill_cmd.add_argument("--until", type=date.fromisoformat, help="last day (default: today)")
+    args = parser.parse_args(argv)
+
+    if args.command == "backfill":
+        days = backfill(args.since, args.until)
+        print(f"Backfilled {days} day(s) of message rollups")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,9 @@ from .conversation_router import conversation_route
 from .message_router import message_route
 from .contact_router import contact_route
 from .dashboard_router import dashboard_route
+from .export_router import export_route
+from .media_router import media_route
+from .metrics_router import metrics_route
 
 __all__ = [
     "inbox_route",
@@ -10,4 +13,7 @@ __all__ = [
     "message_route",
     "contact_route",
     "dashboard_route",
+    "export_route",
+    "media_route",
+    "metrics_route",
 ]
@@ -1,78 +1,91 @@
-from fastapi import APIRouter, Depends, Query, Body, status
+from fastapi import APIRouter, Depends, Query, Body, Request, status
 from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.database import get_db
+from app.change_versions import bump, check_not_modified, contacts_scope, instance_scopes
+from app.contact_cache import known_contacts
+from app.database import get_db, get_read_db
 from app.models import contact
 
 contact_route = APIRouter(prefix="/contacts", tags=["Contact"])
 
 @contact_route.get("/")
-def get_contacts(instanceId: str = Query(...), db: Session = Depends(get_db)):
+async def get_contacts(request: Request, instanceId: str = Query(...), db: AsyncSession = Depends(get_read_db)):
     try:
-        contacts = db.query(contact).filter(contact.instanceId == instanceId).all()
+        etag, not_modified = await check_not_modified(request, db, contacts_scope(instanceId))
+        if not_modified:
+            return not_modified
+        contacts = (
+            await db.scalars(select(contact).where(contact.instanceId == instanceId))
+        ).all()
         result = [
             {
-                "contactId": contact.contactId,
-                "WhatsappjId": contact.WhatsappjId,
-                "pushname": contact.pushname,
-                "instanceId": contact.instanceId,
-                "createdAt": contact.createdAt.isoformat() if contact.createdAt else None,
-                "updatedAt": contact.updatedAt.isoformat() if contact.updatedAt else None
+                "contactId": c.contactId,
+                "WhatsappjId": c.WhatsappjId,
+                "pushname": c.pushname,
+                "instanceId": c.instanceId,
+                "createdAt": c.createdAt.isoformat() if c.createdAt else None,
+                "updatedAt": c.updatedAt.isoformat() if c.updatedAt else None
             }
-            for contact in contacts
+            for c in contacts
         ]
-        return JSONResponse(content={"status": "Success", "contacts": result})
+        return JSONResponse(content={"status": "Success", "contacts": result}, headers={"ETag": etag})
     except Exception as e:
         return JSONResponse(content={"status": "Error", "details": str(e)})
 
 @contact_route.post("/")
-def create_contact(
+async def create_contact(
     pushname: str = Body(...),
     WhatsappjId: str = Body(...),
     instanceId: str = Body(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
-        exists = db.query(contact).filter(contact.WhatsappjId == WhatsappjId, contact.instanceId == instanceId).first()
+        exists = await db.scalar(
+            select(contact).where(contact.WhatsappjId == WhatsappjId, contact.instanceId == instanceId)
+        )
         if exists:
             return JSONResponse(content={"status": "Error", "details": "Contact already exists"})
         import uuid
-        contact = contact(
+        new_contact = contact(
             contactId=str(uuid.uuid4()),
             pushname=pushname,
             WhatsappjId=WhatsappjId,
             instanceId=instanceId
         )
-        db.add(contact)
-        db.commit()
-        db.refresh(contact)
+        db.add(new_contact)
+        await bump(db, instance_scopes(instanceId))
+        await db.commit()
+        await db.refresh(new_contact)
         return JSONResponse(content={
             "status": "Success",
             "contact": {
-                "contactId": contact.contactId,
-                "pushname": contact.pushname,
-                "WhatsappjId": contact.WhatsappjId,
-                "instanceId": contact.instanceId,
-                "createdAt": contact.createdAt.isoformat() if contact.createdAt else None
+                "contactId": new_contact.contactId,
+                "pushname": new_contact.pushname,
+                "WhatsappjId": new_contact.WhatsappjId,
+                "instanceId": new_contact.instanceId,
+                "createdAt": new_contact.createdAt.isoformat() if new_contact.createdAt else None
             }
         })
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         return JSONResponse(content={"status": "Error", "details": str(e)})
 
 @contact_route.delete("/")
-def delete_contact(contactId: str = Query(...), db: Session = Depends(get_db)):
+async def delete_contact(contactId: str = Query(...), db: AsyncSession = Depends(get_db)):
     try:
-        contact = db.query(contact).filter(contact.contactId == contactId).first()
-        if not contact:
+        existing = await db.get(contact, contactId)
+        if not existing:
             return JSONResponse(
                 status_code=status.HTTP_404_NOT_FOUND,
                 content={"status": "Error", "details": "Contact not found"}
             )
-        db.delete(contact)
-        db.commit()
+        await db.delete(existing)
+        await bump(db, instance_scopes(existing.instanceId))
+        await db.commit()
+        known_contacts.invalidate(existing.WhatsappjId)
         return JSONResponse(content={"status": "Success", "message": f"Contact {contactId} deleted"})
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         return JSONResponse(content={"status": "Error", "details": str(e)})
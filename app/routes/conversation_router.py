@@ -1,32 +1,84 @@
-from fastapi import APIRouter, Depends, Query
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Query, Request, status
 from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.database import get_db
-from app.models import message, contact
+from app.change_versions import check_not_modified, conversations_scope
+from app.database import get_read_db
+from app.models import message, image_message, contact, conversation
+from app.pagination import decode_cursor, encode_cursor
+from app.timeline import with_details
 
 conversation_route = APIRouter(tags=["Conversation"])
 
+
+def _conversations_query(instance_id: str, limit: int, after: Optional[tuple]):
+    """Latest message per contact, newest first.
+
+    The page is a range scan of the conversation index; message details and
+    contacts are joined only for the rows of the page.
+    """
+    page = (
+        select(conversation.WhatsappjId, conversation.messageId, conversation.datetime, conversation.kind)
+        .where(conversation.instanceId == instance_id)
+        .order_by(conversation.datetime.desc(), conversation.WhatsappjId.desc())
+        .limit(limit + 1)
+    )
+    if after is not None:
+        page = page.where(tuple_(conversation.datetime, conversation.WhatsappjId) < tuple_(*after))
+    page = page.subquery()
+    return (
+        select(
+            page,
+            func.coalesce(message.Message_Content, image_message.caption).label("content"),
+            contact.pushname,
+        )
+        .select_from(with_details(page))
+        .outerjoin(contact, contact.WhatsappjId == page.c.WhatsappjId)
+        .order_by(page.c.datetime.desc(), page.c.WhatsappjId.desc())
+    )
+
+
 @conversation_route.get("/conversations")
-def get_conversations(instanceId: str = Query(...), db: Session = Depends(get_db)):
+async def get_conversations(
+    request: Request,
+    instanceId: str = Query(...),
+    limit: int = Query(50, ge=1, le=200),
+    after: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_read_db),
+):
+    try:
+        position = decode_cursor(after) if after else None
+    except ValueError as e:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"status": "Error", "details": str(e)},
+        )
     try:
-        contacts = db.query(contact).filter(contact.instanceId == instanceId).all()
-        conversations = []
-        for contact in contacts:
-            last_message = (
-                db.query(message)
-                .filter(message.WhatsappjId == contact.WhatsappjId)
-                .order_by(desc(message.datetime))
-                .first()
-            )
-            if last_message:
-                conversations.append({
-                    "contact_name": contact.pushname,
-                    "contact_number": contact.WhatsappjId.replace("@s.whatsapp.net", ""),
-                    "last_message": last_message.Message_Content,
-                    "last_update": last_message.datetime.strftime("%Y-%m-%d %H:%M:%S")
-                })
-        return JSONResponse(content={"status": "Success", "conversations": conversations})
+        etag, not_modified = await check_not_modified(request, db, conversations_scope(instanceId))
+        if not_modified:
+            return not_modified
+        rows = (await db.execute(_conversations_query(instanceId, limit, position))).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].datetime, rows[-1].WhatsappjId)
+        conversations = [
+            {
+                "contact_name": row.pushname,
+                "contact_number": row.WhatsappjId.replace("@s.whatsapp.net", ""),
+                "last_message": row.content,
+                "last_message_type": row.kind,
+                "last_update": row.datetime.strftime("%Y-%m-%d %H:%M:%S")
+            }
+            for row in rows
+        ]
+        return JSONResponse(content={
+            "status": "Success",
+            "conversations": conversations,
+            "next_cursor": next_cursor,
+        }, headers={"ETag": etag})
     except Exception as e:
         return JSONResponse(content={"status": "Error", "details": str(e)})
@@ -1,121 +1,244 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
-from sqlalchemy import func, extract
-from datetime import datetime, timedelta
+from typing import Optional
 
-from app.database import get_db
-from app.models import message, contact, inbox
+from fastapi import APIRouter, Query, status
+from fastapi.responses import JSONResponse
+from sqlalchemy import func, extract, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import date, datetime, time, timedelta
+
+from app.database import open_read_session
+from app.models import timeline, contact, inbox, message_rollup, message_rollup_contact
+from app.response_cache import dashboard_cache
+from app.rollup import hour_bucket
 
 
 dashboard_route = APIRouter(tags=["Dashboard"])
 
+TIMESERIES_BUCKETS = {"hour": timedelta(hours=1), "day": timedelta(days=1), "week": timedelta(weeks=1)}
+TIMESERIES_MAX_POINTS = 5000
 
-def _base_dashboard_data(db: Session, today: datetime.date):
-    """Return basic dashboard metrics used by multiple endpoints."""
-    week_ago = today - timedelta(days=7)
-    month_ago = today - timedelta(days=30)
 
-    sent_today = (
-        db.query(func.count())
-        .filter(message.Message_Type == "Outgoing", func.date(message.datetime) == today)
-        .scalar()
-    )
-    sent_week = (
-        db.query(func.count())
-        .filter(message.Message_Type == "Outgoing", func.date(message.datetime) >= week_ago)
-        .scalar()
-    )
-    sent_month = (
-        db.query(func.count())
-        .filter(message.Message_Type == "Outgoing", func.date(message.datetime) >= month_ago)
-        .scalar()
-    )
+def _day_start(day: date) -> datetime:
+    return datetime.combine(day, time.min)
 
-    received_today = (
-        db.query(func.count())
-        .filter(message.Message_Type == "Incoming", func.date(message.datetime) == today)
-        .scalar()
-    )
-    received_week = (
-        db.query(func.count())
-        .filter(message.Message_Type == "Incoming", func.date(message.datetime) >= week_ago)
-        .scalar()
-    )
-    received_month = (
-        db.query(func.count())
-        .filter(message.Message_Type == "Incoming", func.date(message.datetime) >= month_ago)
-        .scalar()
-    )
 
-    total_active_contacts = db.query(func.count(contact.contactId)).scalar()
-    contacts_today = (
-        db.query(func.count(func.distinct(message.WhatsappjId)))
-        .filter(func.date(message.datetime) == today)
-        .scalar()
-    )
-    contacts_week = (
-        db.query(func.count(func.distinct(message.WhatsappjId)))
-        .filter(func.date(message.datetime) >= week_ago)
-        .scalar()
-    )
-    contacts_month = (
-        db.query(func.count(func.distinct(message.WhatsappjId)))
-        .filter(func.date(message.datetime) >= month_ago)
-        .scalar()
+async def _cached(key: tuple, compute, *args):
+    """Serve a dashboard payload from the cache, computing it on its own session.
+
+    The computation may outlive the request that triggered it (other
+    pollers wait on it, or it refreshes a stale entry in the background), so
+    it never borrows the request's session.
+    """
+    async def run():
+        db = open_read_session()
+        try:
+            return await compute(db, *args)
+        finally:
+            await db.close()
+
+    return await dashboard_cache.get_or_compute(key, run)
+
+
+async def _base_dashboard_data(db: AsyncSession, today: date, instance_id: Optional[str] = None):
+    """Return basic dashboard metrics used by multiple endpoints.
+
+    Every counter comes out of a single conditional-aggregation pass over the
+    last 30 days of the timeline (messages of every kind), bounded on the raw
+    datetime column so the (instanceId, datetime) index can be used and only
+    the monthly partitions overlapping the window are scanned.
+    """
+    today_start = _day_start(today)
+    tomorrow_start = today_start + timedelta(days=1)
+    week_start = today_start - timedelta(days=7)
+    month_start = today_start - timedelta(days=30)
+
+    is_sent = timeline.Message_Type == "Outgoing"
+    is_received = timeline.Message_Type == "Incoming"
+    in_today = (timeline.datetime >= today_start) & (timeline.datetime < tomorrow_start)
+    in_week = timeline.datetime >= week_start
+
+    active_contacts = select(func.count(contact.contactId))
+    inboxes = select(func.count(inbox.inbox_id))
+    stmt = select(
+        func.count().filter(is_sent, in_today).label("sent_today"),
+        func.count().filter(is_sent, in_week).label("sent_week"),
+        func.count().filter(is_sent).label("sent_month"),
+        func.count().filter(is_received, in_today).label("received_today"),
+        func.count().filter(is_received, in_week).label("received_week"),
+        func.count().filter(is_received).label("received_month"),
+        func.count(func.distinct(timeline.WhatsappjId)).filter(in_today).label("contacts_today"),
+        func.count(func.distinct(timeline.WhatsappjId)).filter(in_week).label("contacts_week"),
+        func.count(func.distinct(timeline.WhatsappjId)).label("contacts_month"),
+    ).where(timeline.datetime >= month_start)
+    if instance_id is not None:
+        stmt = stmt.where(timeline.instanceId == instance_id)
+        active_contacts = active_contacts.where(contact.instanceId == instance_id)
+        inboxes = inboxes.where(inbox.instance_id == instance_id)
+    stmt = stmt.add_columns(
+        active_contacts.scalar_subquery().label("active_contacts"),
+        inboxes.scalar_subquery().label("total_inboxes"),
     )
 
-    total_inboxes = db.query(func.count(inbox.inbox_id)).scalar()
+    row = (await db.execute(stmt)).one()
 
     return {
         "messages_sent": {
-            "today": sent_today,
-            "last_7_days": sent_week,
-            "last_30_days": sent_month,
+            "today": row.sent_today,
+            "last_7_days": row.sent_week,
+            "last_30_days": row.sent_month,
         },
         "messages_received": {
-            "today": received_today,
-            "last_7_days": received_week,
-            "last_30_days": received_month,
+            "today": row.received_today,
+            "last_7_days": row.received_week,
+            "last_30_days": row.received_month,
         },
         "contacts": {
-            "active": total_active_contacts,
-            "talked_today": contacts_today,
-            "talked_last_7_days": contacts_week,
-            "talked_last_30_days": contacts_month,
+            "active": row.active_contacts,
+            "talked_today": row.contacts_today,
+            "talked_last_7_days": row.contacts_week,
+            "talked_last_30_days": row.contacts_month,
         },
-        "total_inboxes": total_inboxes,
+        "total_inboxes": row.total_inboxes,
     }
 
+async def _dashboard_time_data(db: AsyncSession, today: date, instance_id: Optional[str] = None):
+    """Dashboard metrics plus today's messages per hour, read from the hourly rollups."""
+    base_data = await _base_dashboard_data(db, today, instance_id)
+
+    today_start = _day_start(today)
+    hour = extract('hour', message_rollup.bucket).label('hour')
+    by_hour_query = select(
+        hour,
+        message_rollup.direction,
+        func.sum(message_rollup.message_count).label('count')
+    ).where(
+        message_rollup.bucket >= today_start,
+        message_rollup.bucket < today_start + timedelta(days=1),
+    ).group_by(hour, message_rollup.direction)
+    if instance_id is not None:
+        by_hour_query = by_hour_query.where(message_rollup.instanceId == instance_id)
+
+    by_hour = {"Outgoing": {}, "Incoming": {}}
+    for h, direction, c in (await db.execute(by_hour_query)).all():
+        by_hour.setdefault(direction, {})[f"time_{int(h)}"] = int(c)
+    sent_by_time = [{f"time_{h}": by_hour["Outgoing"].get(f"time_{h}", 0)} for h in range(24)]
+    received_by_time = [{f"time_{h}": by_hour["Incoming"].get(f"time_{h}", 0)} for h in range(24)]
+
+    base_data["messages_sent"]["sent_by_time"] = sent_by_time
+    base_data["messages_received"]["received_by_time"] = received_by_time
+    return base_data
+
 @dashboard_route.get("/dashboard_info")
-def get_dashboard_info(db: Session = Depends(get_db)):
+async def get_dashboard_info(instanceId: Optional[str] = Query(None)):
     today = datetime.now().date()
-    return _base_dashboard_data(db, today)
+    return await _cached((instanceId, "dashboard_info", today), _base_dashboard_data, today, instanceId)
 
 @dashboard_route.get("/dashboard_time")
-def get_dashboard_time(db: Session = Depends(get_db)):
+async def get_dashboard_time(instanceId: Optional[str] = Query(None)):
     today = datetime.now().date()
-    base_data = _base_dashboard_data(db, today)
-
-    sent_by_hour_query = db.query(
-        extract('hour', message.datetime).label('hour'),
-        func.count().label('count')
-    ).filter(
-        message.Message_Type == "Outgoing",
-        func.date(message.datetime) == today
-    ).group_by('hour').all()
-    sent_by_hour = {f"time_{int(h)}": c for h, c in sent_by_hour_query}
-    sent_by_time = [{f"time_{h}": sent_by_hour.get(f"time_{h}", 0)} for h in range(24)]
-
-    received_by_hour_query = db.query(
-        extract('hour', message.datetime).label('hour'),
-        func.count().label('count')
-    ).filter(
-        message.Message_Type == "Incoming",
-        func.date(message.datetime) == today
-    ).group_by('hour').all()
-    received_by_hour = {f"time_{int(h)}": c for h, c in received_by_hour_query}
-    received_by_time = [{f"time_{h}": received_by_hour.get(f"time_{h}", 0)} for h in range(24)]
+    return await _cached((instanceId, "dashboard_time", today), _dashboard_time_data, today, instanceId)
 
-    base_data["messages_sent"]["sent_by_time"] = sent_by_time
-    base_data["messages_received"]["received_by_time"] = received_by_time
-    return base_data
+
+def _truncate(value: datetime, bucket: str) -> datetime:
+    """Python mirror of date_trunc for the supported bucket sizes."""
+    value = hour_bucket(value)
+    if bucket in ("day", "week"):
+        value = value.replace(hour=0)
+    if bucket == "week":
+        value -= timedelta(days=value.weekday())
+    return value
+
+
+@dashboard_route.get("/dashboard/timeseries")
+async def get_dashboard_timeseries(
+    instanceId: Optional[str] = Query(None),
+    start: Optional[datetime] = Query(None),
+    end: Optional[datetime] = Query(None),
+    bucket: str = Query("day"),
+):
+    """Message and contact counts per bucket, served from the hourly rollups."""
+    # Message datetimes are stored as naive local time.
+    if end is not None and end.tzinfo is not None:
+        end = end.astimezone().replace(tzinfo=None)
+    if start is not None and start.tzinfo is not None:
+        start = start.astimezone().replace(tzinfo=None)
+    # Without an explicit end the range runs to the end of the current hour,
+    # which keeps the cache key stable between polls.
+    end = end or hour_bucket(datetime.now()) + timedelta(hours=1)
+    start = start or end - timedelta(days=7)
+    if bucket not in TIMESERIES_BUCKETS:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"status": "Error", "details": f"bucket must be one of {', '.join(TIMESERIES_BUCKETS)}"},
+        )
+    if start >= end or (end - start) / TIMESERIES_BUCKETS[bucket] > TIMESERIES_MAX_POINTS:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"status": "Error", "details": "Invalid or too large time range for this bucket"},
+        )
+    first = _truncate(start, bucket)
+    return await _cached(
+        (instanceId, "timeseries", bucket, first, end),
+        _timeseries_data, instanceId, first, end, bucket,
+    )
+
+
+async def _timeseries_data(db: AsyncSession, instance_id: Optional[str], first: datetime, end: datetime, bucket: str):
+    """Zero-filled series of rollup counts between first and end."""
+    counts_bucket = func.date_trunc(bucket, message_rollup.bucket).label("bucket")
+    counts_query = select(
+        counts_bucket,
+        message_rollup.direction,
+        message_rollup.kind,
+        func.sum(message_rollup.message_count).label("messages"),
+    ).where(
+        message_rollup.bucket >= first,
+        message_rollup.bucket < end,
+    ).group_by(counts_bucket, message_rollup.direction, message_rollup.kind)
+
+    contacts_bucket = func.date_trunc(bucket, message_rollup_contact.bucket).label("bucket")
+    contacts_query = select(
+        contacts_bucket,
+        func.count(func.distinct(message_rollup_contact.WhatsappjId)).label("contacts"),
+    ).where(
+        message_rollup_contact.bucket >= first,
+        message_rollup_contact.bucket < end,
+    ).group_by(contacts_bucket)
+
+    if instance_id is not None:
+        counts_query = counts_query.where(message_rollup.instanceId == instance_id)
+        contacts_query = contacts_query.where(message_rollup_contact.instanceId == instance_id)
+
+    points = {}
+    current = first
+    while current < end:
+        points[current] = {
+            "bucket": current.isoformat(),
+            "messages_sent": 0,
+            "messages_received": 0,
+            "by_kind": {"text": 0, "image": 0},
+            "contacts": 0,
+        }
+        current += TIMESERIES_BUCKETS[bucket]
+
+    for row in (await db.execute(counts_query)).all():
+        point = points.get(row.bucket)
+        if point is None:
+            continue
+        messages = int(row.messages)
+        if row.direction == "Outgoing":
+            point["messages_sent"] += messages
+        else:
+            point["messages_received"] += messages
+        point["by_kind"][row.kind] = point["by_kind"].get(row.kind, 0) + messages
+    for row in (await db.execute(contacts_query)).all():
+        if row.bucket in points:
+            points[row.bucket]["contacts"] = row.contacts
+
+    return {
+        "instanceId": instance_id,
+        "bucket": bucket,
+        "start": first.isoformat(),
+        "end": end.isoformat(),
+        "series": list(points.values()),
+    }
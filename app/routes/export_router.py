@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import zlib
+from datetime import datetime
+from typing import AsyncIterator, Callable, Optional
+
+from fastapi import APIRouter, Query, Request, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy import select
+
+from app.database import stream_rows
+from app.models import contact, image_message, message, timeline
+from app.timeline import with_details
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+export_route = APIRouter(prefix="/export", tags=["Export"])
+
+
+def _contact_line(row) -> dict:
+    return {
+        "contactId": row.contactId,
+        "WhatsappjId": row.WhatsappjId,
+        "pushname": row.pushname,
+        "instanceId": row.instanceId,
+        "createdAt": row.createdAt.isoformat() if row.createdAt else None,
+        "updatedAt": row.updatedAt.isoformat() if row.updatedAt else None,
+    }
+
+
+def _message_line(row) -> dict:
+    item = {
+        "type": row.kind,
+        "messageId": row.messageId,
+        "WhatsappjId": row.WhatsappjId,
+        "Message_Type": row.Message_Type,
+        "datetime": row.datetime.isoformat(),
+    }
+    if row.kind == "text":
+        item["Message_Content"] = row.Message_Content
+    else:
+        item.update({
+            "image_url": row.image_url,
+            "caption": row.caption,
+            "mimetype": row.mimetype,
+            "height": row.height,
+            "width": row.width,
+        })
+    return item
+
+
+async def _ndjson(statement, to_line: Callable, compress: bool) -> AsyncIterator[bytes]:
+    """Encode query rows as NDJSON, one cursor batch at a time.
+
+    Only one batch is held in memory. Errors after the response has started
+    can no longer change the status code: they are logged and the stream
+    ends with an ``{"error": ...}`` line.
+    """
+    encoder = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    try:
+        async for rows in stream_rows(statement, EXPORT_BATCH_SIZE, read_only=True):
+            chunk = "".join(json.dumps(to_line(row)) + "\n" for row in rows).encode()
+            if encoder is not None:
+                chunk = encoder.compress(chunk)
+            if chunk:
+                yield chunk
+    except Exception:
+        logger.exception("Export aborted")
+        tail = (json.dumps({"error": "Export aborted"}) + "\n").encode()
+        yield encoder.compress(tail) if encoder is not None else tail
+    if encoder is not None:
+        yield encoder.flush()
+
+
+def _response(request: Request, statement, to_line: Callable, filename: str) -> StreamingResponse:
+    compress = "gzip" in request.headers.get("accept-encoding", "")
+    headers = {"Content-Disposition": f'attachment; filename="{filename}.ndjson"'}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    headers["Vary"] = "Accept-Encoding"
+    return StreamingResponse(
+        _ndjson(statement, to_line, compress),
+        media_type="application/x-ndjson",
+        headers=headers,
+    )
+
+
+@export_route.get("/contacts")
+async def export_contacts(request: Request, instanceId: str = Query(...)):
+    """All contacts of an instance as NDJSON."""
+    statement = (
+        select(
+            contact.contactId,
+            contact.WhatsappjId,
+            contact.pushname,
+            contact.instanceId,
+            contact.createdAt,
+            contact.updatedAt,
+        )
+        .where(contact.instanceId == instanceId)
+        .order_by(contact.WhatsappjId)
+    )
+    return _response(request, statement, _contact_line, f"contacts-{instanceId}")
+
+
+@export_route.get("/messages")
+async def export_messages(
+    request: Request,
+    instanceId: str = Query(...),
+    contact_number: Optional[str] = Query(None),
+    start: Optional[datetime] = Query(None),
+    end: Optional[datetime] = Query(None),
+):
+    """Messages of an instance, optionally of one contact and a [start, end) range, as NDJSON.
+
+    Rows come ordered by conversation then time, straight from the timeline
+    key.
+    """
+    # Message datetimes are stored as naive local time.
+    if start is not None and start.tzinfo is not None:
+        start = start.astimezone().replace(tzinfo=None)
+    if end is not None and end.tzinfo is not None:
+        end = end.astimezone().replace(tzinfo=None)
+    if start is not None and end is not None and start >= end:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"status": "Error", "details": "start must be before end"},
+        )
+    entries = timeline.__table__
+    statement = (
+        select(
+            entries.c.kind,
+            entries.c.messageId,
+            entries.c.WhatsappjId,
+            entries.c.Message_Type,
+            entries.c.datetime,
+            message.Message_Content,
+            image_message.url.label("image_url"),
+            image_message.caption,
+            image_message.mimetype,
+            image_message.height,
+            image_message.width,
+        )
+        .select_from(with_details(entries))
+        .where(entries.c.instanceId == instanceId)
+        .order_by(entries.c.WhatsappjId, entries.c.datetime, entries.c.messageId)
+    )
+    filename = f"messages-{instanceId}"
+    if contact_number:
+        statement = statement.where(entries.c.WhatsappjId == f"{contact_number}@s.whatsapp.net")
+        filename += f"-{contact_number}"
+    if start is not None:
+        statement = statement.where(entries.c.datetime >= start)
+    if end is not None:
+        statement = statement.where(entries.c.datetime < end)
+    return _response(request, statement, _message_line, filename)
@@ -1,11 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from fastapi import Query
+from fastapi import APIRouter, Depends, Request
 from fastapi.responses import JSONResponse
-from fastapi import Depends
 from fastapi import status
 from fastapi import Body
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.change_versions import INBOXES, bump, check_not_modified
 from app.database import get_db
 from uuid import uuid4
 from app.models import inbox
@@ -19,16 +18,16 @@ inbox_route = APIRouter(
 
 # POST Inbox
 @inbox_route.post("/create_inbox")
-def create_inbox(
+async def create_inbox(
     instance_id: str = Body(...),
     url_evo: str = Body(...),
     api_key: str = Body(...),
     whatsappjID: str = Body(...),
     inbox_name: str = Body(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
-        inbox = inbox(
+        new_inbox = inbox(
             inbox_id=str(uuid4()),
             instance_id=instance_id,
             url_evo=url_evo,
@@ -36,57 +35,62 @@ def create_inbox(
             whatsappjID=whatsappjID,
             inbox_name=inbox_name
         )
-        db.add(inbox)
-        db.commit()
-        db.refresh(inbox)
+        db.add(new_inbox)
+        await bump(db, [INBOXES])
+        await db.commit()
+        await db.refresh(new_inbox)
         return JSONResponse(content={
             "status": "Success",
             "inbox": {
-                "inbox_id": inbox.inbox_id,
-                "instance_id": inbox.instance_id,
-                "url_evo": inbox.url_evo,
-                "api_key": inbox.api_key,
-                "whatsappjID": inbox.whatsappjID,
-                "inbox_name": inbox.inbox_name
+                "inbox_id": new_inbox.inbox_id,
+                "instance_id": new_inbox.instance_id,
+                "url_evo": new_inbox.url_evo,
+                "api_key": new_inbox.api_key,
+                "whatsappjID": new_inbox.whatsappjID,
+                "inbox_name": new_inbox.inbox_name
             }
         })
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         return JSONResponse(content={"status": "Error", "details": str(e)})
 
 # GET Inbox
 @inbox_route.get("/")
-def get_inbox(db: Session = Depends(get_db)):
+async def get_inbox(request: Request, db: AsyncSession = Depends(get_db)):
     try:
-        inboxes = db.query(inbox).all()
+        etag, not_modified = await check_not_modified(request, db, INBOXES)
+        if not_modified:
+            return not_modified
+        inboxes = (await db.scalars(select(inbox))).all()
         result = [
             {
-                "inbox_id": inbox.inbox_id,
-                "instance_id": inbox.instance_id,
-                "url_evo": inbox.url_evo,
-                "api_key": inbox.api_key,
-                "whatsappjID": inbox.whatsappjID,
-                "inbox_name": inbox.inbox_name
+                "inbox_id": i.inbox_id,
+                "instance_id": i.instance_id,
+                "url_evo": i.url_evo,
+                "api_key": i.api_key,
+                "whatsappjID": i.whatsappjID,
+                "inbox_name": i.inbox_name
             }
-            for inbox in inboxes
+            for i in inboxes
         ]
-        return JSONResponse(content={"status": "Success", "inboxes": result})
+        return JSONResponse(content={"status": "Success", "inboxes": result}, headers={"ETag": etag})
     except Exception as e:
         return JSONResponse(content={"status": "Error", "details": str(e)})
 
 # DELETE Inbox
-@inbox_route.delete("/{inbox_id}}")
-def delete_inbox(inbox_id: str, db: Session = Depends(get_db)):
+@inbox_route.delete("/{inbox_id}")
+async def delete_inbox(inbox_id: str, db: AsyncSession = Depends(get_db)):
     try:
-        inbox = db.query(inbox).filter(inbox.inbox_id == inbox_id).first()
-        if not inbox:
+        existing = await db.get(inbox, inbox_id)
+        if not existing:
             return JSONResponse(
                 status_code=status.HTTP_404_NOT_FOUND,
                 content={"status": "Error", "details": "Inbox not found"}
             )
-        db.delete(inbox)
-        db.commit()
+        await db.delete(existing)
+        await bump(db, [INBOXES])
+        await db.commit()
         return JSONResponse(content={"status": "Success", "message": f"Inbox {inbox_id} deleted"})
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         return JSONResponse(content={"status": "Error", "details": str(e)})
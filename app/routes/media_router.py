@@ -0,0 +1,71 @@
+import re
+from typing import Iterable, List, Optional
+
+from fastapi import APIRouter, Request, Response, status
+from fastapi.responses import FileResponse, JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+from app.media import media_path, sha_key, sniff_mimetype, thumbnail_path
+
+media_route = APIRouter(prefix="/media", tags=["Media"])
+
+# Files never change once stored under their content hash.
+CACHE_HEADERS = {"Cache-Control": "public, max-age=31536000, immutable"}
+
+_SHA_HEX = re.compile(r"[0-9a-f]{64}")
+
+
+def media_url(file_sha256: Optional[str]) -> Optional[str]:
+    """Path of the cached copy of an image, or None while it is not cached."""
+    key = sha_key(file_sha256)
+    if key is None or not media_path(key).exists():
+        return None
+    return f"/media/{key}"
+
+
+async def media_urls(file_sha256s: Iterable[Optional[str]]) -> List[Optional[str]]:
+    """media_url for a page of images, checked in one trip to the threadpool."""
+    file_sha256s = list(file_sha256s)
+    if not any(file_sha256s):
+        return [None] * len(file_sha256s)
+    return await run_in_threadpool(lambda: [media_url(file_sha256) for file_sha256 in file_sha256s])
+
+
+def _media_type(path, media_type: Optional[str]) -> Optional[str]:
+    """The type to serve a stored file with, or None when it does not exist."""
+    if not path.exists():
+        return None
+    if media_type is None:
+        with open(path, "rb") as f:
+            media_type = sniff_mimetype(f.read(12))
+    return media_type
+
+
+async def _serve(request: Request, sha: str, path, media_type: Optional[str] = None):
+    if _SHA_HEX.fullmatch(sha):
+        # Disk access stays off the event loop; FileResponse streams in a thread too.
+        media_type = await run_in_threadpool(_media_type, path, media_type)
+    else:
+        media_type = None
+    if media_type is None:
+        return JSONResponse(
+            status_code=status.HTTP_404_NOT_FOUND,
+            content={"status": "Error", "details": "Media not found"},
+        )
+    etag = f'"{sha}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=dict(CACHE_HEADERS, ETag=etag))
+    # FileResponse answers Range requests with 206 partial content.
+    return FileResponse(path, media_type=media_type, headers=dict(CACHE_HEADERS, ETag=etag))
+
+
+@media_route.get("/{sha}")
+async def get_media(sha: str, request: Request):
+    """A cached image, addressed by the hex SHA-256 of its decrypted content."""
+    return await _serve(request, sha, media_path(sha))
+
+
+@media_route.get("/{sha}/thumbnail")
+async def get_media_thumbnail(sha: str, request: Request):
+    """JPEG thumbnail of a cached image."""
+    return await _serve(request, sha, thumbnail_path(sha), "image/jpeg")
@@ -5,236 +5,421 @@ from fastapi import (
     Request,
     WebSocket,
     WebSocketDisconnect,
+    status,
 )
 from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
+from typing import Optional
 import json
+import logging
 
-from app.database import get_db
-from app.models import message, contact, image_message
+from app.admission import WEBHOOK_OUTGOING_SHARE, WEBHOOK_RETRY_AFTER, webhook_admission
+from app.broadcast import create_broadcast_backend
+from app.bulk_load import load_stream
+from app.change_versions import bump_committed, message_scopes
+from app.contact_cache import known_contacts
+from app.database import get_db, get_read_db
+from app.dedupe import recent_messages
+from app.ingestion import (
+    INGEST_QUEUE_SIZE,
+    WEBHOOK_MODE,
+    batch_writer,
+    message_payload,
+    parse_webhook_payload,
+    write_batch,
+)
+from app.media import media_cache
+from app.metrics import REJECTIONS, WEBSOCKET_CONNECTIONS
+from app.models import message, contact, image_message, timeline
+from app.pagination import decode_cursor, encode_cursor
+from app.response_cache import dashboard_cache
+from app.routes.media_router import media_urls
+from app.search import highlight_substring, search_query
+from app.timeline import with_details
 from app.websocket_manager import connection_manager
 
+logger = logging.getLogger(__name__)
+
 message_route = APIRouter(tags=["Message"])
 manager = connection_manager()
+broadcaster = create_broadcast_backend(manager)
+WEBSOCKET_CONNECTIONS.set_function(lambda: len(manager.active_connections))
 
+# In queue mode outgoing echoes may only fill this much of the ingestion
+# queue; the rest is kept for incoming messages.
+OUTGOING_QUEUE_LIMIT = int(INGEST_QUEUE_SIZE * WEBHOOK_OUTGOING_SHARE)
 
-async def _broadcast(payload: dict) -> None:
-    """Send a message to all connected websocket clients."""
-    await manager.broadcast(json.dumps(payload))
 
+async def _broadcast(event: dict) -> None:
+    """Publish a stored message to the websocket clients following its conversation.
 
-def _update_contact(
-    db: Session,
-    whatsapp_id: str,
-    pushname: str,
-    from_me: bool,
-    instance_id: str,
-    contact_id: str,
-) -> None:
-    """Create or update a contact based on the incoming message."""
-    existing = db.query(contact).filter(contact.WhatsappjId == whatsapp_id).first()
-    if existing:
-        if not from_me:
-            existing.pushname = pushname
-            existing.updatedAt = datetime.now()
-    else:
-        new_contact = contact(
-            contactId=contact_id,
-            WhatsappjId=whatsapp_id,
-            pushname=pushname if not from_me else None,
-            instanceId=instance_id,
-        )
-        db.add(new_contact)
+    The message is already committed at this point, so a delivery failure is
+    logged rather than reported back to the webhook caller.
+    """
+    try:
+        await broadcaster.publish(message_payload(event), event["instance_id"], event["whatsapp_id"])
+    except Exception:
+        logger.exception("Failed to broadcast message %s", event["message_id"])
 
 
-async def _handle_text_message(
-    db: Session,
-    *,
-    instance_id: str,
-    message_id: str,
-    whatsapp_id: str,
-    message_type: str,
-    pushname: str,
-    datetime_obj: datetime,
-    content: str,
-) -> None:
-    msg = message(
-        messageId=message_id,
-        datetime=datetime_obj,
-        WhatsappjId=whatsapp_id,
-        Message_Type=message_type,
-        Message_Content=content,
-        instanceId=instance_id,
-    )
-    db.add(msg)
-    await _broadcast(
-        {
-            "messageId": message_id,
-            "WhatsappjId": whatsapp_id,
-            "Message_Type": message_type,
-            "Message_Content": content,
-            "contact": pushname,
-            "datetime": datetime_obj.isoformat(),
-        }
-    )
+async def _on_batch_committed(events: list) -> None:
+    """Invalidate cached dashboards, queue media and push a committed batch to websocket clients."""
+    for instance_id in {event["instance_id"] for event in events}:
+        dashboard_cache.invalidate(instance_id)
+    for event in events:
+        if event["kind"] == "image":
+            media_cache.submit(event["img_data"])
+        if event["kind"] is not None:
+            await _broadcast(event)
 
 
-async def _handle_image_message(
-    db: Session,
-    *,
-    instance_id: str,
-    message_id: str,
-    whatsapp_id: str,
-    message_type: str,
-    pushname: str,
-    datetime_obj: datetime,
-    img_data: dict,
-) -> None:
-    img_msg = image_message(
-        id=message_id,
-        messageId=message_id,
-        WhatsappjId=whatsapp_id,
-        instanceId=instance_id,
-        datetime=datetime_obj,
-        url=img_data.get("url"),
-        mimetype=img_data.get("mimetype"),
-        caption=img_data.get("caption"),
-        fileSha256=img_data.get("fileSha256"),
-        fileLength=img_data.get("fileLength"),
-        height=img_data.get("height"),
-        width=img_data.get("width"),
-        mediaKey=img_data.get("mediaKey"),
-        fileEncSha256=img_data.get("fileEncSha256"),
-        Message_Type=message_type,
-    )
-    db.add(img_msg)
-    await _broadcast(
-        {
-            "messageId": message_id,
-            "WhatsappjId": whatsapp_id,
-            "Message_Type": message_type,
-            "Image_URL": img_data.get("url"),
-            "contact": pushname,
-            "datetime": datetime_obj.isoformat(),
-        }
-    )
+ingestion_queue = batch_writer(on_commit=_on_batch_committed)
+
+
+def _handle_ws_command(websocket: WebSocket, text: str) -> None:
+    """Apply a subscribe/unsubscribe command sent by a websocket client.
+
+    Commands look like ``{"action": "subscribe", "instanceId": "...",
+    "WhatsappjId": ["..."]}``; without WhatsappjId the whole instance is
+    (un)subscribed. ``{"action": "resume", "last_seq": {"<instanceId>": N}}``
+    replays missed events for the current subscriptions.
+    """
+    try:
+        command = json.loads(text)
+        action = command["action"]
+        if action == "resume":
+            last_seq = command["last_seq"]
+            if isinstance(last_seq, dict):
+                last_seq = {str(instance_id): int(seq) for instance_id, seq in last_seq.items()}
+            else:
+                last_seq = int(last_seq)
+            manager.resume(websocket, last_seq)
+            return
+        instance_id = command["instanceId"]
+        whatsapp_ids = command.get("WhatsappjId") or []
+        if isinstance(whatsapp_ids, str):
+            whatsapp_ids = [whatsapp_ids]
+        if not isinstance(instance_id, str) or not (
+            isinstance(whatsapp_ids, list) and all(isinstance(whatsapp_id, str) for whatsapp_id in whatsapp_ids)
+        ):
+            raise TypeError("instanceId must be a string and WhatsappjId a string or a list of strings")
+    except (ValueError, TypeError, KeyError):
+        manager.send(websocket, json.dumps({"type": "error", "details": "Invalid command"}))
+        return
+    if action == "subscribe":
+        manager.subscribe(websocket, instance_id, whatsapp_ids)
+    elif action == "unsubscribe":
+        manager.unsubscribe(websocket, instance_id, whatsapp_ids)
+    else:
+        manager.send(websocket, json.dumps({"type": "error", "details": f"Unknown action {action}"}))
+        return
+    manager.send(websocket, json.dumps({
+        "type": f"{action}d",
+        "instanceId": instance_id,
+        "WhatsappjId": whatsapp_ids,
+        "last_seq": manager.position(instance_id),
+    }))
+
 
 @message_route.websocket("/ws/mensagens")
 async def websocket_endpoint(websocket: WebSocket):
+    """Live message feed.
+
+    Connect with ``?instanceId=...`` (and optionally repeated
+    ``&WhatsappjId=...``) or send subscribe commands to receive only those
+    conversations; a client that never subscribes receives every message.
+    Adding ``last_seq=N`` (with ``instanceId``) replays what was missed
+    since event N, or answers ``resync_required`` when the gap is no longer
+    buffered.
+    """
     await manager.connect(websocket)
+    instance_id = websocket.query_params.get("instanceId")
+    if instance_id:
+        manager.subscribe(websocket, instance_id, websocket.query_params.getlist("WhatsappjId"))
+    last_seq = websocket.query_params.get("last_seq")
+    if last_seq is not None and last_seq.isdigit():
+        manager.resume(websocket, int(last_seq))
     try:
         while True:
-            await websocket.receive_text()
-    except WebSocketDisconnect:
+            _handle_ws_command(websocket, await websocket.receive_text())
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError: the manager already closed a slow consumer.
+        pass
+    finally:
         manager.disconnect(websocket)
 
+
+def _history_query(
+    instance_id: str,
+    whatsapp_id: str,
+    limit: int,
+    before: Optional[tuple] = None,
+    after: Optional[tuple] = None,
+):
+    """One page of a conversation read from the timeline.
+
+    The page is a single ordered range scan of the timeline primary key
+    (instanceId, WhatsappjId, datetime, messageId); details are joined only
+    for the rows of the page. Pages walk backwards from ``before`` (or the
+    newest message) unless ``after`` is given.
+    """
+    position = tuple_(timeline.datetime, timeline.messageId)
+    page = select(
+        timeline.kind,
+        timeline.messageId,
+        timeline.WhatsappjId,
+        timeline.Message_Type,
+        timeline.datetime,
+    ).where(
+        timeline.instanceId == instance_id,
+        timeline.WhatsappjId == whatsapp_id,
+    )
+    # The plain datetime bound keeps the predicate sargable for the index
+    # and lets the planner skip older (or newer) monthly partitions; the
+    # row comparison breaks ties between messages of the same second.
+    if before is not None:
+        page = page.where(timeline.datetime <= before[0], position < tuple_(*before))
+    if after is not None:
+        page = page.where(timeline.datetime >= after[0], position > tuple_(*after))
+        page = page.order_by(timeline.datetime.asc(), timeline.messageId.asc())
+    else:
+        page = page.order_by(timeline.datetime.desc(), timeline.messageId.desc())
+    page = page.limit(limit + 1).subquery()
+
+    if after is not None:
+        order = (page.c.datetime.asc(), page.c.messageId.asc())
+    else:
+        order = (page.c.datetime.desc(), page.c.messageId.desc())
+    return (
+        select(
+            page.c.kind.label("type"),
+            page.c.messageId,
+            page.c.WhatsappjId,
+            page.c.Message_Type,
+            page.c.datetime,
+            message.Message_Content,
+            image_message.url.label("image_url"),
+            image_message.caption,
+            image_message.mimetype,
+            image_message.height,
+            image_message.width,
+            image_message.fileSha256,
+        )
+        .select_from(with_details(page))
+        .order_by(*order)
+    )
+
+
 @message_route.get("/messages")
-def get_messages(instanceId: str = Query(...), contact_number: str = Query(...), db: Session = Depends(get_db)):
+async def get_messages(
+    instanceId: str = Query(...),
+    contact_number: str = Query(...),
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_read_db),
+):
     try:
-        whatsapp_id = f"{contact_number}@s.whatsapp.net"
-        text_messages = (
-            db.query(message)
-            .filter(
-                message.instanceId == instanceId,
-                message.WhatsappjId == whatsapp_id
-            )
-            .order_by(message.datetime.asc())
-            .all()
+        if before and after:
+            raise ValueError("Use either before or after, not both")
+        before_position = decode_cursor(before) if before else None
+        after_position = decode_cursor(after) if after else None
+    except ValueError as e:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"status": "Error", "details": str(e)},
         )
-        image_messages = (
-            db.query(image_message)
-            .filter(
-                image_message.instanceId == instanceId,
-                image_message.WhatsappjId == whatsapp_id
+    try:
+        whatsapp_id = f"{contact_number}@s.whatsapp.net"
+        rows = (
+            await db.execute(
+                _history_query(instanceId, whatsapp_id, limit, before_position, after_position)
             )
-            .order_by(image_message.datetime.asc())
-            .all()
-        )
+        ).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after_position is None:
+            rows.reverse()
+        pushname = await db.scalar(select(contact.pushname).where(contact.WhatsappjId == whatsapp_id))
+
+        urls = iter(await media_urls(row.fileSha256 for row in rows if row.type != "text"))
         all_messages = []
-        for msg in text_messages:
-            contact = db.query(contact).filter(contact.WhatsappjId == msg.WhatsappjId).first()
-            all_messages.append({
-                "type": "text",
-                "messageId": msg.messageId,
-                "WhatsappjId": msg.WhatsappjId,
-                "Message_Type": msg.Message_Type,
-                "Message_Content": msg.Message_Content,
-                "contact": contact.pushname if contact else "",
-                "datetime": msg.datetime.isoformat()
-            })
-        for img in image_messages:
-            contact = db.query(contact).filter(contact.WhatsappjId == img.WhatsappjId).first()
-            all_messages.append({
-                "type": "image",
-                "messageId": img.messageId,
-                "WhatsappjId": img.WhatsappjId,
-                "Message_Type": img.message_type,
-                "image_url": img.url,
-                "caption": img.caption,
-                "contact": contact.pushname if contact else "",
-                "datetime": img.datetime.isoformat(),
-                "mimetype": img.mimetype,
-                "height": img.height,
-                "width": img.width
-            })
-        all_messages.sort(key=lambda x: x["datetime"])
-        return JSONResponse(content={"status": "Success", "messages": all_messages})
+        for row in rows:
+            item = {
+                "type": row.type,
+                "messageId": row.messageId,
+                "WhatsappjId": row.WhatsappjId,
+                "Message_Type": row.Message_Type,
+                "contact": pushname or "",
+                "datetime": row.datetime.isoformat(),
+            }
+            if row.type == "text":
+                item["Message_Content"] = row.Message_Content
+            else:
+                item.update({
+                    "image_url": row.image_url,
+                    "caption": row.caption,
+                    "mimetype": row.mimetype,
+                    "height": row.height,
+                    "width": row.width,
+                    "media_url": next(urls),
+                })
+            all_messages.append(item)
+
+        return JSONResponse(content={
+            "status": "Success",
+            "messages": all_messages,
+            "has_more": has_more,
+            "before_cursor": encode_cursor(rows[0].datetime, rows[0].messageId) if rows else None,
+            "after_cursor": encode_cursor(rows[-1].datetime, rows[-1].messageId) if rows else None,
+        })
+    except Exception as e:
+        return JSONResponse(content={"status": "Error", "details": str(e)})
+
+@message_route.get("/messages/search")
+async def search_messages(
+    instanceId: str = Query(...),
+    q: str = Query(..., min_length=1, max_length=200),
+    contact_number: Optional[str] = Query(None),
+    start: Optional[datetime] = Query(None),
+    end: Optional[datetime] = Query(None),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """Ranked, highlighted search over message text and image captions."""
+    # Message datetimes are stored as naive local time.
+    if start is not None and start.tzinfo is not None:
+        start = start.astimezone().replace(tzinfo=None)
+    if end is not None and end.tzinfo is not None:
+        end = end.astimezone().replace(tzinfo=None)
+    q = q.strip()
+    if not q or (start is not None and end is not None and start >= end):
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"status": "Error", "details": "Empty query or start not before end"},
+        )
+    try:
+        whatsapp_id = f"{contact_number}@s.whatsapp.net" if contact_number else None
+        rows = (
+            await db.execute(search_query(instanceId, q, limit, offset, whatsapp_id, start, end))
+        ).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        pushnames = {}
+        if rows:
+            pushnames = dict((
+                await db.execute(
+                    select(contact.WhatsappjId, contact.pushname)
+                    .where(contact.WhatsappjId.in_({row.WhatsappjId for row in rows}))
+                )
+            ).all())
+        results = [
+            {
+                "type": row.type,
+                "messageId": row.messageId,
+                "WhatsappjId": row.WhatsappjId,
+                "contact_number": row.WhatsappjId.replace("@s.whatsapp.net", ""),
+                "contact": pushnames.get(row.WhatsappjId) or "",
+                "Message_Type": row.Message_Type,
+                "datetime": row.datetime.isoformat(),
+                "rank": row.rank,
+                "highlight": highlight_substring(row.content, row.highlight, q),
+            }
+            for row in rows
+        ]
+        return JSONResponse(content={
+            "status": "Success",
+            "results": results,
+            "has_more": has_more,
+            "next_offset": offset + limit if has_more else None,
+        })
     except Exception as e:
         return JSONResponse(content={"status": "Error", "details": str(e)})
 
+def _busy(details: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"status": "error", "details": details},
+        headers={"Retry-After": str(WEBHOOK_RETRY_AFTER)},
+    )
+
+
 @message_route.post("/webhook/mensagens")
-async def webhook_mensagens(request: Request, db: Session = Depends(get_db)):
+async def webhook_mensagens(request: Request, db: AsyncSession = Depends(get_db)):
     data = await request.json()
     try:
-        data_block = data.get('data', {})
-        instanceId = data_block.get('instanceId')
-        messageId = data_block.get('key', {}).get('id')
-        WhatsappjId = data_block.get('key', {}).get('remoteJid')
-        fromMe = data_block.get('key', {}).get('fromMe', False)
-        Message_Type = "Outgoing" if fromMe else "Incoming"
-        pushname = data_block.get('pushName')
-        message_data = data_block.get('message', {})
-        timestamp_unix = data_block.get('messageTimestamp')
-        datetime_obj = datetime.fromtimestamp(timestamp_unix) if timestamp_unix else datetime.now()
-        if "conversation" in message_data:
-            content = message_data.get("conversation", "")
-            await _handle_text_message(
-                db,
-                instance_id=instanceId,
-                message_id=messageId,
-                whatsapp_id=WhatsappjId,
-                message_type=Message_Type,
-                pushname=pushname,
-                datetime_obj=datetime_obj,
-                content=content,
-            )
-        elif "imageMessage" in message_data:
-            await _handle_image_message(
-                db,
-                instance_id=instanceId,
-                message_id=messageId,
-                whatsapp_id=WhatsappjId,
-                message_type=Message_Type,
-                pushname=pushname,
-                datetime_obj=datetime_obj,
-                img_data=message_data.get("imageMessage", {}),
-            )
+        event = parse_webhook_payload(data)
+    except (ValueError, TypeError) as e:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"status": "error", "details": str(e)},
+        )
 
-        _update_contact(
-            db,
-            whatsapp_id=WhatsappjId,
-            pushname=pushname,
-            from_me=fromMe,
-            instance_id=instanceId,
-            contact_id=messageId,
+    # Retries of a message this worker already accepted are answered
+    # without touching the database or the websocket clients.
+    if event["message_id"] in recent_messages:
+        return {"status": "success", "duplicate": True}
+
+    # Shed load before any database work, so a slow Postgres is answered
+    # with fast 503s instead of requests queueing on the connection pool.
+    if not await webhook_admission.acquire(event["instance_id"], event["from_me"]):
+        return _busy("Too many webhook requests in flight")
+    try:
+        if WEBHOOK_MODE == "queue":
+            if event["from_me"] and ingestion_queue.qsize() >= OUTGOING_QUEUE_LIMIT:
+                REJECTIONS.inc(priority="outgoing", reason="queue")
+                return _busy("Ingestion queue is reserved for incoming messages")
+            if not ingestion_queue.submit(event):
+                REJECTIONS.inc(priority="outgoing" if event["from_me"] else "incoming", reason="queue")
+                return _busy("Ingestion queue is full")
+            recent_messages.add(event["message_id"])
+            return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={"status": "accepted"})
+
+        try:
+            stored, contacts = await write_batch(db, [event])
+            await db.commit()
+            known_contacts.put_many(contacts)
+            await bump_committed(db, message_scopes([event], stored, contacts))
+            recent_messages.add(event["message_id"])
+            if not stored and event["kind"] is not None:
+                return {"status": "success", "duplicate": True}
+            dashboard_cache.invalidate(event["instance_id"])
+            if event["kind"] == "image":
+                media_cache.submit(event["img_data"])
+            if event["kind"] is not None:
+                await _broadcast(event)
+            return {"status": "success"}
+        except Exception as e:
+            await db.rollback()
+            return {"status": "error", "details": str(e)}
+    finally:
+        webhook_admission.release(event["instance_id"])
+
+
+async def _on_history_committed(events: list) -> None:
+    """History is not pushed to websockets; only the cached dashboards and media change."""
+    for instance_id in {event["instance_id"] for event in events}:
+        dashboard_cache.invalidate(instance_id)
+    for event in events:
+        if event["kind"] == "image":
+            media_cache.submit(event["img_data"], history=True)
+
+
+@message_route.post("/webhook/mensagens/bulk")
+async def webhook_mensagens_bulk(request: Request, instanceId: Optional[str] = Query(None)):
+    """Load a history sync: a JSON array or NDJSON of Evolution message payloads."""
+    summary = await load_stream(request.stream(), instanceId, on_commit=_on_history_committed)
+    if "malformed" in summary:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"status": "Error", "details": summary.pop("malformed"), "summary": summary},
         )
-        db.commit()
-        return {"status": "success"}
-    except IntegrityError as e:
-        db.rollback()
-        return {"status": "error", "details": str(e)}
-    except Exception as e:
-        db.rollback()
-        return {"status": "error", "details": str(e)}
+    if "failed" in summary:
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"status": "Error", "details": summary.pop("failed"), "summary": summary},
+        )
+    return JSONResponse(content={"status": "Success", "summary": summary})
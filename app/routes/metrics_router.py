@@ -0,0 +1,12 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from app.metrics import CONTENT_TYPE, render_metrics
+
+metrics_route = APIRouter(tags=["Metrics"])
+
+
+@metrics_route.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus metrics of this worker process."""
+    return PlainTextResponse(render_metrics(), media_type=CONTENT_TYPE)
@@ -0,0 +1,154 @@
+"""Full-text and substring search over message text and image captions.
+
+Words are matched through the ``to_tsvector`` GIN indexes and ranked with
+``ts_rank_cd``; fragments such as partial phone numbers or order codes go
+through the trigram indexes. Highlights are computed only for the returned
+page. Indexes missing from databases created before search existed are
+added with::
+
+    python -m app.search create-indexes
+"""
+import argparse
+import html
+import re
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import Float, String, cast, func, literal, literal_column, or_, select, union_all
+
+from app.database import get_engine
+from app.models import SEARCH_CONFIG, image_message, message
+
+# ts_headline marks matches with control characters that are stripped from
+# the text first; the snippet is HTML-escaped before they become <mark> tags.
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_STOP = "\x03"
+HEADLINE_OPTIONS = f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxWords=25, MinWords=10, MaxFragments=2"
+
+# Shortest fragment the trigram indexes can serve.
+MIN_SUBSTRING_LENGTH = 3
+
+_config = literal_column(f"'{SEARCH_CONFIG}'::regconfig")
+
+
+def _vector(column):
+    # Must match the indexed expression exactly, constants included.
+    return func.to_tsvector(_config, func.coalesce(column, literal_column("''")))
+
+
+def _like_pattern(q: str) -> str:
+    return "%" + re.sub(r"([\\%_])", r"\\\1", q) + "%"
+
+
+def search_query(
+    instance_id: str,
+    q: str,
+    limit: int,
+    offset: int,
+    whatsapp_id: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    """Ranked page of matching text messages and image captions.
+
+    Each table contributes its own ranked top ``offset + limit + 1`` rows;
+    headlines are computed on the merged page only.
+    """
+    query = func.websearch_to_tsquery(_config, q)
+    branches = []
+    for kind, table, column in (
+        ("text", message, message.Message_Content),
+        ("image", image_message, image_message.caption),
+    ):
+        match = _vector(column).op("@@")(query)
+        if len(q) >= MIN_SUBSTRING_LENGTH:
+            match = or_(match, column.ilike(_like_pattern(q)))
+        rank = func.ts_rank_cd(_vector(column), query)
+        branch = select(
+            literal(kind, String).label("type"),
+            table.messageId,
+            table.WhatsappjId,
+            table.Message_Type,
+            table.datetime,
+            column.label("content"),
+            cast(rank, Float).label("rank"),
+        ).where(table.instanceId == instance_id, match)
+        if whatsapp_id is not None:
+            branch = branch.where(table.WhatsappjId == whatsapp_id)
+        # Plain range predicates so only the relevant partitions are searched.
+        if start is not None:
+            branch = branch.where(table.datetime >= start)
+        if end is not None:
+            branch = branch.where(table.datetime < end)
+        order = (rank.desc(), table.datetime.desc(), table.messageId.desc())
+        branches.append(branch.order_by(*order).limit(offset + limit + 1))
+
+    merged = union_all(*(b.subquery().select() for b in branches)).subquery()
+    page = (
+        select(merged)
+        .order_by(merged.c.rank.desc(), merged.c.datetime.desc(), merged.c.messageId.desc())
+        .offset(offset)
+        .limit(limit + 1)
+        .subquery()
+    )
+    return select(
+        page,
+        func.ts_headline(
+            _config,
+            func.translate(func.coalesce(page.c.content, ""), HIGHLIGHT_START + HIGHLIGHT_STOP, ""),
+            query,
+            HEADLINE_OPTIONS,
+        ).label("highlight"),
+    ).order_by(page.c.rank.desc(), page.c.datetime.desc(), page.c.messageId.desc())
+
+
+def highlight_substring(text: Optional[str], headline: str, q: str) -> str:
+    """HTML snippet of a result, with matches in ``<mark>`` and everything else escaped.
+
+    Marks a substring match when the word-based headline found none.
+    """
+    position = -1 if text is None or HIGHLIGHT_START in headline else text.lower().find(q.lower())
+    if position < 0:
+        return (
+            html.escape(headline)
+            .replace(HIGHLIGHT_START, "<mark>")
+            .replace(HIGHLIGHT_STOP, "</mark>")
+        )
+    begin = max(0, position - 60)
+    stop = min(len(text), position + len(q) + 60)
+    return (
+        ("..." if begin else "")
+        + html.escape(text[begin:position])
+        + "<mark>" + html.escape(text[position:position + len(q)]) + "</mark>"
+        + html.escape(text[position + len(q):stop])
+        + ("..." if stop < len(text) else "")
+    )
+
+
+def create_indexes() -> int:
+    """Create the search extensions and any missing search index."""
+    created = 0
+    with get_engine().begin() as conn:
+        conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS btree_gin")
+        for table in (message.__table__, image_message.__table__):
+            for index in table.indexes:
+                if index.name.endswith(("_search", "_trgm")):
+                    index.create(conn, checkfirst=True)
+                    created += 1
+    return created
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.search")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("create-indexes", help="create the full-text and trigram indexes")
+    args = parser.parse_args(argv)
+
+    if args.command == "create-indexes":
+        count = create_indexes()
+        print(f"Checked {count} search index(es)")
+
+
+if __name__ == "__main__":
+    main()
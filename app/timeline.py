@@ -0,0 +1,177 @@
+"""Unified conversation timeline.
+
+Every stored message gets a ``timeline`` row in the same transaction, so a
+conversation (or an instance) is read with one ordered range scan whatever
+the message kinds, and details are joined only for the rows returned. The
+``conversation`` table keeps the latest of those rows per conversation for
+the conversation list.
+Messages stored before the timeline existed are loaded with::
+
+    python -m app.timeline backfill
+"""
+import argparse
+from datetime import date
+from typing import List, Optional
+
+from sqlalchemy import and_, func, literal, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.database import get_engine
+from app.models import conversation, image_message, message, timeline
+from app.partitions import ensure_months, month_start, next_month
+
+# Detail table of each kind, with the column holding its messageId.
+DETAIL_TABLES = {
+    "text": (message, message.messageId),
+    "image": (image_message, image_message.id),
+}
+
+
+def timeline_row(event: dict) -> dict:
+    return {
+        "instanceId": event["instance_id"],
+        "WhatsappjId": event["whatsapp_id"],
+        "datetime": event["datetime_obj"],
+        "messageId": event["message_id"],
+        "kind": event["kind"],
+        "Message_Type": event["message_type"],
+    }
+
+
+CONVERSATION_COLUMNS = ["instanceId", "WhatsappjId", "datetime", "messageId", "kind"]
+
+
+def _upsert_conversations(stmt):
+    """Turn an insert into conversation into an upsert that only moves rows forward."""
+    newer = tuple_(stmt.excluded.datetime, stmt.excluded.messageId) > tuple_(
+        conversation.datetime, conversation.messageId
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[conversation.instanceId, conversation.WhatsappjId],
+        set_={column: stmt.excluded[column] for column in ("datetime", "messageId", "kind")},
+        where=newer,
+    )
+
+
+def refresh_conversations(source):
+    """Upsert statement moving each conversation to its latest row in ``source``.
+
+    ``source`` is a subquery with the timeline columns; rows come out ordered
+    by conversation, so concurrent refreshes lock them in the same order.
+    """
+    latest = (
+        select(*(source.c[column] for column in CONVERSATION_COLUMNS))
+        .distinct(source.c.instanceId, source.c.WhatsappjId)
+        .order_by(
+            source.c.instanceId, source.c.WhatsappjId, source.c.datetime.desc(), source.c.messageId.desc()
+        )
+    )
+    return _upsert_conversations(pg_insert(conversation).from_select(CONVERSATION_COLUMNS, latest))
+
+
+async def record_timeline(db, events: List[dict]) -> None:
+    """Add stored message events to the timeline and the conversation list."""
+    rows = [timeline_row(event) for event in events if event["kind"] is not None]
+    if not rows:
+        return
+    await db.execute(pg_insert(timeline).values(rows).on_conflict_do_nothing())
+    latest = {}
+    for row in rows:
+        key = (row["instanceId"], row["WhatsappjId"])
+        current = latest.get(key)
+        if current is None or (row["datetime"], row["messageId"]) > (current["datetime"], current["messageId"]):
+            latest[key] = row
+    await db.execute(_upsert_conversations(pg_insert(conversation).values(
+        [{column: latest[key][column] for column in CONVERSATION_COLUMNS} for key in sorted(latest)]
+    )))
+
+
+def with_details(page):
+    """Join a page of timeline rows (a subquery) to the detail tables of its kinds."""
+    joined = page
+    for kind, (table, message_id) in DETAIL_TABLES.items():
+        joined = joined.outerjoin(
+            table,
+            and_(
+                page.c.kind == kind,
+                message_id == page.c.messageId,
+                table.datetime == page.c.datetime,
+            ),
+        )
+    return joined
+
+
+def backfill_month(conn, month: date, conversations: bool = True) -> int:
+    """Insert the timeline rows of one month and move the conversations they touch."""
+    start, end = month_start(month), next_month(month)
+    inserted = 0
+    for kind, (table, message_id) in DETAIL_TABLES.items():
+        rows = select(
+            table.instanceId,
+            table.WhatsappjId,
+            table.datetime,
+            message_id,
+            literal(kind),
+            table.Message_Type,
+        ).where(table.datetime >= start, table.datetime < end)
+        inserted += conn.execute(
+            pg_insert(timeline)
+            .from_select(["instanceId", "WhatsappjId", "datetime", "messageId", "kind", "Message_Type"], rows)
+            .on_conflict_do_nothing()
+        ).rowcount
+    if conversations:
+        conn.execute(refresh_conversations(
+            select(timeline).where(timeline.datetime >= start, timeline.datetime < end).subquery()
+        ))
+    return inserted
+
+
+def backfill_conversations() -> None:
+    """Fill the conversation list from the whole timeline, in one transaction."""
+    with get_engine().begin() as conn:
+        conn.execute(refresh_conversations(timeline.__table__.alias("source")))
+
+
+def backfill(since: Optional[date] = None, until: Optional[date] = None, conversations: bool = True) -> int:
+    """Backfill the timeline month by month, one transaction per month.
+
+    Without ``conversations`` the conversation list is left alone, for
+    databases that do not have it yet.
+    """
+    if since is None:
+        with get_engine().connect() as conn:
+            firsts = [
+                conn.scalar(select(func.min(table.datetime)))
+                for table, _ in DETAIL_TABLES.values()
+            ]
+        firsts = [first for first in firsts if first is not None]
+        if not firsts:
+            return 0
+        since = min(firsts).date()
+    until = until or date.today()
+
+    inserted = 0
+    month = month_start(since)
+    while month <= until:
+        ensure_months([month])
+        with get_engine().begin() as conn:
+            inserted += backfill_month(conn, month, conversations)
+        month = next_month(month)
+    return inserted
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.timeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill_cmd = commands.add_parser("backfill", help="fill the timeline from the message tables")
+    backfill_cmd.add_argument("--since", type=date.fromisoformat, help="first day (default: oldest message)")
+    backfill_cmd.add_argument("--until", type=date.fromisoformat, help="last day (default: today)")
+    args = parser.parse_args(argv)
+
+    if args.command == "backfill":
+        rows = backfill(args.since, args.until)
+        print(f"Backfilled {rows} timeline row(s)")
+
+
+if __name__ == "__main__":
+    main()
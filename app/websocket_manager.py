@@ -1,17 +1,289 @@
-from typing import List
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple, Union
 from fastapi import WebSocket
 
+from app.metrics import BROADCAST_DELIVERIES, BROADCAST_FANOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+WS_REPLAY_BUFFER_SIZE = int(os.getenv("WS_REPLAY_BUFFER_SIZE", "1000"))
+
+# "Try again later": the client was too slow to keep up with the stream.
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class _client:
+    """A connected websocket with its own bounded outbound queue."""
+
+    def __init__(self, websocket: WebSocket, queue_size: int):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.task: asyncio.Task = None
+        self.instances: Set[str] = set()
+        self.conversations: Set[Tuple[str, str]] = set()
+
+
+class replay_buffer:
+    """Recent events of one instance, kept so reconnecting clients can catch up.
+
+    ``evicted_upto`` is the highest sequence number no longer held; a client
+    whose last seen sequence is below it has missed events for good.
+    ``last_seq`` is the newest sequence number of the instance.
+    """
+
+    def __init__(self, size: int, floor: int):
+        self.events: Deque[Tuple[int, str, str]] = deque()
+        self.size = size
+        self.evicted_upto = floor
+        self.last_seq = floor
+
+    def append(self, seq: int, whatsapp_id: str, message: str) -> None:
+        if len(self.events) >= self.size:
+            self.evicted_upto = self.events.popleft()[0]
+        self.events.append((seq, whatsapp_id, message))
+        self.last_seq = max(self.last_seq, seq)
+
+    def raise_floor(self, floor: int) -> None:
+        while self.events and self.events[0][0] <= floor:
+            self.events.popleft()
+        self.evicted_upto = max(self.evicted_upto, floor)
+        self.last_seq = max(self.last_seq, floor)
+
+    def since(self, last_seq: int) -> List[Tuple[int, str, str]]:
+        return [event for event in self.events if event[0] > last_seq]
+
+
 class connection_manager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    """Fan messages out to websockets without ever waiting on a client.
+
+    Each connection is drained by its own sender task, so broadcast only
+    enqueues. A client whose queue overflows, or whose send does not finish
+    within the deadline, is disconnected.
+
+    Clients may subscribe to whole instances or to single conversations
+    (instanceId, WhatsappjId); publish only reaches the interested sockets.
+    Clients that never subscribed keep receiving everything.
+
+    Every published event carries a ``seq``, increasing per instance, and is
+    kept in a per-instance replay buffer, so a client reconnecting with the
+    last ``seq`` it saw of each instance gets only what it missed. When the
+    numbers come from outside (the postgres broadcast backend) the local
+    counters are unused.
+    """
+
+    def __init__(
+        self,
+        queue_size: int = WS_SEND_QUEUE_SIZE,
+        send_timeout: float = WS_SEND_TIMEOUT,
+        replay_size: int = WS_REPLAY_BUFFER_SIZE,
+    ):
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.replay_size = replay_size
+        self.active_connections: Dict[WebSocket, _client] = {}
+        self._unsubscribed: Set[_client] = set()
+        self._by_instance: Dict[str, Set[_client]] = {}
+        self._by_conversation: Dict[Tuple[str, str], Set[_client]] = {}
+        self._replay: Dict[str, replay_buffer] = {}
+        # Floor of instances with no event yet. Seeding from the clock keeps
+        # sequence numbers increasing across restarts, and makes anything
+        # older than this process a known gap.
+        self._floor = time.time_ns() // 1000
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = _client(websocket, self.queue_size)
+        client.task = asyncio.create_task(self._sender(client))
+        self.active_connections[websocket] = client
+        self._unsubscribed.add(client)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        client = self.active_connections.pop(websocket, None)
+        if client is None:
+            return
+        self._unsubscribed.discard(client)
+        self._drop(self._by_instance, client.instances, client)
+        self._drop(self._by_conversation, client.conversations, client)
+        if client.task is not asyncio.current_task():
+            client.task.cancel()
+
+    def subscribe(self, websocket: WebSocket, instance_id: str, whatsapp_ids: Optional[Iterable[str]] = None) -> None:
+        """Follow a whole instance, or only the given conversations of it."""
+        client = self.active_connections.get(websocket)
+        if client is None:
+            return
+        if whatsapp_ids:
+            for whatsapp_id in whatsapp_ids:
+                key = (instance_id, whatsapp_id)
+                client.conversations.add(key)
+                self._by_conversation.setdefault(key, set()).add(client)
+        else:
+            client.instances.add(instance_id)
+            self._by_instance.setdefault(instance_id, set()).add(client)
+        self._unsubscribed.discard(client)
+
+    def unsubscribe(self, websocket: WebSocket, instance_id: str, whatsapp_ids: Optional[Iterable[str]] = None) -> None:
+        """Stop following an instance (and all its conversations) or some conversations."""
+        client = self.active_connections.get(websocket)
+        if client is None:
+            return
+        if whatsapp_ids:
+            keys = {(instance_id, whatsapp_id) for whatsapp_id in whatsapp_ids}
+        else:
+            keys = {key for key in client.conversations if key[0] == instance_id}
+            self._drop(self._by_instance, {instance_id}, client)
+            client.instances.discard(instance_id)
+        self._drop(self._by_conversation, keys, client)
+        client.conversations -= keys
+
+    def broadcast(self, message: str) -> None:
+        """Queue a message for every connection; never blocks."""
+        for client in list(self.active_connections.values()):
+            self._enqueue(client, message)
+
+    def publish(self, payload: dict, instance_id: str, whatsapp_id: str, seq: Optional[int] = None) -> int:
+        """Serialize once and queue for the sockets interested in this conversation.
+
+        Returns the number of clients the message was queued for.
+        """
+        buffer = self._buffer(instance_id)
+        if seq is None:
+            seq = buffer.last_seq + 1
+        message = json.dumps(dict(payload, seq=seq))
+        buffer.append(seq, whatsapp_id, message)
+
+        started = time.perf_counter()
+        targets = set(self._unsubscribed)
+        targets.update(self._by_instance.get(instance_id, ()))
+        targets.update(self._by_conversation.get((instance_id, whatsapp_id), ()))
+        for client in targets:
+            self._enqueue(client, message)
+        BROADCAST_FANOUT_SECONDS.observe(time.perf_counter() - started)
+        BROADCAST_DELIVERIES.inc(len(targets))
+        return len(targets)
+
+    def _buffer(self, instance_id: str) -> replay_buffer:
+        buffer = self._replay.get(instance_id)
+        if buffer is None:
+            buffer = self._replay[instance_id] = replay_buffer(self.replay_size, self._floor)
+        return buffer
+
+    def position(self, instance_id: str) -> int:
+        """The last sequence number published for ``instance_id``."""
+        buffer = self._replay.get(instance_id)
+        return buffer.last_seq if buffer is not None else self._floor
+
+    def start_sequence(self, floor: int) -> None:
+        """Take sequence numbers from an external source that starts every instance after ``floor``.
+
+        Replaces the clock-based numbering; call it before anything is published.
+        """
+        self._floor = floor
+        self._replay.clear()
+
+    def reset_floors(self, floors: Dict[str, int]) -> None:
+        """Declare every event up to ``floors[instance]`` unrecoverable (e.g. after a missed stream)."""
+        for instance_id, floor in floors.items():
+            self._buffer(instance_id).raise_floor(floor)
+
+    def resume(self, websocket: WebSocket, last_seq: Union[int, Dict[str, int]]) -> bool:
+        """Replay the events a client missed since its last seen ``seq`` of each instance.
+
+        ``last_seq`` maps instanceId to sequence number; a plain number is
+        accepted from clients following a single instance. Only events
+        matching the client's current subscriptions are sent. Returns False,
+        after telling the client to resync, when part of the gap is no
+        longer buffered or a followed instance has no position.
+        """
+        client = self.active_connections.get(websocket)
+        if client is None:
+            return False
+        everything = client in self._unsubscribed
+        if everything:
+            instance_ids = set(self._replay)
+        else:
+            instance_ids = set(client.instances)
+            instance_ids.update(key[0] for key in client.conversations)
+
+        if isinstance(last_seq, dict):
+            positions = last_seq
+        elif len(instance_ids) == 1:
+            positions = dict.fromkeys(instance_ids, last_seq)
+        else:
+            positions = {}
+
+        if any(self._has_gap(instance_id, positions.get(instance_id)) for instance_id in instance_ids):
+            self._enqueue(client, json.dumps({"type": "resync_required", "last_seq": last_seq}))
+            return False
+
+        replayed = 0
+        for instance_id in instance_ids:
+            buffer = self._replay.get(instance_id)
+            if buffer is None:
+                continue
+            whole_instance = everything or instance_id in client.instances
+            for _, whatsapp_id, message in buffer.since(positions[instance_id]):
+                if whole_instance or (instance_id, whatsapp_id) in client.conversations:
+                    self._enqueue(client, message)
+                    replayed += 1
+        self._enqueue(client, json.dumps({"type": "resumed", "last_seq": last_seq, "replayed": replayed}))
+        return True
+
+    def _has_gap(self, instance_id: str, position: Optional[int]) -> bool:
+        buffer = self._replay.get(instance_id)
+        if buffer is None:
+            # Nothing published yet: only a position from an older process is a gap.
+            return position is not None and position < self._floor
+        return position is None or position < buffer.evicted_upto or position > buffer.last_seq
+
+    def send(self, websocket: WebSocket, message: str) -> None:
+        """Queue a message for a single connection."""
+        client = self.active_connections.get(websocket)
+        if client is not None:
+            self._enqueue(client, message)
+
+    def _enqueue(self, client: _client, message: str) -> None:
+        try:
+            client.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            logger.warning("Disconnecting websocket client: send queue full")
+            self._evict(client)
+
+    @staticmethod
+    def _drop(index: dict, keys: Iterable, client: _client) -> None:
+        for key in keys:
+            clients = index.get(key)
+            if clients is not None:
+                clients.discard(client)
+                if not clients:
+                    del index[key]
+
+    async def _sender(self, client: _client) -> None:
+        try:
+            while True:
+                message = await client.queue.get()
+                await asyncio.wait_for(client.websocket.send_text(message), self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            logger.warning("Disconnecting websocket client: send deadline missed")
+            self._evict(client)
+        except Exception:
+            self._evict(client)
+
+    def _evict(self, client: _client) -> None:
+        self.disconnect(client.websocket)
+        asyncio.ensure_future(self._close(client.websocket))
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
\ No newline at end of file
+    async def _close(self, websocket: WebSocket) -> None:
+        try:
+            await asyncio.wait_for(websocket.close(code=SLOW_CONSUMER_CLOSE_CODE), self.send_timeout)
+        except Exception:
+            pass
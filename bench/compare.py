@@ -0,0 +1,66 @@
+"""Compare two ``bench.load`` result files and flag regressions.
+
+::
+
+    python -m bench.compare baseline.json current.json --threshold 0.15
+
+Exits 1 when an endpoint's p95 latency or queries per request grew, or its
+throughput dropped, by more than the threshold.
+"""
+import argparse
+import json
+import sys
+
+
+def _change(old, new):
+    if old in (None, 0) or new is None:
+        return None
+    return (new - old) / old
+
+
+def compare(baseline: dict, current: dict, threshold: float):
+    """Yield (endpoint, metric, old, new, change, regressed) for every shared endpoint."""
+    checks = (
+        ("p95 ms", lambda e: e["latency_ms"]["p95"], 1),
+        ("p99 ms", lambda e: e["latency_ms"]["p99"], 1),
+        ("queries/req", lambda e: e["queries_per_request"], 1),
+        ("rps", lambda e: e["throughput_rps"], -1),
+    )
+    for endpoint in sorted(set(baseline["endpoints"]) & set(current["endpoints"])):
+        for metric, read, worse in checks:
+            old = read(baseline["endpoints"][endpoint])
+            new = read(current["endpoints"][endpoint])
+            change = _change(old, new)
+            # p99 is reported but too noisy to fail a run on.
+            regressed = change is not None and metric != "p99 ms" and change * worse > threshold
+            yield endpoint, metric, old, new, change, regressed
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m bench.compare")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed relative change, 0.15 = 15%%")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    regressions = 0
+    print(f"{'endpoint':<28}{'metric':<13}{'baseline':>10}{'current':>10}{'change':>9}")
+    for endpoint, metric, old, new, change, regressed in compare(baseline, current, args.threshold):
+        regressions += regressed
+        print(
+            f"{endpoint:<28}{metric:<13}"
+            f"{'-' if old is None else f'{old:.1f}':>10}{'-' if new is None else f'{new:.1f}':>10}"
+            f"{'-' if change is None else f'{change:+.0%}':>9}{'  REGRESSION' if regressed else ''}"
+        )
+    if regressions:
+        print(f"{regressions} regression(s) above {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""Mixed-load benchmark against a running server.
+
+Replays webhooks at a fixed rate while websocket clients follow the live
+feed and readers page through conversations, messages and dashboards::
+
+    uvicorn app.main:app --workers 1 &
+    python -m bench.load --rate 200 --duration 60 --ws-clients 50 --readers 8 --output results.json
+
+Use the same ``--instances``/``--contacts`` as ``bench.seed``. Latency is
+measured by the client; queries per request come from the server's
+``/metrics`` (so run a single worker), sampled before and after the run.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import re
+import subprocess
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import httpx
+import websockets
+
+from bench import synthetic
+
+WEBHOOK = "POST /webhook/mensagens"
+READ_ENDPOINTS = ("GET /conversations", "GET /messages", "GET /dashboard_time")
+
+_METRIC_LINE = re.compile(r'^(nestor_http_request_(?:statements|db_seconds)_(?:sum|count))\{method="([^"]+)",route="([^"]+)"\} (\S+)$')
+
+
+class endpoint_stats:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.statuses: Dict[int, int] = defaultdict(int)
+
+    def record(self, seconds: float, status_code: int) -> None:
+        self.latencies.append(seconds * 1000)
+        self.statuses[status_code] += 1
+        if status_code >= 400:
+            self.errors += 1
+
+    def fail(self) -> None:
+        self.errors += 1
+        self.statuses[0] += 1
+
+
+async def _timed(client: httpx.AsyncClient, stats: endpoint_stats, method: str, url: str, **kwargs) -> None:
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except httpx.HTTPError:
+        stats.fail()
+        return
+    stats.record(time.perf_counter() - started, response.status_code)
+
+
+async def webhook_sender(client, args, stats, sent_at, stop_at) -> int:
+    """Open-loop sender: requests start on schedule whether or not earlier ones finished."""
+    rng = random.Random(args.seed)
+    interval = 1 / args.rate
+    in_flight = asyncio.Semaphore(args.max_in_flight)
+    tasks = set()
+    sent = 0
+    loop = asyncio.get_running_loop()
+    next_at = loop.time()
+
+    async def send(payload):
+        try:
+            sent_at[payload["data"]["key"]["id"]] = time.perf_counter()
+            await _timed(client, stats, "POST", "/webhook/mensagens", json=payload)
+        finally:
+            in_flight.release()
+
+    while loop.time() < stop_at:
+        await in_flight.acquire()
+        payload = synthetic.webhook_payload(rng, args.instances, args.contacts, args.image_ratio, args.from_me_ratio)
+        task = asyncio.create_task(send(payload))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        sent += 1
+        next_at += interval
+        await asyncio.sleep(max(0, next_at - loop.time()))
+    await asyncio.gather(*tasks)
+    return sent
+
+
+async def reader(client, args, stats_by_endpoint, stop_at, worker: int) -> None:
+    rng = random.Random(args.seed * 1000 + worker)
+    loop = asyncio.get_running_loop()
+    n = worker
+    while loop.time() < stop_at:
+        endpoint = READ_ENDPOINTS[n % len(READ_ENDPOINTS)]
+        n += 1
+        instance = rng.randrange(args.instances)
+        params = {"instanceId": synthetic.instance_id(instance)}
+        if endpoint == "GET /messages":
+            params["contact_number"] = synthetic.contact_number(instance, synthetic.hot_contact(rng, args.contacts))
+        await _timed(client, stats_by_endpoint[endpoint], "GET", endpoint.split(" ", 1)[1], params=params)
+        if args.reader_pause:
+            await asyncio.sleep(args.reader_pause)
+
+
+async def websocket_client(args, index: int, sent_at, delivery: List[float], counts, stop_at) -> None:
+    url = args.base_url.replace("http", "ws", 1) + "/ws/mensagens"
+    # Half the clients follow one instance, the others get everything.
+    if index % 2 == 0:
+        url += f"?instanceId={synthetic.instance_id(index // 2 % args.instances)}"
+    loop = asyncio.get_running_loop()
+    try:
+        async with websockets.connect(url, max_queue=None) as ws:
+            counts["connected"] += 1
+            while True:
+                remaining = stop_at - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    raw = await asyncio.wait_for(ws.recv(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                counts["events"] += 1
+                started = sent_at.get(json.loads(raw).get("messageId"))
+                if started is not None:
+                    delivery.append((time.perf_counter() - started) * 1000)
+    except (OSError, websockets.WebSocketException):
+        counts["failed"] += 1
+
+
+async def scrape_metrics(client) -> Dict[str, Dict[str, float]]:
+    """Per-endpoint sums and counts of the server's per-request SQL histograms."""
+    values: Dict[str, Dict[str, float]] = defaultdict(dict)
+    try:
+        response = await client.get("/metrics")
+    except httpx.HTTPError:
+        return values
+    for line in response.text.splitlines():
+        match = _METRIC_LINE.match(line)
+        if match:
+            name, method, route, value = match.groups()
+            values[f"{method} {route}"][name] = float(value)
+    return values
+
+
+def _server_side(before, after, endpoint: str) -> dict:
+    delta = {
+        name: after.get(endpoint, {}).get(name, 0) - before.get(endpoint, {}).get(name, 0)
+        for name in (
+            "nestor_http_request_statements_sum",
+            "nestor_http_request_statements_count",
+            "nestor_http_request_db_seconds_sum",
+        )
+    }
+    count = delta["nestor_http_request_statements_count"]
+    if not count:
+        return {"queries_per_request": None, "db_ms_per_request": None}
+    return {
+        "queries_per_request": delta["nestor_http_request_statements_sum"] / count,
+        "db_ms_per_request": delta["nestor_http_request_db_seconds_sum"] * 1000 / count,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run(args) -> dict:
+    limits = httpx.Limits(max_connections=args.max_in_flight + args.readers + 2)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        before = await scrape_metrics(client)
+        loop = asyncio.get_running_loop()
+        stats = defaultdict(endpoint_stats)
+        sent_at: Dict[str, float] = {}
+        delivery: List[float] = []
+        ws_counts = defaultdict(int)
+
+        # Websocket clients connect and readers warm up before the clock starts.
+        stop_at = loop.time() + args.warmup + args.duration
+        ws_tasks = [
+            asyncio.create_task(websocket_client(args, i, sent_at, delivery, ws_counts, stop_at + args.drain))
+            for i in range(args.ws_clients)
+        ]
+        await asyncio.sleep(args.warmup)
+        started = time.perf_counter()
+        readers = [asyncio.create_task(reader(client, args, stats, stop_at, i)) for i in range(args.readers)]
+        sent = await webhook_sender(client, args, stats[WEBHOOK], sent_at, stop_at)
+        await asyncio.gather(*readers)
+        elapsed = time.perf_counter() - started
+        await asyncio.gather(*ws_tasks)
+        after = await scrape_metrics(client)
+
+    endpoints = {}
+    for endpoint, endpoint_data in sorted(stats.items()):
+        endpoints[endpoint] = {
+            "requests": len(endpoint_data.latencies) + endpoint_data.statuses.get(0, 0),
+            "errors": endpoint_data.errors,
+            "statuses": {str(code): n for code, n in sorted(endpoint_data.statuses.items())},
+            "throughput_rps": len(endpoint_data.latencies) / elapsed,
+            "latency_ms": synthetic.percentiles(endpoint_data.latencies),
+            **_server_side(before, after, endpoint),
+        }
+    return {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "label": args.label,
+            "args": vars(args),
+            "elapsed_seconds": elapsed,
+        },
+        "webhook": {"target_rps": args.rate, "achieved_rps": sent / elapsed, "sent": sent},
+        "endpoints": endpoints,
+        "websocket": {
+            "clients": args.ws_clients,
+            "connected": ws_counts["connected"],
+            "failed": ws_counts["failed"],
+            "events_received": ws_counts["events"],
+            "delivery_ms": synthetic.percentiles(delivery),
+        },
+    }
+
+
+def _ms(value) -> str:
+    return "-" if value is None else f"{value:.1f}"
+
+
+def print_report(result: dict) -> None:
+    print(f"{'endpoint':<28}{'reqs':>8}{'err':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'q/req':>8}{'db ms':>8}")
+    for endpoint, data in result["endpoints"].items():
+        latency = data["latency_ms"]
+        print(
+            f"{endpoint:<28}{data['requests']:>8}{data['errors']:>6}{data['throughput_rps']:>9.1f}"
+            f"{_ms(latency['p50']):>9}{_ms(latency['p95']):>9}{_ms(latency['p99']):>9}"
+            f"{_ms(data['queries_per_request']):>8}{_ms(data['db_ms_per_request']):>8}"
+        )
+    webhook, ws = result["webhook"], result["websocket"]
+    print(f"webhooks: {webhook['achieved_rps']:.1f}/{webhook['target_rps']} rps")
+    delivery = ws["delivery_ms"]
+    print(
+        f"websocket: {ws['connected']}/{ws['clients']} connected, {ws['events_received']} events, "
+        f"delivery p50 {_ms(delivery['p50'])}ms p95 {_ms(delivery['p95'])}ms p99 {_ms(delivery['p99'])}ms"
+    )
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m bench.load")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--rate", type=float, default=50, help="webhooks per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds for websockets to connect first")
+    parser.add_argument("--drain", type=float, default=2, help="seconds websockets keep listening afterwards")
+    parser.add_argument("--ws-clients", type=int, default=20)
+    parser.add_argument("--readers", type=int, default=4, help="concurrent reader loops")
+    parser.add_argument("--reader-pause", type=float, default=0, help="seconds between a reader's requests")
+    parser.add_argument("--max-in-flight", type=int, default=200, help="cap on concurrent webhook requests")
+    parser.add_argument("--instances", type=int, default=2)
+    parser.add_argument("--contacts", type=int, default=1000, help="contacts per instance")
+    parser.add_argument("--image-ratio", type=float, default=0.2)
+    parser.add_argument("--from-me-ratio", type=float, default=0.3)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default="", help="free text stored with the results")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Seed Postgres with synthetic inboxes, contacts and messages for benchmarks.
+
+Run against a local database that has been migrated (``python -m app.migrate``)::
+
+    python -m bench.seed --instances 4 --contacts 5000 --messages 2000000
+
+Rows are written with COPY in batches and are deterministic for a given
+``--seed``. Every synthetic instance id starts with ``bench-``; seeding
+refuses to run when such rows exist unless ``--reset`` is given, which
+deletes them first and never touches anything else.
+"""
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+import asyncpg
+
+from app import rollup, timeline
+from app.database import DATABASE_URL
+from app.migrate import MIGRATIONS, applied_versions
+from app.partitions import ensure_months, month_start, next_month
+from bench import synthetic
+
+COPY_BATCH_SIZE = 50_000
+
+MESSAGE_COLUMNS = ["messageId", "datetime", "WhatsappjId", "Message_Type", "Message_Content", "instanceId"]
+IMAGE_COLUMNS = [
+    "id", "messageId", "WhatsappjId", "instanceId", "datetime", "url", "mimetype", "caption",
+    "fileSha256", "fileLength", "height", "width", "mediaKey", "fileEncSha256", "Message_Type",
+]
+TIMELINE_COLUMNS = ["instanceId", "WhatsappjId", "datetime", "messageId", "kind", "Message_Type"]
+
+BENCH_TABLES = ("timeline", "conversation", "message", "image_message", "contact", "inbox",
+                "message_rollup", "message_rollup_contact")
+
+
+async def _reset(conn) -> None:
+    for table in BENCH_TABLES:
+        column = "instance_id" if table == "inbox" else "instanceId"
+        await conn.execute(f'DELETE FROM {table} WHERE "{column}" LIKE $1', synthetic.INSTANCE_PREFIX + "%")
+
+
+async def _already_seeded(conn) -> bool:
+    return await conn.fetchval(
+        'SELECT EXISTS (SELECT 1 FROM inbox WHERE instance_id LIKE $1) '
+        'OR EXISTS (SELECT 1 FROM contact WHERE "instanceId" LIKE $1)',
+        synthetic.INSTANCE_PREFIX + "%",
+    )
+
+
+async def _copy(conn, table: str, columns, records) -> None:
+    if records:
+        await conn.copy_records_to_table(table, records=records, columns=columns)
+
+
+async def seed(args) -> dict:
+    rng = random.Random(args.seed)
+    end = datetime.now().replace(microsecond=0)
+    start = end - timedelta(days=args.days)
+    span = int((end - start).total_seconds())
+
+    months = []
+    month = month_start(start)
+    while month <= end.date():
+        months.append(month)
+        month = next_month(month)
+    ensure_months(months)
+
+    counts = {"inboxes": 0, "contacts": 0, "messages": 0, "images": 0}
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        if args.reset:
+            await _reset(conn)
+        elif await _already_seeded(conn):
+            # Inbox and contact ids are fixed, and messages would be doubled.
+            raise SystemExit("bench-* rows already exist; run again with --reset to replace them")
+
+        inboxes = [
+            (str(uuid.UUID(int=rng.getrandbits(128))), synthetic.instance_id(i), "http://localhost:8080",
+             "bench", synthetic.whatsapp_id(i, 0), f"Bench {i}")
+            for i in range(args.instances)
+        ]
+        await _copy(conn, "inbox", ["inbox_id", "instance_id", "url_evo", "api_key", "whatsappjID", "inbox_name"], inboxes)
+        counts["inboxes"] = len(inboxes)
+
+        now = datetime.now(timezone.utc)
+        contacts = []
+        for i in range(args.instances):
+            for c in range(args.contacts):
+                contacts.append((str(uuid.UUID(int=rng.getrandbits(128))), synthetic.whatsapp_id(i, c),
+                                 f"Cliente {c}", synthetic.instance_id(i), now, now))
+                if len(contacts) >= COPY_BATCH_SIZE:
+                    await _copy(conn, "contact", ["contactId", "WhatsappjId", "pushname", "instanceId",
+                                                  "createdAt", "updatedAt"], contacts)
+                    counts["contacts"] += len(contacts)
+                    contacts = []
+        await _copy(conn, "contact", ["contactId", "WhatsappjId", "pushname", "instanceId",
+                                      "createdAt", "updatedAt"], contacts)
+        counts["contacts"] += len(contacts)
+
+        texts, images, rows = [], [], []
+        for n in range(args.messages):
+            instance = rng.randrange(args.instances)
+            contact = synthetic.hot_contact(rng, args.contacts)
+            jid = synthetic.whatsapp_id(instance, contact)
+            iid = synthetic.instance_id(instance)
+            mid = synthetic.message_id(rng)
+            when = start + timedelta(seconds=rng.randrange(span))
+            direction = "Outgoing" if rng.random() < args.from_me_ratio else "Incoming"
+            if rng.random() < args.image_ratio:
+                # Image ids are message ids, as in ingestion._image_row.
+                images.append((
+                    mid, mid, jid, iid, when,
+                    f"https://mmg.whatsapp.net/bench/{n}.enc", "image/jpeg", synthetic.sentence(rng, 0, 8),
+                    None, str(rng.randint(20_000, 400_000)), 1280, 960, None, None, direction,
+                ))
+                rows.append((iid, jid, when, mid, "image", direction))
+            else:
+                texts.append((mid, when, jid, direction, synthetic.sentence(rng), iid))
+                rows.append((iid, jid, when, mid, "text", direction))
+            if len(rows) >= COPY_BATCH_SIZE:
+                await _flush(conn, texts, images, rows, counts)
+                texts, images, rows = [], [], []
+                if args.verbose:
+                    print(f"  {n + 1} messages", flush=True)
+        await _flush(conn, texts, images, rows, counts)
+    finally:
+        await conn.close()
+
+    # Dashboards read the hourly rollups and the conversation list its own
+    # table, so rebuild both from the seeded rows.
+    rollup.backfill(start.date(), date.today())
+    timeline.backfill_conversations()
+    return counts
+
+
+async def _flush(conn, texts, images, rows, counts) -> None:
+    async with conn.transaction():
+        await _copy(conn, "message", MESSAGE_COLUMNS, texts)
+        await _copy(conn, "image_message", IMAGE_COLUMNS, images)
+        await _copy(conn, "timeline", TIMELINE_COLUMNS, rows)
+    counts["messages"] += len(texts)
+    counts["images"] += len(images)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m bench.seed")
+    parser.add_argument("--instances", type=int, default=2)
+    parser.add_argument("--contacts", type=int, default=1000, help="contacts per instance")
+    parser.add_argument("--messages", type=int, default=100_000, help="messages in total, text and image")
+    parser.add_argument("--days", type=int, default=90, help="spread messages over this many past days")
+    parser.add_argument("--image-ratio", type=float, default=0.2)
+    parser.add_argument("--from-me-ratio", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--reset", action="store_true", help="delete earlier bench-* rows first")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    pending = [version for version, _, _ in MIGRATIONS if version not in applied_versions()]
+    if pending:
+        parser.error(f"migrations {pending} are pending; run `python -m app.migrate` first")
+
+    started = time.perf_counter()
+    counts = asyncio.run(seed(args))
+    print(
+        f"Seeded {counts['inboxes']} inboxes, {counts['contacts']} contacts, "
+        f"{counts['messages']} text and {counts['images']} image messages "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
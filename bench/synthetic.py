@@ -0,0 +1,108 @@
+"""Deterministic synthetic identities and Evolution payloads shared by the seeder and the load runner."""
+import random
+import time
+import uuid
+from typing import List
+
+INSTANCE_PREFIX = "bench-"
+
+WORDS = (
+    "oi tudo bem pedido entrega amanha obrigado valor pix boleto enviado "
+    "confirmado endereco horario produto estoque desconto frete prazo nota "
+    "fiscal cancelar trocar cliente atendimento retorno aguardo ok"
+).split()
+
+
+def instance_id(index: int) -> str:
+    return f"{INSTANCE_PREFIX}{index:03d}"
+
+
+def contact_number(instance: int, contact: int) -> str:
+    # Unique across instances: contact.WhatsappjId is unique table-wide.
+    return f"55{instance:03d}{contact:08d}"
+
+
+def whatsapp_id(instance: int, contact: int) -> str:
+    return f"{contact_number(instance, contact)}@s.whatsapp.net"
+
+
+def message_id(rng: random.Random) -> str:
+    return "3EB0" + uuid.UUID(int=rng.getrandbits(128)).hex[:16].upper()
+
+
+def sentence(rng: random.Random, low: int = 2, high: int = 18) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def hot_contact(rng: random.Random, contacts: int) -> int:
+    """Pick a contact so that about 80% of the traffic goes to 20% of them."""
+    hot = max(1, contacts // 5)
+    if rng.random() < 0.8:
+        return rng.randrange(hot)
+    return rng.randrange(contacts)
+
+
+def webhook_payload(
+    rng: random.Random,
+    instances: int,
+    contacts: int,
+    image_ratio: float = 0.2,
+    from_me_ratio: float = 0.3,
+) -> dict:
+    """A realistic ``messages.upsert`` webhook body for a random conversation.
+
+    Image messages carry no ``mediaKey``, so the server records them without
+    trying to download the (fake) media.
+    """
+    instance = rng.randrange(instances)
+    contact = hot_contact(rng, contacts)
+    from_me = rng.random() < from_me_ratio
+    if rng.random() < image_ratio:
+        content = {
+            "imageMessage": {
+                "url": f"https://mmg.whatsapp.net/bench/{uuid.UUID(int=rng.getrandbits(128)).hex}.enc",
+                "mimetype": "image/jpeg",
+                "caption": sentence(rng, 0, 8),
+                "fileLength": str(rng.randint(20_000, 400_000)),
+                "height": 1280,
+                "width": 960,
+            }
+        }
+    else:
+        content = {"conversation": sentence(rng)}
+    return {
+        "event": "messages.upsert",
+        "instance": instance_id(instance),
+        "data": {
+            "key": {
+                "remoteJid": whatsapp_id(instance, contact),
+                "fromMe": from_me,
+                # Always fresh, so repeated runs are not answered as duplicates.
+                "id": "3EB0" + uuid.uuid4().hex[:16].upper(),
+            },
+            "pushName": None if from_me else f"Cliente {contact}",
+            "message": content,
+            "messageType": "imageMessage" if "imageMessage" in content else "conversation",
+            "messageTimestamp": int(time.time()),
+            "instanceId": instance_id(instance),
+            "source": "android",
+        },
+    }
+
+
+def percentiles(samples: List[float]) -> dict:
+    """Nearest-rank p50/p95/p99 plus mean and max, in the samples' unit."""
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+    return {
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "mean": sum(ordered) / len(ordered),
+        "max": ordered[-1],
+    }
@@ -0,0 +1,23 @@
+import asyncio
+import os
+
+import pytest
+from sqlalchemy.engine import make_url
+
+from app import database
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+@pytest.fixture
+def db_engine(monkeypatch):
+    """The sync engine bound to the disposable TEST_DATABASE_URL database."""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    url = make_url(TEST_DATABASE_URL)
+    monkeypatch.setattr(database, "DATABASE_URL", url.render_as_string(hide_password=False))
+    monkeypatch.setattr(
+        database, "ASYNC_DATABASE_URL", url.set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
+    )
+    yield database.get_engine()
+    asyncio.run(database.dispose_engines())
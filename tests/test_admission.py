@@ -0,0 +1,90 @@
+import asyncio
+
+from app.admission import admission_controller
+
+
+def _run(test):
+    asyncio.run(test())
+
+
+def test_sheds_beyond_global_and_instance_caps():
+    async def test():
+        controller = admission_controller(limit=3, per_instance=2, outgoing_share=1, max_wait=0)
+        assert await controller.acquire("a", from_me=False)
+        assert await controller.acquire("a", from_me=False)
+        assert not await controller.acquire("a", from_me=False)
+        assert await controller.acquire("b", from_me=False)
+        assert not await controller.acquire("c", from_me=False)
+        assert controller.in_flight == 3
+        controller.release("a")
+        assert await controller.acquire("c", from_me=False)
+
+    _run(test)
+
+
+def test_outgoing_keeps_to_its_share():
+    async def test():
+        controller = admission_controller(limit=4, per_instance=4, outgoing_share=0.5, max_wait=0)
+        assert [await controller.acquire("a", from_me=True) for _ in range(3)] == [True, True, False]
+        assert [await controller.acquire("a", from_me=False) for _ in range(3)] == [True, True, False]
+
+    _run(test)
+
+
+def test_freed_slot_goes_to_incoming_first():
+    async def test():
+        controller = admission_controller(limit=1, per_instance=1, outgoing_share=1, max_wait=1)
+        assert await controller.acquire("a", from_me=False)
+        outgoing = asyncio.create_task(controller.acquire("b", from_me=True))
+        await asyncio.sleep(0)
+        incoming = asyncio.create_task(controller.acquire("c", from_me=False))
+        await asyncio.sleep(0)
+        assert controller.waiting == 2
+
+        controller.release("a")
+        assert await incoming
+        assert not outgoing.done()
+        controller.release("c")
+        assert await outgoing
+        assert controller.waiting == 0
+
+    _run(test)
+
+
+def test_waiter_times_out_and_is_rejected():
+    async def test():
+        controller = admission_controller(limit=1, per_instance=1, max_wait=0.01)
+        assert await controller.acquire("a", from_me=False)
+        assert not await controller.acquire("b", from_me=False)
+        assert controller.waiting == 0
+        assert controller.in_flight == 1
+
+    _run(test)
+
+
+def test_cancelled_waiter_does_not_leak_a_slot():
+    async def test():
+        controller = admission_controller(limit=1, per_instance=1, max_wait=1)
+        assert await controller.acquire("a", from_me=False)
+        waiter = asyncio.create_task(controller.acquire("b", from_me=False))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        controller.release("a")
+        assert controller.in_flight == 0
+        assert controller.waiting == 0
+
+    _run(test)
+
+
+def test_max_waiting_rejects_immediately():
+    async def test():
+        controller = admission_controller(limit=1, per_instance=1, max_wait=1, max_waiting=1)
+        assert await controller.acquire("a", from_me=False)
+        queued = asyncio.create_task(controller.acquire("b", from_me=False))
+        await asyncio.sleep(0)
+        assert not await controller.acquire("c", from_me=False)
+        controller.release("a")
+        assert await queued
+
+    _run(test)
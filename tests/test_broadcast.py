@@ -0,0 +1,52 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+from sqlalchemy.engine import make_url
+
+from app.broadcast import postgres_backend
+from app.websocket_manager import connection_manager
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+def test_postgres_backend_starts_without_postgres():
+    async def test():
+        backend = postgres_backend(connection_manager(), dsn="postgresql://nobody@127.0.0.1:1/none")
+        await asyncio.wait_for(backend.start(), 1)
+        with pytest.raises(RuntimeError):
+            await backend.publish({"messageId": "a"}, "inst", "jid")
+        await backend.stop()
+
+    asyncio.run(test())
+
+
+def test_postgres_backend_numbers_each_instance():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    dsn = make_url(TEST_DATABASE_URL).set(drivername="postgresql").render_as_string(hide_password=False)
+
+    async def test():
+        manager = connection_manager()
+        backend = postgres_backend(manager, dsn=dsn, channel="nestor_test_messages")
+        await backend.start()
+        try:
+            for _ in range(100):
+                if backend._pool is not None:
+                    break
+                await asyncio.sleep(0.05)
+            # Fresh instances, so their counters start at 1.
+            instances = [f"test-{uuid.uuid4()}" for _ in range(2)]
+            await asyncio.gather(*(
+                backend.publish({"messageId": str(n)}, instance, "jid") for instance in instances for n in range(3)
+            ))
+            for _ in range(100):
+                if [manager.position(instance) for instance in instances] == [3, 3]:
+                    break
+                await asyncio.sleep(0.05)
+            assert [manager.position(instance) for instance in instances] == [3, 3]
+        finally:
+            await backend.stop()
+
+    asyncio.run(test())
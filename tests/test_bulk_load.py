@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from app.bulk_load import expand_history_item, json_stream, json_stream_error
+
+DOCUMENT = [
+    {"data": {"key": {"id": "A1"}, "message": {"conversation": 'brackets ]}[{ and "quotes" \\ done'}}},
+    {"data": {"messages": [{"key": {"id": "B1"}}, {"key": {"id": "B2"}, "n": [1, [2, [3]]]}]}},
+    {"data": {"message": {"conversation": "olá, ação ✓ 😀"}, "escaped": "é\n\t\"\\"}},
+    12.75,
+    None,
+]
+
+
+def _parse(body: bytes, size: int) -> list:
+    stream = json_stream()
+    values = []
+    for start in range(0, len(body), size):
+        values.extend(stream.feed(body[start:start + size]))
+    return values + stream.close()
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 10_000])
+def test_array_split_anywhere(size):
+    body = json.dumps(DOCUMENT, ensure_ascii=False).encode()
+    assert _parse(body, size) == DOCUMENT
+
+
+@pytest.mark.parametrize("size", [1, 5, 10_000])
+def test_ndjson_and_scalars(size):
+    body = b'{"a": 1}\n{"b": [2]}\n12345\n"text"\ntrue\n3.5'
+    assert _parse(body, size) == [{"a": 1}, {"b": [2]}, 12345, "text", True, 3.5]
+
+
+def test_truncated_body_is_an_error():
+    stream = json_stream()
+    assert stream.feed(b'[{"a": 1}, {"b": ') == [{"a": 1}]
+    with pytest.raises(json_stream_error):
+        stream.close()
+
+
+def test_malformed_value_is_an_error():
+    with pytest.raises(json_stream_error):
+        _parse(b'[{"a": 1}, {"b" 2}]', 4)
+
+
+def test_document_size_limit():
+    stream = json_stream(max_document_bytes=100)
+    stream.feed(b'[{"a": "')
+    with pytest.raises(json_stream_error, match="BULK_MAX_DOCUMENT_BYTES"):
+        stream.feed(b"x" * 200)
+
+
+def test_expand_history_item_shapes():
+    bare = {"key": {"id": "1"}}
+    assert list(expand_history_item(bare, "inst")) == [{"data": dict(bare, instanceId="inst")}]
+    envelope = {"event": "messages.set", "data": {"messages": [bare, "junk", {"key": {"id": "2"}, "instanceId": "own"}]}}
+    assert [p["data"].get("instanceId") for p in expand_history_item(envelope, "inst")] == ["inst", "own"]
@@ -0,0 +1,90 @@
+import asyncio
+import uuid
+
+from sqlalchemy import delete
+from starlette.requests import Request
+
+from app import change_versions
+from app.change_versions import (
+    bump,
+    check_not_modified,
+    contacts_scope,
+    conversations_scope,
+    current,
+    etag_for,
+    message_scopes,
+)
+from app.models import change_version
+
+
+def _request(query: str = "", if_none_match: str = None) -> Request:
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/contacts", "query_string": query.encode(), "headers": headers})
+
+
+class fake_db:
+    def __init__(self, version: int):
+        self.version = version
+
+    async def scalar(self, statement):
+        return self.version
+
+
+def _event(instance_id: str, whatsapp_id: str) -> dict:
+    return {"instance_id": instance_id, "whatsapp_id": whatsapp_id}
+
+
+def test_message_scopes():
+    events = [_event("a", "1"), _event("b", "2")]
+    assert message_scopes(events, events[:1], []) == {conversations_scope("a")}
+    assert message_scopes(events, [], [("2", "Bia")]) == {contacts_scope("b"), conversations_scope("b")}
+
+
+def test_etag_depends_on_version_and_query():
+    tag = etag_for(_request("limit=10"), "contacts:a", 1)
+    assert tag == etag_for(_request("limit=10"), "contacts:a", 1)
+    assert tag != etag_for(_request("limit=10"), "contacts:a", 2)
+    assert tag != etag_for(_request("limit=20"), "contacts:a", 1)
+    assert tag != etag_for(_request("limit=10"), "contacts:b", 1)
+
+
+def test_check_not_modified():
+    async def test():
+        etag, response = await check_not_modified(_request(), fake_db(7), "contacts:a")
+        assert response is None
+
+        _, response = await check_not_modified(_request(if_none_match=f'"other", W/{etag}'), fake_db(7), "contacts:a")
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+
+        _, response = await check_not_modified(_request(if_none_match=etag), fake_db(8), "contacts:a")
+        assert response is None
+
+        _, response = await check_not_modified(_request(if_none_match="*"), fake_db(8), "contacts:a")
+        assert response.status_code == 304
+
+    asyncio.run(test())
+
+
+def test_bump_only_moves_forward(db_engine, monkeypatch):
+    scope = f"test:{uuid.uuid4()}"
+
+    async def test():
+        from app.database import open_session
+
+        db = open_session()
+        try:
+            assert await current(db, scope) == 0
+            await change_versions.bump_committed(db, [scope])
+            first = await current(db, scope)
+            # A clock that went backwards still advances the version.
+            monkeypatch.setattr(change_versions.time, "time_ns", lambda: 0)
+            await bump(db, [scope])
+            await db.commit()
+            assert await current(db, scope) == first + 1
+        finally:
+            await db.execute(delete(change_version).where(change_version.scope == scope))
+            await db.commit()
+            await db.close()
+
+    asyncio.run(test())
@@ -0,0 +1,78 @@
+import asyncio
+
+from app import ingestion
+from app.contact_cache import contact_cache
+
+
+def test_lru_evicts_least_recently_used():
+    cache = contact_cache(max_size=2, ttl=60)
+    cache.put("a", "ca", "Ana")
+    cache.put("b", "cb", "Bia")
+    assert cache.get("a") == ("ca", "Ana")
+    cache.put("c", "cc", "Caio")
+    assert cache.get("b") is None
+    assert cache.get("a") == ("ca", "Ana")
+    assert cache.get("c") == ("cc", "Caio")
+
+
+def test_entries_expire():
+    cache = contact_cache(max_size=2, ttl=-1)
+    cache.put_many([("a", "ca", "Ana")])
+    assert cache.get("a") is None
+
+
+class recording_db:
+    def __init__(self):
+        self.statements = []
+
+    async def execute(self, statement):
+        self.statements.append(statement)
+        rows = statement.compile().params
+        return _result([(rows["WhatsappjId_m0"], rows["contactId_m0"], rows["pushname_m0"])])
+
+
+class _result:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def all(self):
+        return self.rows
+
+
+def _event(whatsapp_id, pushname, from_me=False):
+    return {
+        "message_id": f"m-{whatsapp_id}",
+        "whatsapp_id": whatsapp_id,
+        "instance_id": "inst",
+        "pushname": pushname,
+        "from_me": from_me,
+    }
+
+
+def _upsert(events):
+    db = recording_db()
+    rows = asyncio.run(ingestion.upsert_contacts(db, events))
+    return db.statements, rows
+
+
+def test_upsert_skips_cached_contacts(monkeypatch):
+    cache = contact_cache(max_size=10, ttl=60)
+    monkeypatch.setattr(ingestion, "known_contacts", cache)
+    cache.put("a", "ca", "Ana")
+
+    assert _upsert([_event("a", "Ana")]) == ([], [])
+    # Our own messages never carry the contact's pushname.
+    assert _upsert([_event("a", None, from_me=True)]) == ([], [])
+
+
+def test_changed_pushname_bypasses_the_cache(monkeypatch):
+    cache = contact_cache(max_size=10, ttl=60)
+    monkeypatch.setattr(ingestion, "known_contacts", cache)
+    cache.put("a", "ca", "Ana")
+
+    statements, rows = _upsert([_event("a", "Ana Maria")])
+    assert len(statements) == 1
+    assert rows == [("a", "m-a", "Ana Maria")]
+
+    statements, _ = _upsert([_event("new", None, from_me=True)])
+    assert len(statements) == 1
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+from app import database
+from app.database import _replica, replica_set
+
+
+def _stub(replica, result):
+    async def probe():
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    replica._probe = probe
+
+
+@pytest.mark.parametrize("probe, usable", [
+    ((True, True, 0), True),
+    ((True, True, database.REPLICA_MAX_LAG_SECONDS + 1), False),
+    ((True, True, None), False),
+    ((False, False, 0), False),
+    ((True, False, 0), False),
+    (OSError("connection refused"), False),
+])
+def test_replica_check(probe, usable):
+    replica = _replica(0, "postgresql://nestor@replica/nestor")
+    _stub(replica, probe)
+    asyncio.run(replica.check())
+    assert replica.usable is usable
+
+
+def test_choose_skips_unusable_replicas():
+    replicas = replica_set(["postgresql://nestor@r0/nestor", "postgresql://nestor@r1/nestor", "postgresql://nestor@r2/nestor"])
+    _stub(replicas.replicas[0], (True, True, 0.5))
+    _stub(replicas.replicas[1], (True, False, 0))
+    _stub(replicas.replicas[2], (True, True, 1))
+
+    async def check_all():
+        for replica in replicas.replicas:
+            await replica.check()
+
+    asyncio.run(check_all())
+    assert [replicas.choose().name for _ in range(4)] == ["replica0", "replica2", "replica0", "replica2"]
+
+    # The receiver of replica0 went down; it is dropped on the next check.
+    _stub(replicas.replicas[0], (True, False, 0))
+    _stub(replicas.replicas[2], (False, False, 0))
+    asyncio.run(check_all())
+    assert replicas.choose() is None
@@ -0,0 +1,74 @@
+import gzip
+import json
+from datetime import datetime
+from types import SimpleNamespace
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.routes import export_router
+
+CONTACTS = [
+    SimpleNamespace(
+        contactId=f"c{i}", WhatsappjId=f"55{i}@s.whatsapp.net", pushname=f"Contato {i}",
+        instanceId="inst", createdAt=datetime(2026, 1, 1, 12, i), updatedAt=None,
+    )
+    for i in range(5)
+]
+
+
+def _client(monkeypatch, batches, fail=False):
+    async def stream_rows(statement, batch_size, read_only=False):
+        assert read_only
+        for batch in batches:
+            yield batch
+        if fail:
+            raise RuntimeError("connection lost")
+
+    monkeypatch.setattr(export_router, "stream_rows", stream_rows)
+    app = FastAPI()
+    app.include_router(export_router.export_route)
+    return TestClient(app)
+
+
+def _raw(client, url, **headers):
+    with client.stream("GET", url, headers=headers) as response:
+        return response, b"".join(response.iter_raw())
+
+
+def test_gzip_export_streams_every_row(monkeypatch):
+    client = _client(monkeypatch, [CONTACTS[:2], CONTACTS[2:]])
+    response, body = _raw(client, "/export/contacts?instanceId=inst", **{"Accept-Encoding": "gzip"})
+
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert response.headers["content-disposition"] == 'attachment; filename="contacts-inst.ndjson"'
+    assert response.headers["vary"] == "Accept-Encoding"
+    lines = [json.loads(line) for line in gzip.decompress(body).decode().splitlines()]
+    assert [line["contactId"] for line in lines] == ["c0", "c1", "c2", "c3", "c4"]
+    assert lines[0] == {
+        "contactId": "c0",
+        "WhatsappjId": "550@s.whatsapp.net",
+        "pushname": "Contato 0",
+        "instanceId": "inst",
+        "createdAt": "2026-01-01T12:00:00",
+        "updatedAt": None,
+    }
+
+
+def test_plain_export_ends_with_an_error_line_when_aborted(monkeypatch):
+    client = _client(monkeypatch, [CONTACTS[:1]], fail=True)
+    response, body = _raw(client, "/export/contacts?instanceId=inst", **{"Accept-Encoding": "identity"})
+
+    assert "content-encoding" not in response.headers
+    lines = [json.loads(line) for line in body.decode().splitlines()]
+    assert [line.get("contactId") for line in lines] == ["c0", None]
+    assert lines[-1] == {"error": "Export aborted"}
+
+
+def test_message_export_rejects_an_empty_range(monkeypatch):
+    client = _client(monkeypatch, [])
+    response = client.get("/export/messages?instanceId=inst&start=2026-02-01T00:00:00&end=2026-01-01T00:00:00")
+    assert response.status_code == 400
+    assert response.json()["status"] == "Error"
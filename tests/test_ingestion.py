@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from app.dedupe import recent_messages
+from app.ingestion import batch_writer, parse_webhook_payload
+
+
+def _payload(**data):
+    block = {
+        "instanceId": "inst",
+        "key": {"id": "ABC", "remoteJid": "5511999999999@s.whatsapp.net", "fromMe": False},
+        "pushName": "Ana",
+        "message": {"conversation": "oi"},
+        "messageTimestamp": 1700000000,
+    }
+    block.update(data)
+    return {"data": block}
+
+
+def test_redelivery_parses_to_the_same_key():
+    first, again = parse_webhook_payload(_payload()), parse_webhook_payload(_payload())
+    assert first["kind"] == "text"
+    assert (first["message_id"], first["datetime_obj"]) == (again["message_id"], again["datetime_obj"])
+
+
+@pytest.mark.parametrize("timestamp", [None, 0, ""])
+def test_missing_timestamp_is_rejected(timestamp):
+    with pytest.raises(ValueError, match="messageTimestamp"):
+        parse_webhook_payload(_payload(messageTimestamp=timestamp))
+
+
+def _event(message_id: str) -> dict:
+    return {"message_id": message_id}
+
+
+def _writer(monkeypatch, fail=(), **kwargs):
+    """A batch_writer whose writes are recorded instead of reaching Postgres."""
+    writes, commits = [], []
+
+    async def write(events):
+        writes.append([event["message_id"] for event in events])
+        if len(events) > 1 and any(event["message_id"] in fail for event in events):
+            raise RuntimeError("batch failed")
+        if events[0]["message_id"] in fail:
+            raise RuntimeError("event failed")
+        return events
+
+    async def on_commit(events):
+        commits.append([event["message_id"] for event in events])
+
+    writer = batch_writer(on_commit=on_commit, **kwargs)
+    monkeypatch.setattr(writer, "_write", write)
+    return writer, writes, commits
+
+
+def test_batch_writer_flushes_in_batches(monkeypatch):
+    async def test():
+        writer, writes, commits = _writer(monkeypatch, batch_size=2, flush_interval=0.05)
+        writer.start()
+        for message_id in "abcde":
+            assert writer.submit(_event(message_id))
+        await asyncio.sleep(0.2)
+        assert writes == [["a", "b"], ["c", "d"], ["e"]]
+        assert commits == writes
+        await writer.stop()
+
+    asyncio.run(test())
+
+
+def test_batch_writer_falls_back_to_single_writes(monkeypatch):
+    async def test():
+        recent_messages.add("bad")
+        writer, writes, commits = _writer(monkeypatch, fail={"bad"}, batch_size=10, flush_interval=0.01)
+        writer.start()
+        for message_id in ("a", "bad", "c"):
+            writer.submit(_event(message_id))
+        await writer.stop()
+        assert writes == [["a", "bad", "c"], ["a"], ["bad"], ["c"]]
+        assert commits == [["a", "c"]]
+        # The dropped event is forgotten so a webhook retry can store it.
+        assert "bad" not in recent_messages
+
+    asyncio.run(test())
+
+
+def test_batch_writer_stop_drains_the_queue(monkeypatch):
+    async def test():
+        writer, writes, _ = _writer(monkeypatch, batch_size=100, flush_interval=60)
+        writer.start()
+        for message_id in "abc":
+            writer.submit(_event(message_id))
+        await asyncio.wait_for(writer.stop(), 1)
+        assert writes == [["a", "b", "c"]]
+
+    asyncio.run(test())
+
+
+def test_batch_writer_rejects_when_full(monkeypatch):
+    async def test():
+        writer, _, _ = _writer(monkeypatch, max_size=2)
+        with pytest.raises(RuntimeError):
+            writer.submit(_event("a"))
+        writer.start()
+        assert [writer.submit(_event(message_id)) for message_id in "abc"] == [True, True, False]
+        await writer.stop()
+
+    asyncio.run(test())
@@ -0,0 +1,165 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import http.server
+import os
+import socket
+import threading
+
+import pytest
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app import media
+from app.routes.media_router import media_route, media_urls
+
+PLAIN = b"\xff\xd8\xff" + os.urandom(5000)
+MEDIA_KEY = base64.b64encode(b"k" * 32).decode()
+
+
+def _encrypt(plaintext: bytes, media_key: str = MEDIA_KEY) -> bytes:
+    """What WhatsApp uploads: AES-CBC ciphertext followed by a truncated HMAC."""
+    expanded = media._hkdf(base64.b64decode(media_key), 112, media.IMAGE_KEY_INFO)
+    iv, cipher_key, mac_key = expanded[:16], expanded[16:48], expanded[48:80]
+    padder = padding.PKCS7(128).padder()
+    padded = padder.update(plaintext) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(cipher_key), modes.CBC(iv)).encryptor()
+    ciphertext = encryptor.update(padded) + encryptor.finalize()
+    return ciphertext + hmac.new(mac_key, iv + ciphertext, hashlib.sha256).digest()[: media.MAC_LENGTH]
+
+
+def _b64_sha(data: bytes) -> str:
+    return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+
+@pytest.fixture
+def media_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(media, "MEDIA_ROOT", tmp_path)
+    return tmp_path
+
+
+def test_decrypt_media_round_trip():
+    encrypted = _encrypt(PLAIN)
+    assert media.decrypt_media(encrypted, MEDIA_KEY, _b64_sha(encrypted), _b64_sha(PLAIN)) == PLAIN
+
+
+def test_decrypt_media_rejects_tampering():
+    encrypted = bytearray(_encrypt(PLAIN))
+    encrypted[20] ^= 1
+    with pytest.raises(media.media_error, match="MAC"):
+        media.decrypt_media(bytes(encrypted), MEDIA_KEY)
+    with pytest.raises(media.media_error, match="fileSha256"):
+        media.decrypt_media(_encrypt(PLAIN), MEDIA_KEY, file_sha256=_b64_sha(b"other"))
+
+
+def test_fetch_and_store_from_http_server(media_root, monkeypatch):
+    encrypted = _encrypt(PLAIN)
+    requests = []
+
+    class handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(encrypted)))
+            self.end_headers()
+            self.wfile.write(encrypted)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # The local server is plain http on a loopback address.
+    monkeypatch.setattr(media, "_check_url", lambda url: None)
+    try:
+        img_data = {
+            "url": f"http://127.0.0.1:{server.server_port}/image.enc",
+            "mediaKey": MEDIA_KEY,
+            "fileEncSha256": _b64_sha(encrypted),
+            "fileSha256": _b64_sha(PLAIN),
+        }
+        key = media.fetch_and_store(img_data)
+        assert key == hashlib.sha256(PLAIN).hexdigest()
+        assert media.media_path(key).read_bytes() == PLAIN
+        # Already cached: no second download.
+        assert media.fetch_and_store(img_data) == key
+        assert requests == ["/image.enc"]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize("url, reason", [
+    ("http://mmg.whatsapp.net/x.enc", "https"),
+    ("https://evil.example/x.enc", "not allowed"),
+    ("https://whatsapp.net.evil.example/x.enc", "not allowed"),
+    ("https://mmg.whatsapp.net/x.enc", "private address"),
+])
+def test_check_url_rejects(url, reason, monkeypatch):
+    monkeypatch.setattr(
+        socket, "getaddrinfo", lambda *args, **kwargs: [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.0.0.5", 443))]
+    )
+    with pytest.raises(media.media_error, match=reason):
+        media._check_url(url)
+
+
+def test_check_url_accepts_public_media_host(monkeypatch):
+    monkeypatch.setattr(
+        socket, "getaddrinfo", lambda *args, **kwargs: [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("157.240.1.1", 443))]
+    )
+    media._check_url("https://media-gru1-1.cdn.whatsapp.net/v/t62/x.enc?ccb=11")
+
+
+def test_media_route_serves_ranges(media_root):
+    key = hashlib.sha256(PLAIN).hexdigest()
+    path = media.media_path(key)
+    path.parent.mkdir(parents=True)
+    path.write_bytes(PLAIN)
+    app = FastAPI()
+    app.include_router(media_route)
+    client = TestClient(app)
+
+    response = client.get(f"/media/{key}", headers={"Range": "bytes=0-99"})
+    assert response.status_code == 206
+    assert response.content == PLAIN[:100]
+    assert response.headers["content-range"] == f"bytes 0-99/{len(PLAIN)}"
+    assert response.headers["content-type"] == "image/jpeg"
+
+    response = client.get(f"/media/{key}", headers={"Range": "bytes=-10"})
+    assert response.status_code == 206
+    assert response.content == PLAIN[-10:]
+
+    response = client.get(f"/media/{key}", headers={"If-None-Match": f'"{key}"'})
+    assert response.status_code == 304
+    assert client.get("/media/" + "0" * 64).status_code == 404
+    assert client.get(f"/media/{key}/thumbnail").status_code == 404
+    assert client.get("/media/not-a-sha").status_code == 404
+
+
+def test_media_urls_only_lists_cached_images(media_root):
+    key = hashlib.sha256(PLAIN).hexdigest()
+    path = media.media_path(key)
+    path.parent.mkdir(parents=True)
+    path.write_bytes(PLAIN)
+
+    urls = asyncio.run(media_urls([_b64_sha(PLAIN), _b64_sha(b"missing"), None]))
+    assert urls == [f"/media/{key}", None, None]
+    assert asyncio.run(media_urls([None, None])) == [None, None]
+
+
+def test_history_images_leave_room_for_live_media(media_root):
+    async def test():
+        pipeline = media.media_pipeline(workers=0, max_size=4, history_size=2)
+        pipeline.start()
+        images = [
+            {"url": "https://mmg.whatsapp.net/x.enc", "mediaKey": MEDIA_KEY, "fileSha256": _b64_sha(bytes([i]))}
+            for i in range(5)
+        ]
+        assert [pipeline.submit(image, history=True) for image in images[:3]] == [True, True, False]
+        assert pipeline.submit(images[3]) is True
+        await pipeline.stop()
+
+    asyncio.run(test())
@@ -0,0 +1,56 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+from app import metrics
+from app.routes.metrics_router import metrics_route
+
+
+def test_histogram_renders_cumulative_buckets():
+    latency = metrics.histogram("nestor_test_latency_seconds", "Test histogram.", ("route",), (0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        latency.observe(value, route="/a")
+    assert latency.render() == [
+        "# HELP nestor_test_latency_seconds Test histogram.",
+        "# TYPE nestor_test_latency_seconds histogram",
+        'nestor_test_latency_seconds_bucket{route="/a",le="0.1"} 2',
+        'nestor_test_latency_seconds_bucket{route="/a",le="1"} 3',
+        'nestor_test_latency_seconds_bucket{route="/a",le="+Inf"} 4',
+        'nestor_test_latency_seconds_sum{route="/a"} 3.65',
+        'nestor_test_latency_seconds_count{route="/a"} 4',
+    ]
+
+
+def test_metrics_endpoint_reports_requests_and_sql():
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=metrics.timed_pool_class("metrics_test"),
+    )
+    metrics.instrument_engine(engine, "metrics_test")
+    app = FastAPI()
+    app.add_middleware(metrics.metrics_middleware)
+    app.include_router(metrics_route)
+
+    @app.get("/metrics_test/{name}")
+    def lookup(name: str):
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            conn.execute(text("SELECT 2"))
+        return {"name": name}
+
+    client = TestClient(app)
+    assert client.get("/metrics_test/a").status_code == 200
+    assert client.get("/metrics_test/b").status_code == 200
+    response = client.get("/metrics")
+    assert response.headers["content-type"] == metrics.CONTENT_TYPE
+    lines = set(response.text.splitlines())
+
+    route = 'method="GET",route="/metrics_test/{name}"'
+    assert f"nestor_http_requests_total{{{route},status=\"200\"}} 2" in lines
+    assert f"nestor_http_request_duration_seconds_count{{{route}}} 2" in lines
+    assert f'nestor_http_request_statements_bucket{{{route},le="1"}} 0' in lines
+    assert f'nestor_http_request_statements_bucket{{{route},le="2"}} 2' in lines
+    assert f"nestor_http_request_statements_sum{{{route}}} 4" in lines
+    assert 'nestor_db_statement_duration_seconds_count{engine="metrics_test"} 4' in lines
+    assert 'nestor_db_pool_checkout_seconds_count{engine="metrics_test"} 2' in lines
+    assert 'nestor_db_pool_connections{engine="metrics_test",state="checked_out"} 0' in lines
+    assert "# TYPE nestor_http_request_duration_seconds histogram" in lines
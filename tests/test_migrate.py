@@ -0,0 +1,54 @@
+from sqlalchemy import text
+
+from app import migrate
+from app.models import contact
+
+
+def _extensions_available(conn) -> bool:
+    return conn.scalar(text(
+        "SELECT count(*) FROM pg_available_extensions WHERE name IN ('pg_trgm', 'btree_gin')"
+    )) == 2
+
+
+def _contact_problems():
+    return [
+        problem for problem in migrate.check_schema()
+        if problem.startswith(("table contact ", "column contact.")) or problem.endswith(" on contact is missing")
+    ]
+
+
+def test_check_schema_finds_mixed_case_indexes(db_engine):
+    with db_engine.begin() as conn:
+        contact.__table__.create(conn, checkfirst=True)
+    assert _contact_problems() == []
+
+    index = next(index for index in contact.__table__.indexes if index.name == "ix_contact_WhatsappjId")
+    with db_engine.begin() as conn:
+        conn.execute(text('DROP INDEX "ix_contact_WhatsappjId"'))
+    try:
+        assert _contact_problems() == ["index ix_contact_WhatsappjId on contact is missing"]
+    finally:
+        with db_engine.begin() as conn:
+            index.create(conn, checkfirst=True)
+
+
+def test_migrations_build_the_models_from_scratch(db_engine, monkeypatch):
+    with db_engine.begin() as conn:
+        conn.execute(text("DROP SCHEMA public CASCADE; CREATE SCHEMA public"))
+        extensions = _extensions_available(conn)
+    expected = []
+    if not extensions:
+        # Without the extensions only the search indexes are left out.
+        monkeypatch.setattr(migrate, "MIGRATIONS", [
+            (version, name, step if step is not migrate._search_indexes else lambda: None)
+            for version, name, step in migrate.MIGRATIONS
+        ])
+        expected = [
+            f"index ix_{table}_{kind} on {table} is missing"
+            for table in ("message", "image_message")
+            for kind in ("search", "trgm")
+        ]
+
+    assert migrate.upgrade() == [version for version, _, _ in migrate.MIGRATIONS]
+    assert sorted(migrate.check_schema()) == sorted(expected)
+    assert migrate.upgrade() == []
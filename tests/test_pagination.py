@@ -0,0 +1,23 @@
+from datetime import datetime
+
+import pytest
+
+from app.pagination import decode_cursor, encode_cursor
+
+
+def test_cursor_round_trip():
+    position = datetime(2026, 3, 1, 12, 30, 45, 123456)
+    token = encode_cursor(position, "5511999999999@s.whatsapp.net")
+    assert "=" not in token
+    assert decode_cursor(token) == (position, "5511999999999@s.whatsapp.net")
+
+
+def test_cursor_orders_ties_by_key():
+    position = datetime(2026, 3, 1)
+    assert decode_cursor(encode_cursor(position, "a")) != decode_cursor(encode_cursor(position, "b"))
+
+
+@pytest.mark.parametrize("token", ["", "not a cursor", "W10", encode_cursor(datetime(2026, 1, 1), "k")[:-3] + "!!!"])
+def test_invalid_cursor(token):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        decode_cursor(token)
@@ -0,0 +1,85 @@
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import Column, DateTime, MetaData, String, Table, text
+
+from app import partitions
+
+MONTH = date(2026, 2, 1)
+
+
+def _table(partitioned: bool) -> Table:
+    options = {"postgresql_partition_by": "RANGE (datetime)"} if partitioned else {}
+    return Table(
+        "partition_test", MetaData(),
+        Column("id", String, primary_key=True),
+        Column("datetime", DateTime, primary_key=True),
+        **options,
+    )
+
+
+@pytest.fixture
+def scratch(db_engine, monkeypatch):
+    monkeypatch.setattr(partitions, "_known_months", set())
+    monkeypatch.setattr(partitions, "_unpartitioned_until", 0.0)
+
+    def drop():
+        with db_engine.begin() as conn:
+            conn.execute(text("DROP TABLE IF EXISTS partition_test, partition_test_legacy CASCADE"))
+
+    drop()
+    yield db_engine
+    drop()
+
+
+def _partitions(engine) -> list:
+    with engine.connect() as conn:
+        return conn.execute(text(
+            "SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = 'partition_test'::regclass"
+        )).scalars().all()
+
+
+def test_ensure_months_rechecks_unpartitioned_table(scratch, monkeypatch):
+    table = _table(partitioned=True)
+    monkeypatch.setattr(partitions, "PARTITIONED_TABLES", (table,))
+
+    # Missing table, e.g. a worker started before the migrations ran.
+    partitions.ensure_months([MONTH])
+    assert partitions._known_months == set()
+    assert partitions._unpartitioned_until > 0
+
+    table.create(scratch)
+    partitions.ensure_months([MONTH])
+    assert partitions._known_months == set()
+
+    monkeypatch.setattr(partitions, "_unpartitioned_until", 0.0)
+    partitions.ensure_months([MONTH])
+    assert partitions._known_months == {MONTH}
+    assert _partitions(scratch) == ["partition_test_p2026_02"]
+
+
+def test_convert_needs_opt_in_for_tables_with_rows(scratch):
+    _table(partitioned=False).create(scratch)
+    with scratch.begin() as conn:
+        conn.execute(text("INSERT INTO partition_test VALUES ('a', '2026-02-03'), ('b', '2026-03-04')"))
+
+    target = _table(partitioned=True)
+    with pytest.raises(RuntimeError, match="MIGRATE_ALLOW_TABLE_REWRITE"):
+        partitions.convert([target], allow_rewrite=False)
+    assert _partitions(scratch) == []
+
+    partitions.convert([target], allow_rewrite=True)
+    assert sorted(_partitions(scratch)) == ["partition_test_p2026_02", "partition_test_p2026_03"]
+    with scratch.connect() as conn:
+        assert conn.execute(text("SELECT id, datetime FROM partition_test ORDER BY id")).all() == [
+            ("a", datetime(2026, 2, 3)),
+            ("b", datetime(2026, 3, 4)),
+        ]
+        assert conn.scalar(text("SELECT count(*) FROM partition_test_legacy")) == 2
+
+
+def test_convert_rebuilds_empty_tables_without_opt_in(scratch):
+    _table(partitioned=False).create(scratch)
+    partitions.convert([_table(partitioned=True)], allow_rewrite=False)
+    with scratch.connect() as conn:
+        assert partitions._is_partitioned(conn, "partition_test")
@@ -0,0 +1,99 @@
+import asyncio
+
+from app.response_cache import response_cache
+
+
+class loader:
+    """Counts calls and returns the next value once released."""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        return self.calls
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def _run(test):
+    asyncio.run(test())
+
+
+def test_concurrent_misses_share_one_load():
+    async def test():
+        cache = response_cache(ttl=60, stale_ttl=60)
+        load = loader()
+        waiting = [asyncio.ensure_future(cache.get_or_compute(("a", "summary"), load)) for _ in range(5)]
+        await _settle()
+        load.release.set()
+        assert await asyncio.gather(*waiting) == [1] * 5
+        assert load.calls == 1
+        # Fresh now: served without loading.
+        assert await cache.get_or_compute(("a", "summary"), load) == 1
+        assert load.calls == 1
+
+    _run(test)
+
+
+def test_stale_entry_is_served_while_one_refresh_runs():
+    async def test():
+        cache = response_cache(ttl=60, stale_ttl=60)
+        load = loader()
+        load.release.set()
+        assert await cache.get_or_compute(("a",), load) == 1
+
+        load.release.clear()
+        cache.invalidate("a")
+        assert await cache.get_or_compute(("a",), load) == 1
+        await _settle()
+        assert load.calls == 2
+        load.release.set()
+        await _settle()
+        assert await cache.get_or_compute(("a",), load) == 2
+        assert load.calls == 2
+
+    _run(test)
+
+
+def test_invalidation_only_touches_its_instance():
+    async def test():
+        cache = response_cache(ttl=60, stale_ttl=60)
+        load = loader()
+        load.release.set()
+        for key in (("a",), ("b",), (None, "inboxes")):
+            await cache.get_or_compute(key, load)
+        cache.invalidate("a")
+        assert [cache._entries[key].stale for key in (("a",), ("b",), (None, "inboxes"))] == [True, False, True]
+
+    _run(test)
+
+
+def test_expired_entry_forces_a_reload():
+    async def test():
+        cache = response_cache(ttl=0, stale_ttl=0)
+        load = loader()
+        load.release.set()
+        assert await cache.get_or_compute(("a",), load) == 1
+        assert await cache.get_or_compute(("a",), load) == 2
+
+    _run(test)
+
+
+def test_write_during_load_leaves_the_result_stale():
+    async def test():
+        cache = response_cache(ttl=60, stale_ttl=60)
+        load = loader()
+        pending = asyncio.ensure_future(cache.get_or_compute(("a",), load))
+        await _settle()
+        cache.invalidate("a")
+        load.release.set()
+        assert await pending == 1
+        assert cache._entries[("a",)].stale
+
+    _run(test)
@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time as clock
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app import rollup
+from app.models import message, message_rollup, message_rollup_contact
+from app.partitions import ensure_months, month_start
+from app.routes.dashboard_router import _dashboard_time_data
+
+DAY = datetime(2026, 1, 15, 10, 30)
+
+
+def _live_insert(conn, instance_id: str, message_id: str) -> None:
+    """What webhook ingestion does for one stored text message."""
+    conn.execute(pg_insert(message).values(
+        messageId=message_id, datetime=DAY, WhatsappjId="5511@s.whatsapp.net",
+        Message_Type="Incoming", Message_Content="oi", instanceId=instance_id,
+    ))
+    stmt = pg_insert(message_rollup).values(
+        instanceId=instance_id, bucket=rollup.hour_bucket(DAY), direction="Incoming", kind="text", message_count=1
+    )
+    conn.execute(stmt.on_conflict_do_update(
+        index_elements=list(rollup.ROLLUP_KEY),
+        set_={"message_count": message_rollup.message_count + stmt.excluded.message_count},
+    ))
+
+
+def test_backfill_keeps_concurrent_live_counts(db_engine):
+    ensure_months([month_start(DAY)])
+    instance_id = f"rollup-{uuid.uuid4()}"
+    try:
+        with db_engine.begin() as conn:
+            _live_insert(conn, instance_id, "m1")
+
+        # A webhook transaction is in flight while the backfill recomputes the day.
+        live = db_engine.connect()
+        live.begin()
+        _live_insert(live, instance_id, "m2")
+
+        def run_backfill():
+            with db_engine.begin() as conn:
+                rollup.backfill_day(conn, DAY.date())
+
+        backfill = threading.Thread(target=run_backfill)
+        backfill.start()
+        clock.sleep(0.3)
+        live.commit()
+        live.close()
+        backfill.join(10)
+
+        with db_engine.connect() as conn:
+            count = conn.scalar(select(message_rollup.message_count).where(message_rollup.instanceId == instance_id))
+        assert count == 2
+    finally:
+        with db_engine.begin() as conn:
+            conn.execute(delete(message).where(message.instanceId == instance_id))
+            conn.execute(delete(message_rollup).where(message_rollup.instanceId == instance_id))
+            conn.execute(delete(message_rollup_contact).where(message_rollup_contact.instanceId == instance_id))
+
+
+def test_dashboard_time_reads_hourly_rollups(db_engine):
+    instance_id = f"rollup-{uuid.uuid4()}"
+    today = DAY.date()
+    with db_engine.begin() as conn:
+        conn.execute(pg_insert(message_rollup).values([
+            dict(instanceId=instance_id, bucket=rollup.hour_bucket(DAY), direction="Incoming", kind="text", message_count=3),
+            dict(instanceId=instance_id, bucket=rollup.hour_bucket(DAY), direction="Incoming", kind="image", message_count=1),
+            dict(instanceId=instance_id, bucket=DAY.replace(hour=14, minute=0), direction="Outgoing", kind="text", message_count=2),
+            # Yesterday's counts stay out of today's hours.
+            dict(instanceId=instance_id, bucket=rollup.hour_bucket(DAY) - timedelta(days=1), direction="Outgoing", kind="text", message_count=5),
+        ]))
+
+    async def test():
+        from app.database import open_session
+
+        db = open_session()
+        try:
+            return await _dashboard_time_data(db, today, instance_id)
+        finally:
+            await db.close()
+
+    try:
+        data = asyncio.run(test())
+    finally:
+        with db_engine.begin() as conn:
+            conn.execute(delete(message_rollup).where(message_rollup.instanceId == instance_id))
+
+    received = data["messages_received"]["received_by_time"]
+    sent = data["messages_sent"]["sent_by_time"]
+    assert len(received) == len(sent) == 24
+    assert received[10] == {"time_10": 4}
+    assert sent[14] == {"time_14": 2}
+    assert sum(sum(hour.values()) for hour in received + sent) == 6
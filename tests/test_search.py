@@ -0,0 +1,17 @@
+from app.search import HIGHLIGHT_START, HIGHLIGHT_STOP, highlight_substring
+
+
+def test_headline_is_escaped_before_marking():
+    headline = f"<img src=x onerror=alert(1)> {HIGHLIGHT_START}pedido{HIGHLIGHT_STOP} 123"
+    assert highlight_substring("ignored", headline, "pedido") == (
+        "&lt;img src=x onerror=alert(1)&gt; <mark>pedido</mark> 123"
+    )
+
+
+def test_substring_match_is_escaped():
+    text = "<b>ABC-12345</b>"
+    assert highlight_substring(text, text, "1234") == "&lt;b&gt;ABC-<mark>1234</mark>5&lt;/b&gt;"
+
+
+def test_no_match_returns_escaped_headline():
+    assert highlight_substring(None, "a < b", "zzz") == "a &lt; b"
@@ -0,0 +1,172 @@
+import asyncio
+import json
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.broadcast import postgres_backend
+from app.routes.message_router import message_route
+from app.websocket_manager import connection_manager, replay_buffer
+
+
+class fake_websocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message):
+        self.sent.append(json.loads(message))
+
+    async def close(self, code=1000):
+        pass
+
+
+async def _drain():
+    for _ in range(50):
+        await asyncio.sleep(0)
+
+
+def _publish(manager, message_id, instance_id="inst", whatsapp_id="jid", seq=None):
+    """Publish and return the event's sequence number."""
+    manager.publish({"messageId": message_id}, instance_id, whatsapp_id, seq)
+    return manager.position(instance_id)
+
+
+def _run(test):
+    asyncio.run(test())
+
+
+def test_replay_buffer_since_and_eviction():
+    buffer = replay_buffer(2, floor=10)
+    for seq in (11, 12, 13):
+        buffer.append(seq, "jid", str(seq))
+    assert buffer.evicted_upto == 11
+    assert [event[0] for event in buffer.since(11)] == [12, 13]
+    buffer.raise_floor(12)
+    assert [event[0] for event in buffer.since(0)] == [13]
+
+
+def test_resume_replays_missed_events():
+    async def test():
+        manager = connection_manager()
+        first = _publish(manager, "a")
+        _publish(manager, "b")
+        ws = fake_websocket()
+        await manager.connect(ws)
+        assert manager.resume(ws, first)
+        await _drain()
+        assert [m.get("messageId", m.get("type")) for m in ws.sent] == ["b", "resumed"]
+        manager.disconnect(ws)
+
+    _run(test)
+
+
+def test_resume_across_publish_with_backend_sequence():
+    # The postgres backend numbers each instance's events from 1, well below
+    # the clock-based floor the manager starts with.
+    async def test():
+        manager = connection_manager()
+        postgres_backend(manager, dsn="postgresql://unused")
+        # What the listener does on connect: the counters' current values.
+        manager.reset_floors({"inst": 5})
+        _publish(manager, "a", seq=6)
+
+        ws = fake_websocket()
+        await manager.connect(ws)
+        _publish(manager, "b", seq=7)
+        assert manager.resume(ws, 6)
+        await _drain()
+        assert ws.sent[-2:] == [
+            {"messageId": "b", "seq": 7},
+            {"type": "resumed", "last_seq": 6, "replayed": 1},
+        ]
+        manager.disconnect(ws)
+
+    _run(test)
+
+
+def test_resume_outside_buffer_requires_resync():
+    async def test():
+        manager = connection_manager(replay_size=1)
+        first = _publish(manager, "a")
+        _publish(manager, "b")
+        _publish(manager, "c")
+        ws = fake_websocket()
+        await manager.connect(ws)
+        assert not manager.resume(ws, first)
+        assert not manager.resume(ws, first + 100)
+        await _drain()
+        assert [m["type"] for m in ws.sent] == ["resync_required", "resync_required"]
+        manager.disconnect(ws)
+
+    _run(test)
+
+
+def test_resume_only_replays_subscribed_conversations():
+    async def test():
+        manager = connection_manager()
+        ws = fake_websocket()
+        await manager.connect(ws)
+        manager.subscribe(ws, "inst", ["jid-1"])
+        start = _publish(manager, "a", "inst", "jid-1")
+        _publish(manager, "b", "inst", "jid-2")
+        _publish(manager, "c", "inst", "jid-1")
+        _publish(manager, "d", "other", "jid-1")
+        await _drain()
+        ws.sent.clear()
+        assert manager.resume(ws, start)
+        await _drain()
+        assert [m.get("messageId", m.get("type")) for m in ws.sent] == ["c", "resumed"]
+        manager.disconnect(ws)
+
+    _run(test)
+
+
+def test_resume_with_positions_per_instance():
+    async def test():
+        manager = connection_manager()
+        postgres_backend(manager, dsn="postgresql://unused")
+        _publish(manager, "a1", "a", seq=1)
+        _publish(manager, "b1", "b", seq=1)
+        ws = fake_websocket()
+        await manager.connect(ws)
+        _publish(manager, "a2", "a", seq=2)
+        _publish(manager, "b2", "b", seq=2)
+        _publish(manager, "b3", "b", seq=3)
+
+        assert manager.resume(ws, {"a": 1, "b": 2})
+        # A followed instance without a position cannot be resumed.
+        assert not manager.resume(ws, {"a": 1})
+        assert not manager.resume(ws, 1)
+        await _drain()
+        replayed = [m.get("messageId", m.get("type")) for m in ws.sent[3:]]
+        assert sorted(replayed[:2]) == ["a2", "b3"]
+        assert replayed[2:] == ["resumed", "resync_required", "resync_required"]
+        manager.disconnect(ws)
+
+    _run(test)
+
+
+def test_malformed_subscribe_commands_answer_errors():
+    app = FastAPI()
+    app.include_router(message_route)
+    malformed = [
+        "not json",
+        "[]",
+        {"action": "subscribe"},
+        {"action": "subscribe", "instanceId": "i3", "WhatsappjId": 5},
+        {"action": "subscribe", "instanceId": "i3", "WhatsappjId": [5]},
+        {"action": "subscribe", "instanceId": "i3", "WhatsappjId": {"a": 1}},
+        {"action": "subscribe", "instanceId": ["i3"]},
+        {"action": "unsubscribe", "instanceId": {"i": 3}},
+        {"action": "resume", "last_seq": "x"},
+    ]
+    with TestClient(app).websocket_connect("/ws/mensagens") as ws:
+        for command in malformed:
+            ws.send_text(command if isinstance(command, str) else json.dumps(command))
+            assert ws.receive_json() == {"type": "error", "details": "Invalid command"}
+        # The connection survived and still takes valid commands.
+        ws.send_text(json.dumps({"action": "subscribe", "instanceId": "i3", "WhatsappjId": "jid"}))
+        assert ws.receive_json()["type"] == "subscribed"